@@ -0,0 +1,528 @@
+# encoding: utf-8
+
+u'''
+Benchmarks for ckanext-rq.
+
+Measures the throughput and latency of the most important background job
+operations and writes the results as JSON, so that the results of
+different releases can be compared::
+
+    python bench/benchmark.py -c /etc/ckan/default/development.ini \\
+        --output results-0.1.json
+    python bench/benchmark.py -c /etc/ckan/default/development.ini \\
+        --compare results-0.1.json
+
+By default the Redis instance configured in the CKAN configuration file is
+used. Use ``--redis-url`` to use another instance (recommended, since the
+benchmarks create and delete lots of jobs) or ``--fakeredis`` to run
+against an in-process fake Redis (requires a version of ``fakeredis``
+with Lua support, i.e. ``pip install fakeredis[lua]``, since RQ uses Lua
+scripts). Benchmarks that fork work horses are skipped with
+``--fakeredis``, since forked processes do not share the fake database.
+
+All benchmarks only use the queue ``benchmark`` and clear it before and
+after each run.
+'''
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+BENCHMARK_QUEUE = u'benchmark'
+
+# Number of jobs that are added per round trip when filling a queue
+FILL_BATCH_SIZE = 1000
+
+# Modules that importing ``ckanext.rq.jobs`` must not import, since they
+# make every process that enqueues jobs slow to start
+HEAVY_MODULES = [u'ckan.model', u'ckan.config.environment']
+
+# Number of modules listed by the import benchmark
+SLOWEST_IMPORTS = 10
+
+# Number of jobs prefetched by the worker of the prefetch benchmark
+PREFETCH = 10
+
+
+def noop():
+    u'''
+    A background job that does nothing.
+    '''
+    pass
+
+
+def load_config(path):
+    u'''
+    Load a CKAN configuration file (like ``paster`` commands do).
+    '''
+    from paste.deploy import appconfig
+    from ckan.config.environment import load_environment
+    conf = appconfig(u'config:' + os.path.abspath(path))
+    load_environment(conf.global_conf, conf.local_conf)
+
+
+def use_redis(url):
+    u'''
+    Make ckanext-rq use the Redis instance at ``url``.
+    '''
+    from ckanext.rq import jobs, redis
+    from ckanext.rq.redis import REDIS_URL_SETTING_NAME
+    redis.config[REDIS_URL_SETTING_NAME] = url
+    redis._connection_pool = None
+    jobs._queues.clear()
+
+
+def use_fakeredis():
+    u'''
+    Make ckanext-rq use an in-process fake Redis.
+    '''
+    import fakeredis
+    from ckanext.rq import jobs, redis
+
+    def connect_to_redis():
+        return fakeredis.FakeRedis()
+
+    for module in (jobs, redis):
+        module.connect_to_redis = connect_to_redis
+    jobs._queues.clear()
+
+
+def call_action(name, **kwargs):
+    from ckanext.rq import action
+    return getattr(action, name)({u'ignore_auth': True}, kwargs)
+
+
+def clear_queue():
+    call_action(u'job_clear', queues=[BENCHMARK_QUEUE])
+
+
+def fill_queue(size):
+    u'''
+    Add ``size`` no-op jobs to the benchmark queue.
+
+    Uses one round trip per :py:data:`FILL_BATCH_SIZE` jobs, since filling
+    large queues via ``enqueue`` would take longer than the benchmarks.
+    '''
+    from rq.job import JobStatus
+    from rq.utils import utcnow
+    from ckanext.rq import jobs, shards
+    queue = jobs.get_queue(BENCHMARK_QUEUE)
+    shard = shards.get_queue_shard(queue.name)
+    ids = []
+    for start in range(0, size, FILL_BATCH_SIZE):
+        with queue.connection.pipeline() as pipeline:
+            for i in range(start, min(size, start + FILL_BATCH_SIZE)):
+                job = queue.job_class.create(
+                    noop, connection=queue.connection,
+                    status=JobStatus.QUEUED, origin=queue.name,
+                    id=shards.new_job_id(shard),
+                    meta={u'title': u'Benchmark job {}'.format(i)})
+                job.enqueued_at = utcnow()
+                jobs._push_job(job, pipeline)
+                ids.append(job.id)
+            pipeline.execute()
+    return ids
+
+
+def measure(fn, repeat):
+    u'''
+    Measure the duration of an operation ``repeat`` times.
+
+    ``fn`` prepares a measurement and returns the callable whose duration
+    is measured, so that the preparation is not included.
+
+    :returns: The durations in seconds.
+    :rtype: list
+    '''
+    durations = []
+    for _ in range(repeat):
+        target = fn()
+        if not callable(target):
+            raise ValueError(u'Benchmark setup must return a callable')
+        start = timeit.default_timer()
+        target()
+        durations.append(timeit.default_timer() - start)
+    return durations
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def result(name, size, operations, durations, **extra):
+    u'''
+    Create the result dict of a benchmark.
+
+    :param string name: Name of the benchmark.
+    :param int size: Number of jobs in the queue during the benchmark
+        (``None`` if not applicable).
+    :param int operations: Number of operations per measurement.
+    :param list durations: The measured durations in seconds.
+    '''
+    median = _median(durations)
+    d = {
+        u'name': name,
+        u'size': size,
+        u'operations': operations,
+        u'repeat': len(durations),
+        u'min': min(durations),
+        u'median': median,
+        u'max': max(durations),
+        u'ops_per_sec': operations / median if median else None,
+    }
+    d.update(extra)
+    return d
+
+
+def bench_enqueue_single(args):
+    u'''
+    Latency of enqueueing a single job.
+    '''
+    from ckanext.rq import jobs
+
+    def setup():
+        return lambda: jobs.enqueue(noop, queue=BENCHMARK_QUEUE)
+
+    clear_queue()
+    durations = measure(setup, args.operations)
+    clear_queue()
+    return [result(u'enqueue_single', None, 1, durations)]
+
+
+def bench_enqueue_bulk(args):
+    u'''
+    Throughput of enqueueing many jobs one after another.
+    '''
+    from ckanext.rq import jobs
+
+    def setup():
+        clear_queue()
+
+        def run():
+            for _ in range(args.operations):
+                jobs.enqueue(noop, queue=BENCHMARK_QUEUE)
+        return run
+
+    durations = measure(setup, args.repeat)
+    clear_queue()
+    return [result(u'enqueue_bulk', None, args.operations, durations)]
+
+
+def _bench_worker(args, name, fork):
+    from ckanext.rq import jobs
+
+    def setup():
+        clear_queue()
+        fill_queue(args.operations)
+        worker = jobs.Worker([BENCHMARK_QUEUE])
+        if not fork:
+            worker.execute_job = worker.perform_job
+        return lambda: worker.work(burst=True)
+
+    durations = measure(setup, args.repeat)
+    clear_queue()
+    return [result(name, None, args.operations, durations)]
+
+
+def bench_worker_fork(args):
+    u'''
+    Throughput of a worker that executes no-op jobs in work horses.
+    '''
+    if args.fakeredis:
+        return []
+    return _bench_worker(args, u'worker_fork', True)
+
+
+def bench_worker_no_fork(args):
+    u'''
+    Throughput of a worker that executes no-op jobs in its own process.
+    '''
+    return _bench_worker(args, u'worker_no_fork', False)
+
+
+def bench_worker_prefetch(args):
+    u'''
+    Throughput of a worker that prefetches no-op jobs and executes them in
+    its own process.
+    '''
+    from ckanext.rq import prefetch
+    prefetch.config[u'ckanext.rq.prefetch'] = PREFETCH
+    try:
+        return _bench_worker(args, u'worker_prefetch', False)
+    finally:
+        del prefetch.config[u'ckanext.rq.prefetch']
+
+
+def bench_job_list(args):
+    u'''
+    Latency of ``job_list`` for large queues.
+    '''
+    results = []
+    for size in args.sizes:
+        clear_queue()
+        fill_queue(size)
+
+        def run():
+            call_action(u'job_list', queues=[BENCHMARK_QUEUE])
+
+        durations = measure(lambda: run, args.repeat)
+        results.append(result(u'job_list', size, 1, durations))
+    clear_queue()
+    return results
+
+
+def bench_job_show(args):
+    u'''
+    Latency of ``job_show`` for large queues.
+    '''
+    results = []
+    for size in args.sizes:
+        clear_queue()
+        ids = fill_queue(size)
+        # Look at jobs from the whole queue
+        step = max(1, len(ids) // args.operations)
+        sample = ids[::step][:args.operations]
+
+        def run():
+            for id in sample:
+                call_action(u'job_show', id=id)
+
+        durations = measure(lambda: run, args.repeat)
+        results.append(result(u'job_show', size, len(sample), durations))
+    clear_queue()
+    return results
+
+
+def bench_job_clear(args):
+    u'''
+    Duration of ``job_clear`` for large queues.
+    '''
+    results = []
+    for size in args.sizes:
+        def setup():
+            clear_queue()
+            fill_queue(size)
+            return clear_queue
+        durations = measure(setup, args.repeat)
+        results.append(result(u'job_clear', size, 1, durations))
+    return results
+
+
+def _run_python(code, *options):
+    u'''
+    Run Python code in a new interpreter with the same module path.
+
+    :returns: The standard output and standard error of the code.
+    '''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    process = subprocess.Popen(
+        [sys.executable] + list(options) + [u'-c', code], env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode:
+        raise RuntimeError(err.decode(u'utf-8'))
+    return out.decode(u'utf-8'), err.decode(u'utf-8')
+
+
+def _get_slowest_imports():
+    u'''
+    Get the modules that take the longest to import when importing
+    ``ckanext.rq.jobs``, using ``python -X importtime`` (Python 3.7+).
+    '''
+    _, err = _run_python(u'import ckanext.rq.jobs', u'-X', u'importtime')
+    imports = []
+    for line in err.splitlines():
+        if not line.startswith(u'import time:'):
+            continue
+        fields = line[len(u'import time:'):].split(u'|')
+        try:
+            own, cumulative = int(fields[0]), int(fields[1])
+        except ValueError:
+            # The header
+            continue
+        imports.append({
+            u'module': fields[2].strip(),
+            u'self': own / 1e6,
+            u'cumulative': cumulative / 1e6,
+        })
+    imports.sort(key=lambda i: i[u'self'], reverse=True)
+    return imports[:SLOWEST_IMPORTS]
+
+
+def bench_import(args):
+    u'''
+    Duration of importing ``ckanext.rq.jobs`` in a new interpreter, which
+    every process that enqueues jobs pays.
+    '''
+    code = u'''
+import sys, timeit
+start = timeit.default_timer()
+import ckanext.rq.jobs
+print(timeit.default_timer() - start)
+print(u' '.join(m for m in {!r} if m in sys.modules))
+'''.format(HEAVY_MODULES)
+    durations = []
+    heavy_modules = set()
+    for _ in range(args.repeat):
+        lines = _run_python(code)[0].splitlines()
+        durations.append(float(lines[0]))
+        heavy_modules.update(lines[1].split() if len(lines) > 1 else [])
+    extra = {u'heavy_modules': sorted(heavy_modules)}
+    if sys.version_info >= (3, 7):
+        extra[u'slowest_imports'] = _get_slowest_imports()
+    return [result(u'import_jobs', None, 1, durations, **extra)]
+
+
+BENCHMARKS = [
+    (u'import_jobs', bench_import),
+    (u'enqueue_single', bench_enqueue_single),
+    (u'enqueue_bulk', bench_enqueue_bulk),
+    (u'worker_fork', bench_worker_fork),
+    (u'worker_no_fork', bench_worker_no_fork),
+    (u'worker_prefetch', bench_worker_prefetch),
+    (u'job_list', bench_job_list),
+    (u'job_show', bench_job_show),
+    (u'job_clear', bench_job_clear),
+]
+
+
+def get_environment(args):
+    u'''
+    Describe the environment in which the benchmarks are run.
+    '''
+    import redis
+    import rq
+    from ckanext.rq.redis import connect_to_redis
+    env = {
+        u'python': platform.python_version(),
+        u'platform': platform.platform(),
+        u'rq': rq.VERSION,
+        u'redis_py': redis.__version__,
+        u'fakeredis': args.fakeredis,
+        u'timestamp': time.strftime(u'%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+    if not args.fakeredis:
+        env[u'redis_server'] = connect_to_redis().info()[u'redis_version']
+    return env
+
+
+def compare(old, new, max_regression=None):
+    u'''
+    Print a comparison of two sets of results.
+
+    :param float max_regression: Maximum increase of a median in percent
+        that is not reported as a regression.
+
+    :returns: Descriptions of the regressions.
+    :rtype: list
+    '''
+    regressions = []
+    old_results = dict(((r[u'name'], r[u'size']), r)
+                       for r in old[u'results'])
+    print(u'{:<16} {:>8} {:>12} {:>12} {:>8}'.format(
+          u'benchmark', u'size', u'old median', u'new median', u'change'))
+    for r in new[u'results']:
+        key = (r[u'name'], r[u'size'])
+        size = r[u'size'] if r[u'size'] is not None else u'-'
+        if key not in old_results:
+            print(u'{:<16} {:>8} {:>12} {:>12.6f} {:>8}'.format(
+                  r[u'name'], size, u'-', r[u'median'], u'-'))
+            continue
+        old_median = old_results[key][u'median']
+        change = (r[u'median'] - old_median) / old_median * 100
+        print(u'{:<16} {:>8} {:>12.6f} {:>12.6f} {:>+7.1f}%'.format(
+              r[u'name'], size, old_median, r[u'median'], change))
+        if max_regression is not None and change > max_regression:
+            regressions.append(u'{} (size {}) is {:.1f}% slower'.format(
+                r[u'name'], size, change))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description=u'Benchmark ckanext-rq.')
+    parser.add_argument(u'-c', u'--config', required=True,
+                        help=u'CKAN configuration file.')
+    parser.add_argument(u'--redis-url',
+                        help=u'Redis instance to use instead of the '
+                             u'configured one.')
+    parser.add_argument(u'--fakeredis', action=u'store_true',
+                        help=u'Use an in-process fake Redis.')
+    parser.add_argument(u'--sizes', default=u'10000,100000',
+                        help=u'Comma-separated queue sizes for the '
+                             u'listing and clearing benchmarks '
+                             u'(default: %(default)s).')
+    parser.add_argument(u'--operations', type=int, default=1000,
+                        help=u'Number of operations per measurement '
+                             u'(default: %(default)s).')
+    parser.add_argument(u'--repeat', type=int, default=5,
+                        help=u'Number of measurements per benchmark '
+                             u'(default: %(default)s).')
+    parser.add_argument(u'--only', action=u'append', default=[],
+                        choices=[name for name, _ in BENCHMARKS],
+                        help=u'Only run this benchmark (repeatable).')
+    parser.add_argument(u'--output',
+                        help=u'Write the results to this JSON file.')
+    parser.add_argument(u'--compare',
+                        help=u'Compare the results with those in this '
+                             u'JSON file.')
+    parser.add_argument(u'--max-regression', type=float,
+                        help=u'Exit with an error if a median is more '
+                             u'than this many percent slower than in the '
+                             u'compared results.')
+    args = parser.parse_args(argv)
+    args.sizes = [int(s) for s in args.sizes.split(u',') if s]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    load_config(args.config)
+    if args.fakeredis:
+        use_fakeredis()
+    elif args.redis_url:
+        use_redis(args.redis_url)
+    results = []
+    for name, fn in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        print(u'Running {}...'.format(name), file=sys.stderr)
+        results.extend(fn(args))
+    output = {
+        u'environment': get_environment(args),
+        u'results': results,
+    }
+    if args.output:
+        with open(args.output, u'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+    regressions = []
+    for r in results:
+        if r.get(u'heavy_modules'):
+            regressions.append(u'importing ckanext.rq.jobs imports {}'.format(
+                u', '.join(r[u'heavy_modules'])))
+    if args.compare:
+        with open(args.compare) as f:
+            regressions.extend(compare(json.load(f), output,
+                                       args.max_regression))
+    if regressions:
+        for regression in regressions:
+            print(u'Regression: {}'.format(regression), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == u'__main__':
+    main()
@@ -1,18 +1,26 @@
 # encoding: utf-8
 
+import datetime
+import itertools
 import logging
 import ckan.lib.navl.dictization_functions
 import ckan.logic as logic
 import ckan.plugins as p
 
+from ckanext.rq import cancel
+from ckanext.rq import failed
+from ckanext.rq import index
 from ckanext.rq import jobs
+from ckanext.rq import retry
 from ckanext.rq import schema
+from ckanext.rq import stats
 
 log = logging.getLogger(__name__)
 _get_or_bust = logic.get_or_bust
 _validate = ckan.logic.validate
 _check_access = p.toolkit.check_access
 NotFound = p.toolkit.ObjectNotFound
+ValidationError = p.toolkit.ValidationError
 
 
 @_validate(schema.job_list_schema)
@@ -22,22 +30,50 @@ def job_list(context, data_dict):
     :param list queues: Queues to list jobs from. If not given then the
         jobs from all queues are listed.
 
+    :param list fields: Additional attributes to include for each job:
+        ``status``, ``enqueued``, ``started``, ``ended``, ``duration``,
+        ``worker``, ``exc_info`` and/or ``meta`` (see ``job_show``).
+    :param int limit: Maximum number of jobs to return (optional).
+    :param int offset: Number of jobs to skip (optional).
+    :param string q: Only list jobs whose title contains all words of
+        this string (optional, case-insensitive).
+    :param string title: Only list jobs whose title matches this
+        shell-style pattern (optional), e.g. ``'Harvest*'``, like in
+        ``job_clear``.
+    :param string function: Only list jobs of this function (optional).
+        Can be the fully qualified name or just the function name.
+    :param string since: Only list jobs that were created at or after
+        this time (optional, ISO 8601, UTC).
+    :param string until: Only list jobs that were created before this
+        time (optional, ISO 8601, UTC).
+
+    Without filters (or only with ``title``) the jobs are listed in the
+    order of their queues. With the other filters they are looked up in
+    the job indexes (see ``paster jobs reindex``) and listed in the order
+    in which they were created.
+
     :returns: The currently enqueued background jobs.
     :rtype: list
 
     .. versionadded:: 2.7
     '''
     _check_access(u'job_list', context, data_dict)
-    dictized_jobs = []
-    queues = data_dict.get(u'queues')
-    if queues:
-        queues = [jobs.get_queue(q) for q in queues]
-    else:
-        queues = jobs.get_all_queues()
-    for queue in queues:
-        for job in queue.jobs:
-            dictized_jobs.append(jobs.dictize_job(job))
-    return dictized_jobs
+    filters = dict((key, data_dict[key]) for key in
+                   [u'q', u'function', u'since', u'until']
+                   if data_dict.get(key))
+    title = data_dict.get(u'title') or None
+    fields = data_dict.get(u'fields', [])
+    offset = data_dict.get(u'offset', 0)
+    limit = data_dict.get(u'limit')
+    if filters:
+        enqueued_jobs = index.search_jobs(data_dict.get(u'queues'),
+                                          title=title, fields=fields,
+                                          **filters)
+        stop = None if limit is None else offset + limit
+        return list(itertools.islice(enqueued_jobs, offset, stop))
+    enqueued_jobs = jobs.iter_jobs(data_dict.get(u'queues'), title=title,
+                                   fields=fields, offset=offset)
+    return list(itertools.islice(enqueued_jobs, limit))
 
 
 def job_show(context, data_dict):
@@ -45,7 +81,16 @@ def job_show(context, data_dict):
 
     :param string id: The ID of the background job.
 
-    :returns: Details about the background job.
+    :returns: Details about the background job: its ``id``, ``title``,
+        ``queue`` and ``status``, the times when it was ``created``,
+        ``enqueued``, ``started`` and ``ended``, its ``duration`` in
+        seconds, the name of the ``worker`` that performed it, the
+        traceback of a failed job (``exc_info``) and its ``meta`` data.
+        For jobs that have been performed this also includes their
+        ``timings``: the total run time, the number of database queries,
+        the time spent in them, the slowest statement and the number and
+        duration of HTTP requests (including Solr queries). All times are
+        in seconds. The job is read from Redis with a single command.
     :rtype: dict
 
     .. versionadded:: 2.7
@@ -53,19 +98,37 @@ def job_show(context, data_dict):
     _check_access(u'job_show', context, data_dict)
     id = _get_or_bust(data_dict, u'id')
     try:
-        return jobs.dictize_job(jobs.job_from_id(id))
+        job_dict = jobs.get_job_dict(id)
     except KeyError:
         raise NotFound
+    timings = job_dict[u'meta'].get(u'timings')
+    if timings:
+        job_dict[u'timings'] = timings
+    return job_dict
 
 
 @_validate(schema.job_clear_schema)
 def job_clear(context, data_dict):
     '''Clear background job queues.
 
-    Does not affect jobs that are already being processed.
+    Also deletes jobs of these queues that wait for a retry. Does not
+    affect jobs that are already being processed.
+
+    If filters are given then only the enqueued jobs matching all of
+    them are cancelled, in batches, while the rest of the queues is
+    kept. Jobs that wait for a retry are not affected in that case.
 
     :param list queues: The queues to clear. If not given then ALL
         queues are cleared.
+    :param string title: Only cancel jobs whose title matches this
+        shell-style pattern (optional), e.g. ``'Harvest*'``.
+    :param string function: Only cancel jobs of this function
+        (optional). Can be the fully qualified name or just the function
+        name.
+    :param int min_age: Only cancel jobs that were created at least
+        this many seconds ago (optional).
+    :param string arg: Only cancel jobs that have this value as one of
+        their arguments (optional). Values are compared as strings.
 
     :returns: The cleared queues.
     :rtype: list
@@ -79,25 +142,146 @@ def job_clear(context, data_dict):
     else:
         queues = jobs.get_all_queues()
     names = [jobs.remove_queue_name_prefix(queue.name) for queue in queues]
+    filters = dict((key, data_dict[key]) for key in
+                   [u'title', u'function', u'arg'] if key in data_dict)
+    if u'min_age' in data_dict:
+        filters[u'until'] = (datetime.datetime.utcnow() -
+                             datetime.timedelta(seconds=data_dict[u'min_age']))
+    if filters:
+        for name in names:
+            cancel.clear_jobs(name, **filters)
+        return names
     for queue, name in zip(queues, names):
+        index.unindex_queue(queue)
         queue.empty()
+        retry.clear_delayed(queue)
         log.info(u'Cleared background job queue "{}"'.format(name))
     return names
 
 
+@_validate(schema.job_cancel_schema)
 def job_cancel(context, data_dict):
-    '''Cancel a queued background job.
+    '''Cancel queued background jobs.
 
-    Removes the job from the queue and deletes it.
+    Removes the jobs from their queues and deletes them. Either ``id`` or
+    ``ids`` must be given. Several jobs are cancelled in batches.
 
-    :param string id: The ID of the background job.
+    :param string id: The ID of a single background job.
+    :param list ids: The IDs of several background jobs. IDs of jobs
+        that do not exist are ignored.
+
+    :returns: The IDs of the cancelled jobs.
+    :rtype: list
 
     .. versionadded:: 2.7
     '''
     _check_access(u'job_cancel', context, data_dict)
-    id = _get_or_bust(data_dict, u'id')
-    try:
-        jobs.job_from_id(id).delete()
+    ids = data_dict.get(u'ids')
+    if ids is None:
+        id = _get_or_bust(data_dict, u'id')
+        if not cancel.cancel_jobs([id]):
+            raise NotFound
         log.info(u'Cancelled background job {}'.format(id))
-    except KeyError:
-        raise NotFound
+        return [id]
+    return cancel.cancel_jobs(ids)
+
+
+@_validate(schema.job_failed_list_schema)
+def job_failed_list(context, data_dict):
+    '''List failed background jobs.
+
+    :param list queues: Queues to list failed jobs from. If not given
+        then the failed jobs from all queues are listed.
+    :param string function: Only list jobs of this function (optional).
+        Can be the fully qualified name or just the function name.
+    :param string exc_type: Only list jobs that failed with this
+        exception type (optional), e.g. ``'ValueError'``.
+    :param int limit: Maximum number of jobs to return (optional).
+    :param int offset: Number of matching jobs to skip (optional).
+
+    :returns: The failed background jobs, in the order in which they
+        failed.
+    :rtype: list
+    '''
+    _check_access(u'job_failed_list', context, data_dict)
+    failed_jobs = failed.iter_failed_jobs(
+        queues=data_dict.get(u'queues'),
+        function=data_dict.get(u'function'),
+        exc_type=data_dict.get(u'exc_type'))
+    offset = data_dict.get(u'offset', 0)
+    limit = data_dict.get(u'limit')
+    stop = None if limit is None else offset + limit
+    return list(itertools.islice(failed_jobs, offset, stop))
+
+
+@_validate(schema.job_requeue_schema)
+def job_requeue(context, data_dict):
+    '''Requeue failed background jobs.
+
+    Moves failed jobs back to the queues they came from. The jobs can
+    either be given by ID or selected via the same filters that
+    ``job_failed_list`` supports. To requeue ALL failed jobs, pass
+    ``all=True`` instead.
+
+    :param string id: The ID of a single failed job (optional).
+    :param list ids: The IDs of several failed jobs (optional).
+    :param list queues: Requeue the failed jobs from these queues
+        (optional).
+    :param string function: Requeue the failed jobs of this function
+        (optional).
+    :param string exc_type: Requeue the jobs that failed with this
+        exception type (optional).
+    :param bool all: Requeue all failed jobs if neither IDs nor filters
+        are given (optional, default: false).
+
+    :returns: The IDs of the requeued jobs.
+    :rtype: list
+    '''
+    _check_access(u'job_requeue', context, data_dict)
+    id = data_dict.get(u'id')
+    ids = data_dict.get(u'ids')
+    if id:
+        requeued = failed.requeue_failed_jobs([id])
+        if not requeued:
+            raise NotFound
+        log.info(u'Requeued failed background job {}'.format(id))
+        return requeued
+    if ids is None:
+        filters = dict((key, data_dict[key]) for key in
+                       [u'queues', u'function', u'exc_type']
+                       if data_dict.get(key))
+        if not filters and not data_dict.get(u'all'):
+            raise ValidationError({u'ids': [
+                u'Give the IDs of the jobs, filters or "all"']})
+        ids = [job[u'id'] for job in failed.iter_failed_jobs(**filters)]
+    return failed.requeue_failed_jobs(ids)
+
+
+@_validate(schema.job_stats_schema)
+def job_stats(context, data_dict):
+    '''Show statistics of background job queues.
+
+    :param list queues: Queues to show statistics for. If not given then
+        all queues are included.
+    :param int window: Number of past minutes over which the rates are
+        averaged (optional, default: 5).
+
+    :returns: For each queue its ``name``, the number of queued jobs
+        (``depth``), the number of jobs that are being performed
+        (``running``), the numbers of enqueued and finished jobs per
+        minute (``arrival_rate`` and ``drain_rate``) and the estimated
+        number of seconds until the queue is empty (``drain_time``,
+        ``None`` if the queue is not shrinking).
+    :rtype: list
+    '''
+    _check_access(u'job_stats', context, data_dict)
+    queues = data_dict.get(u'queues')
+    if queues:
+        queues = [jobs.get_queue(q) for q in queues]
+    else:
+        queues = jobs.get_all_queues()
+    window = data_dict.get(u'window', stats.DEFAULT_WINDOW)
+    results = stats.get_queue_stats(queues, window=window)
+    for result in results:
+        result[u'name'] = jobs.remove_queue_name_prefix(result[u'name'])
+    return results
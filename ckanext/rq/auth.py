@@ -16,3 +16,18 @@ def job_clear(context, data_dict):
 def job_cancel(context, data_dict):
     '''Cancel a background job. Only sysadmins.'''
     return {'success': False}
+
+
+def job_failed_list(context, data_dict):
+    '''List failed background jobs. Only sysadmins.'''
+    return {'success': False}
+
+
+def job_requeue(context, data_dict):
+    '''Requeue failed background jobs. Only sysadmins.'''
+    return {'success': False}
+
+
+def job_stats(context, data_dict):
+    '''Show background job queue statistics. Only sysadmins.'''
+    return {'success': False}
@@ -0,0 +1,274 @@
+# encoding: utf-8
+
+u'''
+Autoscaling of local worker processes.
+
+The :py:class:`Autoscaler` starts and retires worker processes on the
+local machine so that the number of workers follows the backlog of their
+queues (see :py:mod:`ckanext.rq.stats`). It can be run via ``paster jobs
+autoscale``.
+
+The number of workers is chosen so that the current backlog is drained
+within ``ckanext.rq.autoscale_drain_time`` seconds (300 by default) while
+keeping up with new jobs, based on the throughput of the current
+workers. Since the statistics cover the whole cluster, all workers that
+listen on the queues count, including those on other machines; the local
+workers make up the difference between the workers that are needed and
+the other ones. Additional workers are started immediately, surplus
+workers are retired one at a time. Workers are retired gracefully (like
+on ``SIGTERM``), i.e. they finish their current job before they exit.
+The worker processes run in a process group of their own, so that a
+``SIGINT`` from the terminal only reaches the autoscaler, which then
+retires them.
+'''
+
+from __future__ import absolute_import, division
+
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from rq.worker import WorkerStatus
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+from ckanext.rq import jobs, stats
+
+
+log = logging.getLogger(__name__)
+
+DRAIN_TIME_DEFAULT_VALUE = 300
+
+
+def get_desired_workers(queue_stats, current, min_workers, max_workers,
+                        drain_time=DRAIN_TIME_DEFAULT_VALUE, others=0):
+    u'''
+    Compute the number of local workers needed for a backlog.
+
+    :param list queue_stats: Statistics of the queues that the workers
+        listen on, see :py:func:`ckanext.rq.stats.get_queue_stats`.
+
+    :param int current: Current number of local workers.
+
+    :param int min_workers: Minimum number of local workers.
+
+    :param int max_workers: Maximum number of local workers.
+
+    :param int drain_time: Number of seconds in which the backlog should
+        be drained.
+
+    :param int others: Number of other workers in the cluster that
+        listen on the queues, see :py:func:`count_workers`.
+
+    :rtype: int
+    '''
+    total = current + others
+    depth = sum(s[u'depth'] for s in queue_stats)
+    running = sum(s[u'running'] for s in queue_stats)
+    arrival_rate = sum(s[u'arrival_rate'] for s in queue_stats)
+    drain_rate = sum(s[u'drain_rate'] for s in queue_stats)
+    if depth == 0:
+        desired = running - others
+    elif total and drain_rate > 0:
+        # Jobs per minute that one worker can perform
+        per_worker = drain_rate / total
+        needed = arrival_rate + depth / (drain_time / 60)
+        desired = int(math.ceil(needed / per_worker)) - others
+    else:
+        # No throughput data yet, grow step by step
+        desired = current + 1
+    return max(min_workers, min(max_workers, desired))
+
+
+def count_workers(queues, exclude=()):
+    u'''
+    Count the workers in the cluster that listen on at least one of some
+    queues.
+
+    :param list queues: ``rq.queue.Queue`` instances.
+
+    :param list exclude: Names of workers that are not counted.
+
+    :rtype: int
+    '''
+    names = set(queue.name for queue in queues)
+    prefix = jobs.Worker.redis_worker_namespace_prefix
+    excluded = set(prefix + name for name in exclude)
+    redis_conn = jobs._connect()
+    keys = [key for key in redis_conn.smembers(
+            jobs.Worker.redis_workers_keys)
+            if key.decode(u'utf-8') not in excluded]
+    with redis_conn.pipeline(transaction=False) as pipeline:
+        for key in keys:
+            pipeline.hget(key, u'queues')
+        values = pipeline.execute()
+    # Workers whose key has expired are dead
+    return sum(1 for value in values
+               if value and names.intersection(
+                   value.decode(u'utf-8').split(u',')))
+
+
+def _run_worker(queues, name):
+    # A SIGINT from the terminal goes to the whole process group. The
+    # autoscaler retires the workers itself, and a second signal would
+    # make RQ kill the job that a worker is performing.
+    os.setpgrp()
+    jobs.Worker(queues, name=name).work()
+
+
+class Autoscaler(object):
+    u'''
+    Supervisor that scales local worker processes with the backlog.
+
+    :param list queues: Names of the queues that the workers listen on.
+        If not given then the default queue is used.
+
+    :param int min_workers: Minimum number of workers.
+
+    :param int max_workers: Maximum number of workers.
+
+    :param int interval: Seconds between scaling decisions.
+    '''
+    def __init__(self, queues=None, min_workers=1, max_workers=4,
+                 interval=10):
+        if min_workers < 0 or max_workers < max(1, min_workers):
+            raise ValueError(u'Invalid number of workers: {} to {}'.format(
+                             min_workers, max_workers))
+        self.queue_names = queues or [jobs.DEFAULT_QUEUE_NAME]
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.drain_time = int(config.get(u'ckanext.rq.autoscale_drain_time',
+                                         DRAIN_TIME_DEFAULT_VALUE))
+        self.workers = []
+        self.retiring = []
+        self._stop_requested = False
+        self._started = 0
+
+    def start_worker(self):
+        # Make sure that database connections are not shared with the
+        # new process, see ``Worker.execute_job``.
+        from ckan.model import meta
+        meta.Session.remove()
+        meta.engine.dispose()
+        self._started += 1
+        name = u'{}.autoscale-{}-{}'.format(
+            socket.gethostname().split(u'.')[0], os.getpid(), self._started)
+        process = multiprocessing.Process(target=_run_worker, name=name,
+                                          args=(self.queue_names, name))
+        process.start()
+        self.workers.append(process)
+        log.info(u'Started worker process {}'.format(process.pid))
+
+    def _get_worker_states(self):
+        u'''
+        Get the states of the worker processes from Redis.
+        '''
+        prefix = jobs.Worker.redis_worker_namespace_prefix
+        redis_conn = jobs._connect()
+        with redis_conn.pipeline(transaction=False) as pipeline:
+            for process in self.workers:
+                pipeline.hget(prefix + process.name, u'state')
+            return pipeline.execute()
+
+    def retire_worker(self):
+        u'''
+        Ask a worker process to exit once its current job is finished.
+
+        Idle workers are retired first.
+        '''
+        states = self._get_worker_states()
+        index = len(self.workers) - 1
+        for i, state in enumerate(states):
+            if state and state.decode(u'utf-8') == WorkerStatus.IDLE:
+                index = i
+                break
+        process = self.workers.pop(index)
+        os.kill(process.pid, signal.SIGTERM)
+        self.retiring.append(process)
+        log.info(u'Retiring worker process {}'.format(process.pid))
+
+    def collect(self):
+        u'''
+        Forget about worker processes that have exited.
+        '''
+        for process in self.workers[:]:
+            if not process.is_alive():
+                process.join()
+                self.workers.remove(process)
+                log.warning(u'Worker process {} has exited unexpectedly'
+                            .format(process.pid))
+        for process in self.retiring[:]:
+            if not process.is_alive():
+                process.join()
+                self.retiring.remove(process)
+                log.info(u'Worker process {} has been retired'.format(
+                         process.pid))
+
+    def scale(self):
+        u'''
+        Adjust the number of workers to the current backlog.
+
+        :returns: The new number of workers.
+        :rtype: int
+        '''
+        self.collect()
+        queues = [jobs.get_queue(q) for q in self.queue_names]
+        queue_stats = stats.get_queue_stats(queues)
+        current = len(self.workers)
+        # Retiring workers take no new jobs, so they are not counted
+        others = count_workers(queues, [process.name for process in
+                                        self.workers + self.retiring])
+        desired = get_desired_workers(queue_stats, current,
+                                      self.min_workers, self.max_workers,
+                                      self.drain_time, others)
+        if desired > current:
+            log.info(u'Scaling up from {} to {} worker(s)'.format(current,
+                                                                 desired))
+            for _ in range(desired - current):
+                self.start_worker()
+        elif desired < current:
+            log.info(u'Scaling down from {} to {} worker(s)'.format(
+                     current, current - 1))
+            self.retire_worker()
+        return len(self.workers)
+
+    def stop(self):
+        u'''
+        Retire all workers and wait until they have exited.
+        '''
+        while self.workers:
+            self.retire_worker()
+        for process in self.retiring:
+            process.join()
+        self.retiring = []
+
+    def _request_stop(self, signum, frame):
+        self._stop_requested = True
+
+    def run(self):
+        u'''
+        Scale the workers until ``SIGINT`` or ``SIGTERM`` is received.
+        '''
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        log.info(u'Autoscaling {} to {} worker(s) on queue(s) {}'.format(
+                 self.min_workers, self.max_workers,
+                 u', '.join(u'"{}"'.format(q) for q in self.queue_names)))
+        try:
+            while not self._stop_requested:
+                self.scale()
+                deadline = time.time() + self.interval
+                while not self._stop_requested and time.time() < deadline:
+                    time.sleep(0.5)
+        finally:
+            log.info(u'Stopping all workers')
+            self.stop()
@@ -0,0 +1,178 @@
+# encoding: utf-8
+
+u'''
+Memoized results of background jobs.
+
+Some jobs (for example the validation of a resource that has not
+changed) are enqueued again and again with the same arguments. A job
+that is enqueued with a ``cache_ttl`` (see
+:py:func:`ckanext.rq.jobs.enqueue`) is cacheable: once it has finished
+successfully its result is stored in Redis for ``cache_ttl`` seconds,
+and an identical job that is enqueued meanwhile is finished right away
+with that result instead of being added to its queue.
+
+Jobs are identical if they call the same function with the same
+arguments. The arguments are canonicalised (dicts and sets are sorted,
+tuples become lists, ...) and hashed, so they must be JSON serializable
+apart from sets, dates and datetimes. The queue of a job does not matter.
+
+Each CKAN site has its own cache, which is stored in its Redis instance
+(or, on a sharded setup, in the shard of the job's queue):
+
+* ``rq:cache:<prefix><hash>`` contains the pickled result of a job and
+  expires after the job's ``cache_ttl``.
+* ``rq:cache:<prefix>lru`` is a sorted set of the cache entries, scored by
+  the time of their last use. Once it has more entries than configured
+  via ``ckanext.rq.cache_max_entries`` the least recently used entries
+  are evicted.
+
+``<prefix>`` is the queue name prefix of the site.
+'''
+
+from __future__ import absolute_import
+
+import datetime
+import hashlib
+import json
+import logging
+import time
+
+from rq.job import dumps, unpickle
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+
+log = logging.getLogger(__name__)
+
+MAX_ENTRIES_DEFAULT_VALUE = 10000
+
+# Get a cached result and mark it as recently used.
+#
+# KEYS[1]: The key of the cache entry
+# KEYS[2]: The sorted set of cache entries
+# ARGV[1]: The current timestamp
+_GET_SCRIPT = b'''
+    local value = redis.call('get', KEYS[1])
+    if value then
+        redis.call('zadd', KEYS[2], ARGV[1], KEYS[1])
+    else
+        redis.call('zrem', KEYS[2], KEYS[1])
+    end
+    return value
+'''
+
+# Store a result and evict the least recently used entries.
+#
+# KEYS[1]: The key of the cache entry
+# KEYS[2]: The sorted set of cache entries
+# ARGV[1]: The pickled result
+# ARGV[2]: The TTL of the entry in seconds
+# ARGV[3]: The current timestamp
+# ARGV[4]: The maximum number of entries
+#
+# Returns the number of evicted entries.
+_STORE_SCRIPT = b'''
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    redis.call('zadd', KEYS[2], ARGV[3], KEYS[1])
+    local excess = redis.call('zcard', KEYS[2]) - tonumber(ARGV[4])
+    if excess <= 0 then
+        return 0
+    end
+    local evicted = redis.call('zrange', KEYS[2], 0, excess - 1)
+    -- unpack() fails for more than a few thousand values
+    for i = 1, #evicted, 1000 do
+        redis.call('del', unpack(evicted, i, math.min(i + 999, #evicted)))
+    end
+    redis.call('zremrangebyrank', KEYS[2], 0, excess - 1)
+    return #evicted
+'''
+
+
+def get_max_entries():
+    return int(config.get(u'ckanext.rq.cache_max_entries',
+                          MAX_ENTRIES_DEFAULT_VALUE))
+
+
+def get_cache_key(prefix, name):
+    u'''
+    Get the key of a cache entry or of the set of entries (``lru``).
+
+    :param string prefix: The queue name prefix of the CKAN site.
+
+    :param string name: The hash of the job or ``lru``.
+    '''
+    return u'rq:cache:{}{}'.format(prefix, name)
+
+
+def _get_lru_key(key):
+    return key[:-len(key.rsplit(u':', 1)[-1])] + u'lru'
+
+
+def _encode(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(u'Arguments of type {} cannot be used for cacheable '
+                    u'jobs'.format(type(value).__name__))
+
+
+def get_job_hash(func_name, args, kwargs):
+    u'''
+    Get the hash that identifies a job by its function and arguments.
+
+    :param string func_name: The fully qualified name of the function.
+
+    :param list args: The positional arguments.
+
+    :param dict kwargs: The keyword arguments.
+
+    :raises TypeError: If an argument cannot be canonicalised.
+
+    :rtype: string
+    '''
+    canonical = json.dumps([func_name, list(args), kwargs], sort_keys=True,
+                           separators=(u',', u':'), default=_encode)
+    return hashlib.sha1(canonical.encode(u'utf-8')).hexdigest()
+
+
+def get(key, connection):
+    u'''
+    Look up a cached result.
+
+    :param string key: The key of the cache entry.
+
+    :param connection: The Redis connection of the job's queue.
+
+    :returns: A tuple of whether the result is cached and the result.
+    :rtype: tuple
+    '''
+    script = connection.register_script(_GET_SCRIPT)
+    value = script(keys=[key, _get_lru_key(key)], args=[time.time()])
+    if value is None:
+        return False, None
+    return True, unpickle(value)
+
+
+def store(key, result, ttl, connection):
+    u'''
+    Cache the result of a job.
+
+    :param string key: The key of the cache entry.
+
+    :param result: The result of the job.
+
+    :param int ttl: Number of seconds for which the result is cached.
+
+    :param connection: The Redis connection of the job's queue.
+    '''
+    script = connection.register_script(_STORE_SCRIPT)
+    evicted = script(keys=[key, _get_lru_key(key)],
+                     args=[dumps(result), ttl, time.time(),
+                           get_max_entries()])
+    if evicted:
+        log.debug(u'Evicted {} cached job result(s)'.format(evicted))
@@ -0,0 +1,271 @@
+# encoding: utf-8
+
+u'''
+Bulk cancellation of enqueued background jobs.
+
+Cancelling a job one by one takes several round trips and an LREM per
+job, which is O(N) in the length of the queue. The functions in this
+module instead cancel jobs in batches with a server-side script, which
+removes the batch's queue entries in a single pass over the queue and
+deletes the job hashes atomically. Even 100k jobs can therefore be
+removed from a long queue in a few hundred round trips, without
+emptying the queue.
+'''
+
+from __future__ import absolute_import
+
+import fnmatch
+import logging
+
+from rq.compat import as_text
+from rq.job import Job, unpickle
+from rq.utils import utcparse
+
+from ckanext.rq import failed, index, jobs, shards
+
+
+log = logging.getLogger(__name__)
+
+# Number of jobs that are cancelled per script invocation
+CANCEL_BATCH_SIZE = 1000
+
+# Cancel jobs of a CKAN instance.
+#
+# KEYS[1]: Optional, the queue that contains the marker job
+# ARGV[1]: The queue name prefix of the CKAN instance
+# ARGV[2]: Index in KEYS[1] from which to start looking for the jobs
+# ARGV[3]: ID of a marker job in KEYS[1], or an empty string
+# ARGV[4]: The expected index of the marker job
+# ARGV[5]: '1' to also cancel jobs that are not in their queue (for
+#          example delayed jobs), '0' otherwise
+# ARGV[6:]: The IDs of the jobs to cancel
+#
+# Jobs are looked for in KEYS[1] from ARGV[2] on if the marker is still
+# at its expected index, and from the head of their queue otherwise.
+# Found jobs are overwritten with a tombstone which is then removed with
+# a single LREM, and each scan stops as soon as all jobs (and the
+# marker) have been found.
+#
+# Returns the number of jobs that are left in KEYS[1] up to and
+# including the marker (0 if the marker is gone) and the IDs of the
+# cancelled jobs.
+_CANCEL_SCRIPT = b'''
+    local prefix = ARGV[1]
+    local marker = ARGV[3]
+    local tombstone = '__cancelled__'
+    local wanted = {}
+    local keys = {}
+    local pending = {}
+    if KEYS[1] then
+        table.insert(keys, KEYS[1])
+        pending[KEYS[1]] = 0
+    end
+    for i = 6, #ARGV do
+        local id = ARGV[i]
+        local origin = redis.call('hget', 'rq:job:' .. id, 'origin')
+        if origin and string.sub(origin, 1, #prefix) == prefix
+                and not wanted[id] then
+            local key = 'rq:queue:' .. origin
+            wanted[id] = key
+            if not pending[key] then
+                pending[key] = 0
+                table.insert(keys, key)
+            end
+            pending[key] = pending[key] + 1
+        end
+    end
+    local cancelled = {}
+    local function cancel(id)
+        redis.call('del', 'rq:job:' .. id, 'rq:job:' .. id .. ':dependents')
+        table.insert(cancelled, id)
+        wanted[id] = nil
+    end
+    local cursor = 0
+    for _, key in ipairs(keys) do
+        local index = 0
+        local found = true
+        if key == KEYS[1] and marker ~= '' then
+            found = false
+            if redis.call('lindex', key, ARGV[4]) == marker then
+                index = tonumber(ARGV[2])
+            end
+        end
+        local length = redis.call('llen', key)
+        local removed = 0
+        while index < length and (pending[key] > 0 or not found) do
+            local chunk = redis.call('lrange', key, index, index + 999)
+            for j, id in ipairs(chunk) do
+                local position = index + j - 1
+                if wanted[id] == key then
+                    redis.call('lset', key, position, tombstone)
+                    removed = removed + 1
+                    pending[key] = pending[key] - 1
+                    cancel(id)
+                end
+                if not found and id == marker then
+                    found = true
+                    cursor = position + 1 - removed
+                end
+                if pending[key] == 0 and found then
+                    break
+                end
+            end
+            index = index + #chunk
+        end
+        if removed > 0 then
+            redis.call('lrem', key, removed, tombstone)
+        end
+    end
+    if ARGV[5] == '1' then
+        for i = 6, #ARGV do
+            local key = wanted[ARGV[i]]
+            if key then
+                local origin = string.sub(key, #'rq:queue:' + 1)
+                redis.call('zrem', 'rq:delayed:' .. origin, ARGV[i])
+                cancel(ARGV[i])
+            end
+        end
+    end
+    return {cursor, cancelled}
+'''
+
+
+def cancel_jobs(ids):
+    u'''
+    Cancel jobs.
+
+    Each job is removed from its queue (or from the delayed jobs of its
+    queue) and deleted. IDs of jobs that do not exist or do not belong
+    to this CKAN instance are ignored.
+
+    :param list ids: The IDs of the jobs.
+
+    :returns: The IDs of the cancelled jobs.
+    :rtype: list
+    '''
+    prefix = jobs.add_queue_name_prefix(u'')
+    by_shard = {}
+    for id in ids:
+        by_shard.setdefault(shards.get_job_shard(id), []).append(id)
+    cancelled = []
+    for shard, shard_ids in sorted(by_shard.items()):
+        redis_conn = shards.connect_to_shard(shard)
+        script = redis_conn.register_script(_CANCEL_SCRIPT)
+        for i in range(0, len(shard_ids), CANCEL_BATCH_SIZE):
+            batch = shard_ids[i:i + CANCEL_BATCH_SIZE]
+            objs = index.get_job_hashes(batch, redis_conn)
+            result = script(args=[prefix, 0, u'', 0, 1] + batch)
+            ids = [as_text(id) for id in result[1]]
+            with redis_conn.pipeline() as pipeline:
+                for id in ids:
+                    if id in objs:
+                        index.remove_job_hash(id, objs[id], pipeline)
+                pipeline.execute()
+            cancelled.extend(ids)
+    log.info(u'Cancelled {} background job(s)'.format(len(cancelled)))
+    return cancelled
+
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return as_text(value)
+    return u'{}'.format(value)
+
+
+def _get_args(data):
+    u'''
+    Get the argument values of a job from its pickled data.
+    '''
+    try:
+        args, kwargs = unpickle(data)[2:]
+    except Exception:
+        # Functions that cannot be imported, ...
+        return []
+    return list(args) + list(kwargs.values())
+
+
+def clear_jobs(queue, title=None, function=None, until=None, arg=None):
+    u'''
+    Cancel the enqueued jobs of a queue that match the given filters.
+
+    The queue is read in pages of :py:data:`ckanext.rq.jobs.PAGE_SIZE`
+    jobs and the matching jobs of each page are cancelled atomically.
+    Jobs that are dequeued meanwhile are not affected. Delayed jobs are
+    not affected either.
+
+    :param string queue: The name of the queue.
+
+    :param string title: Only cancel jobs whose title matches this
+        shell-style pattern (e.g. ``'Harvest*'``).
+
+    :param string function: Only cancel jobs of this function. Can be
+        the fully qualified name or just the function name.
+
+    :param datetime.datetime until: Only cancel jobs that were created
+        before this time (UTC).
+
+    :param arg: Only cancel jobs that have this value as one of their
+        positional or keyword arguments. The values are compared as
+        strings.
+
+    :returns: The number of cancelled jobs.
+    :rtype: int
+    '''
+    rq_queue = jobs.get_queue(queue)
+    redis_conn = rq_queue.connection
+    script = redis_conn.register_script(_CANCEL_SCRIPT)
+    prefix = jobs.add_queue_name_prefix(u'')
+    fields = index.INDEX_FIELDS[:]
+    if arg is not None:
+        fields.append(u'data')
+        arg = _to_text(arg)
+    count = 0
+    start = 0
+    while True:
+        ids = [as_text(id) for id in redis_conn.lrange(
+               rq_queue.key, start, start + jobs.PAGE_SIZE - 1)]
+        if not ids:
+            break
+        with redis_conn.pipeline(transaction=False) as pipeline:
+            for id in ids:
+                pipeline.hmget(Job.key_for(id), fields)
+            values = pipeline.execute()
+        matched = {}
+        for id, value in zip(ids, values):
+            obj = dict(zip(fields, value))
+            if not obj[u'created_at']:
+                # The job has been deleted
+                continue
+            if until is not None and (
+                    utcparse(as_text(obj[u'created_at'])) >= until):
+                continue
+            if function is not None and not failed.matches_name(
+                    as_text(obj[u'description'] or b'').split(u'(', 1)[0],
+                    function):
+                continue
+            if title is not None:
+                meta = unpickle(obj[u'meta']) if obj[u'meta'] else {}
+                if meta.get(u'title') is None or not fnmatch.fnmatchcase(
+                        meta[u'title'], title):
+                    continue
+            if arg is not None and arg not in [
+                    _to_text(v) for v in _get_args(obj[u'data'])]:
+                continue
+            matched[id] = obj
+        # The marker tells us where to continue if jobs have been
+        # dequeued in the meantime
+        cursor, cancelled = script(keys=[rq_queue.key],
+                                   args=[prefix, start, ids[-1],
+                                         start + len(ids) - 1, 0] +
+                                   list(matched))
+        if cancelled:
+            with redis_conn.pipeline() as pipeline:
+                for id in cancelled:
+                    id = as_text(id)
+                    index.remove_job_hash(id, matched[id], pipeline)
+                pipeline.execute()
+        count += len(cancelled)
+        start = cursor
+    log.info(u'Cancelled {} background job(s) from queue "{}"'.format(
+             count, queue))
+    return count
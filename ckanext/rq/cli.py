@@ -1,3 +1,6 @@
+import datetime
+import itertools
+import json
 import sys
 from optparse import OptionConflictError
 
@@ -11,7 +14,7 @@ class JobsCommand(CkanCommand):
 
     Usage:
 
-        paster jobs worker [--burst] [QUEUES]
+        paster jobs worker [--burst] [--site=CONFIG ...] [QUEUES]
 
             Start a worker that fetches jobs from queues and executes
             them. If no queue names are given then the worker listens
@@ -32,25 +35,153 @@ class JobsCommand(CkanCommand):
             If the `--burst` option is given then the worker will exit
             as soon as all its queues are empty.
 
-        paster jobs list [QUEUES]
+            With one or more `--site` options the worker performs the
+            jobs of the CKAN sites with those configuration files (which
+            must use the same Redis instance as this site) instead of the
+            jobs of this site:
+
+                paster jobs worker --site /etc/ckan/a.ini \\
+                                   --site /etc/ckan/b.ini
+
+            Sending SIGHUP to a worker reloads its code and configuration
+            without interrupting the job that it is performing. The
+            worker keeps taking jobs until its new process is ready, see
+            `ckanext.rq.reloader`.
+
+        paster jobs autoscale [QUEUES] [--min=M] [--max=N] [--interval=S]
+
+            Start and retire local worker processes for the given queues
+            (or the default queue) according to their backlog, keeping
+            between M (default: 1) and N (default: 4) workers. Every S
+            seconds (default: 10) the number of workers is adjusted so
+            that the queued jobs are performed within
+            `ckanext.rq.autoscale_drain_time` seconds, together with the
+            workers on other machines that listen on the same queues.
+            Workers are retired after they have finished their current
+            job.
+
+        paster jobs top [QUEUES] [--interval=S]
+
+                Show a live view of the given queues (or of all queues)
+                with their depth and rates, the workers and the jobs they
+                are performing, and the most recent failures. The view is
+                refreshed every S seconds (default: 1). Press Ctrl+C to
+                exit.
+
+        paster jobs list [QUEUES] [--format=FORMAT] [--limit=N]
+                [--since=TIME] [--until=TIME] [--title=PATTERN]
 
                 List currently enqueued jobs from the given queues. If no queue
                 names are given then the jobs from all queues are listed.
+                The jobs are streamed from Redis in pages, so even very
+                long queues can be listed. FORMAT is `text` (the default),
+                `json` or `ndjson` (one JSON object per line). The list
+                can be limited to jobs created in a time range (UTC, e.g.
+                `2017-03-01` or `2017-03-01T12:00:00`) and to jobs whose
+                title matches a shell-style pattern (e.g. `Harvest*`).
+
+        paster jobs search [QUEUES] [--query=WORDS] [--function=NAME]
+                [--since=TIME] [--until=TIME] [--title=PATTERN]
+                [--format=FORMAT] [--limit=N]
+
+                Find enqueued jobs using the job indexes instead of reading
+                all jobs: by words in their title, by job function and by
+                creation time. The results can also be filtered by a title
+                pattern like in `list`. Jobs are listed in the order in
+                which they were created, in the formats of `list`.
+
+        paster jobs reindex [QUEUES]
+
+                Add the currently enqueued jobs of the given queues (or of
+                all queues) to the job indexes used by `search`. Only
+                needed for jobs that were enqueued before the indexes
+                existed.
 
         paster jobs show ID
 
                 Show details about a specific job.
 
-        paster jobs cancel ID
+        paster jobs cancel ID [ID ...]
 
-                Cancel a specific job. Jobs can only be canceled while they are
+                Cancel specific jobs. Jobs can only be canceled while they are
                 enqueued. Once a worker has started executing a job it cannot
-                be aborted anymore.
+                be aborted anymore. Several jobs are cancelled in batches; use
+                `-` as the only ID to read the IDs from stdin, one per line.
 
-        paster jobs clear [QUEUES]
+        paster jobs clear [QUEUES] [--title=PATTERN] [--function=NAME]
+                [--min-age=SECONDS] [--arg=VALUE]
 
                 Cancel all jobs on the given queues. If no queue names are
-                given then ALL queues are cleared.
+                given then ALL queues are cleared. If filters are given then
+                only the jobs matching all of them are cancelled: by title
+                pattern, by job function, by minimum age and by the value of
+                one of their arguments.
+
+        paster jobs failed [list] [QUEUES] [--function=NAME]
+                [--exc-type=NAME] [--limit=N] [--offset=N]
+
+                List failed jobs from the given queues. If no queue names
+                are given then the failed jobs from all queues are listed.
+                The list can be filtered by the job function and by the type
+                of the exception that the job raised.
+
+        paster jobs failed requeue [IDS] [--queue=NAME] [--function=NAME]
+                [--exc-type=NAME]
+
+                Requeue failed jobs. Either the IDs of the jobs are given or
+                all failed jobs matching the filter options are requeued. If
+                neither IDs nor filters are given then ALL failed jobs are
+                requeued.
+
+        paster jobs spool [replay]
+
+                Show the number of jobs in the local spool. Jobs are spooled
+                to disk if Redis is not available while they are enqueued.
+                With `replay` the spooled jobs are added to their queues.
+
+        paster jobs reap [QUEUES]
+
+                Recover jobs from the given queues whose worker has died.
+                Depending on the reap policy of their queue the jobs are
+                requeued or moved to the failed jobs. If no queue names
+                are given then all queues are checked. Workers also do
+                this regularly.
+
+        paster jobs gc [--dry-run]
+
+                Delete stale job data from Redis: jobs that are neither
+                enqueued nor in a registry, leftovers of deleted jobs and,
+                if `ckanext.rq.gc_sites` is set, the data of other CKAN
+                sites. With `--dry-run` only report what would be deleted
+                and how much memory that would free. Workers also do this
+                regularly if `ckanext.rq.gc_interval` is set.
+
+        paster jobs memory [QUEUES] [--samples=N] [--limit=N]
+                [--format=FORMAT]
+
+                Estimate the Redis memory used by the jobs of the given
+                queues (or of all queues): per queue, per registry and per
+                job function, the largest jobs and the size of the
+                tracebacks of failed jobs. The estimates are extrapolated
+                from up to N (default: 100) jobs sampled from each queue
+                and registry. `--limit` sets the number of functions and
+                jobs shown (default: 10). FORMAT is `text` or `json`.
+
+        paster jobs events [--follow] [--since=TIME] [--format=FORMAT]
+
+                Show the lifecycle events of jobs (enqueued, started,
+                finished and failed, with their timings), which are
+                published if `ckanext.rq.events_max_length` is set. With
+                `--follow` new events are shown as they happen until
+                Ctrl+C is pressed. `--since` only shows events at or after
+                a time (UTC). FORMAT is `text` or `ndjson`.
+
+        paster jobs profile ID [--limit=N] [--sort=KEY]
+
+                Show the functions in which a profiled job spent the most
+                time. `--limit` sets the number of functions (default: 20)
+                and `--sort` the sort order (default: cumulative). See the
+                documentation of ckanext.rq.profile on how to profile jobs.
 
         paster jobs test [QUEUES]
 
@@ -69,6 +200,62 @@ class JobsCommand(CkanCommand):
             self.parser.add_option(u'--burst', action='store_true',
                                    default=False,
                                    help=u'Start worker in burst mode.')
+            self.parser.add_option(u'--site', action='append',
+                                   default=[], dest='sites',
+                                   help=u'Config file of a CKAN site whose '
+                                        u'jobs the worker performs '
+                                        u'(repeatable).')
+            self.parser.add_option(u'--queue', action='append',
+                                   default=[], dest='queues',
+                                   help=u'Filter by queue (repeatable).')
+            self.parser.add_option(u'--function', default=None,
+                                   help=u'Filter by job function.')
+            self.parser.add_option(u'--exc-type', default=None,
+                                   dest='exc_type',
+                                   help=u'Filter by exception type.')
+            self.parser.add_option(u'--limit', type='int', default=None,
+                                   help=u'Maximum number of jobs to list.')
+            self.parser.add_option(u'--offset', type='int', default=0,
+                                   help=u'Number of jobs to skip.')
+            self.parser.add_option(u'--format', default=u'text',
+                                   choices=[u'text', u'json', u'ndjson'],
+                                   help=u'Output format of job lists.')
+            self.parser.add_option(u'--since', default=None,
+                                   help=u'List jobs created at or after '
+                                        u'this time.')
+            self.parser.add_option(u'--until', default=None,
+                                   help=u'List jobs created before this '
+                                        u'time.')
+            self.parser.add_option(u'--title', default=None,
+                                   help=u'Filter by job title pattern.')
+            self.parser.add_option(u'--query', default=None,
+                                   help=u'Search for words in job titles.')
+            self.parser.add_option(u'--min-age', type='int', default=None,
+                                   dest='min_age',
+                                   help=u'Filter by minimum job age in '
+                                        u'seconds.')
+            self.parser.add_option(u'--arg', default=None,
+                                   help=u'Filter by job argument value.')
+            self.parser.add_option(u'--dry-run', action='store_true',
+                                   default=False, dest='dry_run',
+                                   help=u'Only report what would be '
+                                        u'deleted.')
+            self.parser.add_option(u'--follow', action='store_true',
+                                   default=False,
+                                   help=u'Wait for new events.')
+            self.parser.add_option(u'--samples', type='int', default=None,
+                                   help=u'Number of jobs sampled per queue.')
+            self.parser.add_option(u'--sort', default=u'cumulative',
+                                   help=u'Sort order of profiles.')
+            self.parser.add_option(u'--min', type='int', default=1,
+                                   dest='min_workers',
+                                   help=u'Minimum number of workers.')
+            self.parser.add_option(u'--max', type='int', default=4,
+                                   dest='max_workers',
+                                   help=u'Maximum number of workers.')
+            self.parser.add_option(u'--interval', type='float', default=None,
+                                   help=u'Seconds between scaling steps or '
+                                        u'refreshes.')
         except OptionConflictError:
             # Option has already been added in previous call
             pass
@@ -82,34 +269,109 @@ class JobsCommand(CkanCommand):
             sys.exit(0)
         if cmd == u'worker':
             self.worker()
+        elif cmd == u'autoscale':
+            self.autoscale()
+        elif cmd == u'top':
+            self.top()
         elif cmd == u'list':
             self.list()
+        elif cmd == u'search':
+            self.search()
+        elif cmd == u'reindex':
+            self.reindex()
         elif cmd == u'show':
             self.show()
         elif cmd == u'cancel':
             self.cancel()
         elif cmd == u'clear':
             self.clear()
+        elif cmd == u'failed':
+            self.failed()
+        elif cmd == u'spool':
+            self.spool()
+        elif cmd == u'reap':
+            self.reap()
+        elif cmd == u'gc':
+            self.gc()
+        elif cmd == u'memory':
+            self.memory()
+        elif cmd == u'events':
+            self.events()
+        elif cmd == u'profile':
+            self.profile()
         elif cmd == u'test':
             self.test()
         else:
             error(u'Unknown command "{}"'.format(cmd))
 
     def worker(self):
-        from ckanext.rq.jobs import Worker
-        Worker(self.args).work(burst=self.options.burst)
+        if self.options.sites:
+            from ckanext.rq.sites import MultiSiteWorker
+            try:
+                worker = MultiSiteWorker(self.options.sites, self.args)
+            except ValueError as e:
+                error(u'{}'.format(e))
+        else:
+            from ckanext.rq.jobs import Worker
+            worker = Worker(self.args)
+        worker.reload_command = [sys.executable] + sys.argv
+        worker.work(burst=self.options.burst)
+
+    def autoscale(self):
+        from ckanext.rq.autoscale import Autoscaler
+        try:
+            autoscaler = Autoscaler(self.args,
+                                    min_workers=self.options.min_workers,
+                                    max_workers=self.options.max_workers,
+                                    interval=self.options.interval or 10)
+        except ValueError as e:
+            error(u'{}'.format(e))
+        autoscaler.run()
+
+    def top(self):
+        from ckanext.rq import top
+        top.run(self.args, interval=self.options.interval or 1)
 
     def list(self):
-        data_dict = {
-            u'queues': self.args,
-        }
-        jobs = p.toolkit.get_action(u'job_list')({}, data_dict)
-        for job in jobs:
-            if job[u'title'] is None:
-                job[u'title'] = ''
+        from ckanext.rq.jobs import iter_jobs
+        self._print_jobs(iter_jobs(self.args,
+                                   since=parse_datetime(self.options.since),
+                                   until=parse_datetime(self.options.until),
+                                   title=self.options.title))
+
+    def search(self):
+        from ckanext.rq.index import search_jobs
+        self._print_jobs(search_jobs(self.args,
+                                     q=self.options.query,
+                                     function=self.options.function,
+                                     since=parse_datetime(self.options.since),
+                                     until=parse_datetime(self.options.until),
+                                     title=self.options.title))
+
+    def reindex(self):
+        from ckanext.rq.index import rebuild
+        print(u'Indexed {} job(s)'.format(rebuild(self.args)))
+
+    def _print_jobs(self, jobs):
+        if self.options.limit is not None:
+            jobs = itertools.islice(jobs, self.options.limit)
+        format = self.options.format
+        if format == u'json':
+            sys.stdout.write(u'[')
+        for i, job in enumerate(jobs):
+            if format == u'json':
+                sys.stdout.write(u'\n' if i == 0 else u',\n')
+                sys.stdout.write(json.dumps(job))
+            elif format == u'ndjson':
+                print(json.dumps(job))
             else:
-                job[u'title'] = u'"{}"'.format(job[u'title'])
-            print(u'{created} {id} {queue} {title}'.format(**job))
+                if job[u'title'] is None:
+                    job[u'title'] = ''
+                else:
+                    job[u'title'] = u'"{}"'.format(job[u'title'])
+                print(u'{created} {id} {queue} {title}'.format(**job))
+        if format == u'json':
+            print(u'\n]')
 
     def show(self):
         if not self.args:
@@ -119,32 +381,198 @@ class JobsCommand(CkanCommand):
             job = p.toolkit.get_action(u'job_show')({}, {u'id': id})
         except p.toolkit.ObjectNotFound:
             error(u'There is no job with ID "{}"'.format(id))
-        print(u'ID:      {}'.format(job[u'id']))
+        print(u'ID:       {}'.format(job[u'id']))
         if job[u'title'] is None:
             title = u'None'
         else:
             title = u'"{}"'.format(job[u'title'])
-        print(u'Title:   {}'.format(title))
-        print(u'Created: {}'.format(job[u'created']))
-        print(u'Queue:   {}'.format(job[u'queue']))
+        print(u'Title:    {}'.format(title))
+        print(u'Queue:    {}'.format(job[u'queue']))
+        print(u'Status:   {}'.format(job[u'status']))
+        print(u'Created:  {}'.format(job[u'created']))
+        for label, key in [(u'Enqueued', u'enqueued'),
+                           (u'Started', u'started'), (u'Ended', u'ended'),
+                           (u'Worker', u'worker')]:
+            if job[key]:
+                print(u'{:<10}{}'.format(label + u':', job[key]))
+        if job[u'duration'] is not None:
+            print(u'Duration: {:.3f}s'.format(job[u'duration']))
+        timings = job.get(u'timings')
+        if timings:
+            print(u'Time:     {total_time:.3f}s'.format(**timings))
+            print(u'DB:       {db_queries} queries, {db_time:.3f}s'.format(
+                  **timings))
+            if timings[u'slowest_statement']:
+                print(u'Slowest:  {slowest_statement_time:.3f}s {}'.format(
+                      u' '.join(timings[u'slowest_statement'].split()),
+                      **timings))
+            print(u'HTTP:     {http_requests} requests, {http_time:.3f}s'
+                  .format(**timings))
+        if job[u'exc_info']:
+            print(u'')
+            print(job[u'exc_info'].rstrip())
 
     def cancel(self):
         if not self.args:
             error(u'You must specify a job ID')
-        id = self.args[0]
-        try:
-            p.toolkit.get_action(u'job_cancel')({}, {u'id': id})
-        except p.toolkit.ObjectNotFound:
-            error(u'There is no job with ID "{}"'.format(id))
-        print(u'Cancelled job {}'.format(id))
+        if self.args == [u'-']:
+            ids = [line.strip() for line in sys.stdin if line.strip()]
+        else:
+            ids = self.args
+        if len(ids) == 1 and self.args != [u'-']:
+            id = ids[0]
+            try:
+                p.toolkit.get_action(u'job_cancel')({}, {u'id': id})
+            except p.toolkit.ObjectNotFound:
+                error(u'There is no job with ID "{}"'.format(id))
+            print(u'Cancelled job {}'.format(id))
+            return
+        cancelled = p.toolkit.get_action(u'job_cancel')({}, {u'ids': ids})
+        print(u'Cancelled {} of {} job(s)'.format(len(cancelled), len(ids)))
 
     def clear(self):
         data_dict = {
             u'queues': self.args,
         }
+        filters = {
+            u'title': self.options.title,
+            u'function': self.options.function,
+            u'min_age': self.options.min_age,
+            u'arg': self.options.arg,
+        }
+        data_dict.update((k, v) for k, v in filters.items() if v is not None)
         queues = p.toolkit.get_action(u'job_clear')({}, data_dict)
         queues = (u'"{}"'.format(q) for q in queues)
-        print(u'Cleared queue(s) {}'.format(u', '.join(queues)))
+        if len(data_dict) > 1:
+            print(u'Cancelled matching jobs from queue(s) {}'.format(
+                  u', '.join(queues)))
+        else:
+            print(u'Cleared queue(s) {}'.format(u', '.join(queues)))
+
+    def failed(self):
+        subcmd = u'list'
+        if self.args and self.args[0] in (u'list', u'requeue'):
+            subcmd = self.args.pop(0)
+        filters = {
+            u'function': self.options.function,
+            u'exc_type': self.options.exc_type,
+        }
+        filters = dict((k, v) for k, v in filters.items() if v)
+        if subcmd == u'list':
+            data_dict = dict(filters, queues=self.args,
+                             offset=self.options.offset)
+            if self.options.limit is not None:
+                data_dict[u'limit'] = self.options.limit
+            jobs = p.toolkit.get_action(u'job_failed_list')({}, data_dict)
+            for job in jobs:
+                if job[u'title'] is None:
+                    job[u'title'] = ''
+                else:
+                    job[u'title'] = u'"{}"'.format(job[u'title'])
+                print(u'{ended} {id} {queue} {exc_type} {function} '
+                      u'{title}'.format(**job))
+        else:
+            if self.args:
+                data_dict = {u'ids': self.args}
+            else:
+                # The command requeues all failed jobs if there are no
+                # filters, the action only if that is asked for
+                data_dict = dict(filters, queues=self.options.queues,
+                                 all=True)
+            ids = p.toolkit.get_action(u'job_requeue')({}, data_dict)
+            print(u'Requeued {} failed job(s)'.format(len(ids)))
+
+    def spool(self):
+        from ckanext.rq import spool
+        from ckanext.rq.redis import is_redis_available
+        if not spool.is_enabled():
+            error(u'The spool is disabled, set "{}" to enable it'.format(
+                  spool.SPOOL_PATH_SETTING_NAME))
+        if not self.args:
+            print(u'{} spooled job(s)'.format(spool.pending()))
+        elif self.args[0] == u'replay':
+            if not is_redis_available():
+                error(u'Redis is not available')
+            print(u'Replayed {} spooled job(s)'.format(spool.replay()))
+        else:
+            error(u'Unknown spool command "{}"'.format(self.args[0]))
+
+    def reap(self):
+        from ckanext.rq import jobs, reaper
+        if self.args:
+            queues = [jobs.get_queue(q) for q in self.args]
+        else:
+            queues = jobs.get_all_queues()
+        reaped = reaper.reap(queues)
+        print(u'Reaped {} orphaned job(s)'.format(len(reaped)))
+
+    def gc(self):
+        from ckanext.rq import garbage, memory as memory_
+        result = garbage.collect(dry_run=self.options.dry_run)
+        memory = result[u'memory']
+        if memory is None:
+            memory = u'an unknown amount of memory'
+        else:
+            memory = memory_.format_bytes(memory)
+        print(u'{} {} stale job(s), {} list(s) of dependents, {} stale '
+              u'entries and {} key(s) of other sites, {} {}'.format(
+                  u'Would delete' if self.options.dry_run else u'Deleted',
+                  result[u'jobs'], result[u'dependents'], result[u'entries'],
+                  result[u'keys'],
+                  u'freeing' if self.options.dry_run else u'which used',
+                  memory))
+
+    def memory(self):
+        from ckanext.rq import memory
+        try:
+            report = memory.get_report(
+                self.args,
+                samples=self.options.samples or memory.SAMPLE_SIZE,
+                limit=self.options.limit or 10)
+        except ValueError as e:
+            error(u'{}'.format(e))
+        if self.options.format == u'text':
+            print(u'\n'.join(memory.format_report(report)))
+        else:
+            print(json.dumps(report, indent=2))
+
+    def events(self):
+        from ckanext.rq import events
+        since = parse_datetime(self.options.since)
+        if since is not None:
+            since = events.get_event_id(since)
+        try:
+            for event in events.iter_events(since=since,
+                                            follow=self.options.follow):
+                if self.options.format == u'text':
+                    extra = u' '.join(
+                        u'{}={}'.format(key, event[key])
+                        for key in sorted(event)
+                        if key not in [u'id', u'time', u'event', u'job',
+                                       u'queue'])
+                    print(u'{time} {event:<8} {job} {queue} {extra}'.format(
+                        extra=extra, **event).rstrip())
+                else:
+                    print(json.dumps(event))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+
+    def profile(self):
+        from ckanext.rq import profile
+        if not self.args:
+            error(u'You must specify a job ID')
+        id = self.args[0]
+        stats = profile.load(id)
+        if stats is None:
+            error(u'There is no profile for job "{}"'.format(id))
+        limit = self.options.limit
+        if limit is None:
+            limit = 20
+        try:
+            print(profile.format_summary(stats, limit, self.options.sort))
+        except KeyError:
+            error(u'Unknown sort order "{}"'.format(self.options.sort))
 
     def test(self):
         from ckanext.rq.jobs import DEFAULT_QUEUE_NAME, enqueue, test_job
@@ -154,6 +582,22 @@ class JobsCommand(CkanCommand):
             print(u'Added test job {} to queue "{}"'.format(job.id, queue))
 
 
+def parse_datetime(value):
+    u'''
+    Parse a date or date and time given on the command line.
+
+    :returns: The datetime or ``None`` if no value is given.
+    '''
+    if value is None:
+        return None
+    for format in (u'%Y-%m-%dT%H:%M:%S', u'%Y-%m-%d %H:%M:%S', u'%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    error(u'Invalid date "{}", use YYYY-MM-DD[THH:MM:SS]'.format(value))
+
+
 def error(msg):
     '''
     Print an error message to STDOUT and exit with return code 1.
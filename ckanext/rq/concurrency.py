@@ -0,0 +1,222 @@
+# encoding: utf-8
+
+u'''
+Cluster-wide concurrency limits for queues and job functions.
+
+Some jobs must not run more than a few at a time, no matter how many
+workers there are (for example because they put a heavy load on the
+database). Such limits can be configured per queue and per job function
+(by its fully qualified name)::
+
+    # At most 2 jobs of the queue "datastore" run at the same time
+    ckanext.rq.queue.datastore.max_concurrency = 2
+
+    # At most 1 job of this function runs at the same time
+    ckanext.rq.function.ckanext.example.jobs.load.max_concurrency = 1
+
+A worker that starts a job of a limited queue or function first takes a
+slot for it. Slots are leases in sorted sets in the Redis instance of
+``ckan.redis.url`` (``rq:slots:<queue name>`` and
+``rq:slots:<prefix>function:<name>``, where ``<prefix>`` is the queue
+name prefix of the site), scored by the time at which they expire. They
+are released when the job ends and otherwise expire a minute after the
+job's timeout, so slots of dead workers are not lost.
+
+Workers do not take jobs from queues whose slots are all taken, so
+general workers can listen on limited queues without being blocked by
+them. Jobs of limited functions are only recognized once they have been
+dequeued: if all slots of their function are taken then they are
+scheduled to be tried again after :py:data:`DEFER_DELAY` seconds. Jobs
+of functions with a low limit are therefore best put into a queue of
+their own with the same limit.
+'''
+
+from __future__ import absolute_import
+
+import time
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+from ckanext.rq.redis import connect_to_redis
+
+
+# Seconds after which a job whose function had no free slot is tried
+# again
+DEFER_DELAY = 2
+
+# Seconds by which a slot outlives the timeout of its job
+LEASE_MARGIN = 60
+
+# Maximum number of seconds that a worker whose queues have concurrency
+# limits waits for jobs before checking the slots again
+POLL_INTERVAL = 1
+
+# Take a slot in each of several sorted sets, or in none of them.
+#
+# KEYS: The sorted sets of slots
+# ARGV[1]: The current timestamp
+# ARGV[2]: The timestamp at which the slots expire
+# ARGV[3]: The ID of the job
+# ARGV[4:]: The limit of each sorted set
+#
+# Returns 1 if the slots were taken and 0 otherwise.
+_ACQUIRE_SCRIPT = b'''
+    for i, key in ipairs(KEYS) do
+        redis.call('zremrangebyscore', key, '-inf', ARGV[1])
+        if not redis.call('zscore', key, ARGV[3]) and
+                redis.call('zcard', key) >= tonumber(ARGV[i + 3]) then
+            return 0
+        end
+    end
+    for _, key in ipairs(KEYS) do
+        redis.call('zadd', key, ARGV[2], ARGV[3])
+    end
+    return 1
+'''
+
+
+def get_queue_limit(queue):
+    u'''
+    Get the concurrency limit of a queue.
+
+    :param string queue: The name of the queue (without prefix).
+
+    :returns: The maximum number of jobs of the queue that may run at the
+        same time or ``None`` if there is no limit.
+    :rtype: int
+    '''
+    value = config.get(u'ckanext.rq.queue.{}.max_concurrency'.format(queue))
+    return int(value) if value else None
+
+
+def get_function_limit(function):
+    u'''
+    Get the concurrency limit of a job function.
+
+    :param string function: The fully qualified name of the function.
+
+    :returns: The maximum number of jobs of the function that may run at
+        the same time or ``None`` if there is no limit.
+    :rtype: int
+    '''
+    value = config.get(u'ckanext.rq.function.{}.max_concurrency'.format(
+        function))
+    return int(value) if value else None
+
+
+def get_slots_key(name):
+    u'''
+    Get the key of the slots of a queue or function.
+
+    :param string name: The full name of the queue, or
+        ``<prefix>function:<name>`` for a function.
+    '''
+    return u'rq:slots:{}'.format(name)
+
+
+def get_job_slots(job):
+    u'''
+    Get the slots that a job needs.
+
+    :param rq.job.Job job: The job.
+
+    :returns: Tuples of the key of the sorted set of slots and its limit.
+    :rtype: list
+    '''
+    from ckanext.rq.jobs import add_queue_name_prefix, split_queue_name
+    site_id, queue = split_queue_name(job.origin)
+    slots = []
+    limit = get_queue_limit(queue)
+    if limit is not None:
+        slots.append((get_slots_key(job.origin), limit))
+    limit = get_function_limit(job.func_name)
+    if limit is not None:
+        name = add_queue_name_prefix(u'function:' + job.func_name, site_id)
+        slots.append((get_slots_key(name), limit))
+    return slots
+
+
+def get_queue_limits(queues):
+    u'''
+    Get the concurrency limits of queues.
+
+    :param list queues: ``rq.queue.Queue`` instances.
+
+    :returns: The limits of the queues that have one, by the full names
+        of the queues.
+    :rtype: dict
+    '''
+    from ckanext.rq.jobs import split_queue_name
+    limits = {}
+    for queue in queues:
+        limit = get_queue_limit(split_queue_name(queue.name)[1])
+        if limit is not None:
+            limits[queue.name] = limit
+    return limits
+
+
+def get_full_queues(limits):
+    u'''
+    Find the queues whose slots are all taken.
+
+    :param dict limits: The concurrency limits of the queues by their
+        full names, see :py:func:`get_queue_limits`.
+
+    :returns: The full names of the queues whose slots are all taken.
+    :rtype: set
+    '''
+    if not limits:
+        return set()
+    names = list(limits)
+    now = time.time()
+    with connect_to_redis().pipeline(transaction=False) as pipeline:
+        for name in names:
+            # Expired slots are not counted
+            pipeline.zcount(get_slots_key(name), u'({!r}'.format(now),
+                            u'+inf')
+        counts = pipeline.execute()
+    return set(name for name, count in zip(names, counts)
+               if count >= limits[name])
+
+
+def acquire(job, slots, timeout):
+    u'''
+    Take slots for a job.
+
+    :param rq.job.Job job: The job.
+
+    :param list slots: The slots, see :py:func:`get_job_slots`.
+
+    :param int timeout: The timeout of the job in seconds.
+
+    :returns: Whether the slots could be taken. If not then none of them
+        has been taken.
+    :rtype: bool
+    '''
+    if not slots:
+        return True
+    now = time.time()
+    script = connect_to_redis().register_script(_ACQUIRE_SCRIPT)
+    return bool(script(keys=[key for key, _ in slots],
+                       args=[now, now + timeout + LEASE_MARGIN, job.id] +
+                       [limit for _, limit in slots]))
+
+
+def release(job_id, slots):
+    u'''
+    Release the slots of a job.
+
+    :param string job_id: The ID of the job.
+
+    :param list slots: The slots, see :py:func:`get_job_slots`.
+    '''
+    if not slots:
+        return
+    with connect_to_redis().pipeline() as pipeline:
+        for key, _ in slots:
+            pipeline.zrem(key, job_id)
+        pipeline.execute()
@@ -0,0 +1,84 @@
+# encoding: utf-8
+
+u'''
+Pages of the sysadmin jobs dashboard.
+'''
+
+from __future__ import absolute_import
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.rq import dashboard
+
+# Number of jobs shown per page
+PAGE_SIZE = 50
+
+_JOB_FIELDS = [u'status', u'enqueued', u'started', u'worker']
+
+
+def _get_page():
+    try:
+        return max(1, int(toolkit.request.params.get(u'page', 1)))
+    except ValueError:
+        return 1
+
+
+def _check_access(name, data_dict=None):
+    try:
+        toolkit.check_access(name, {u'user': toolkit.c.user}, data_dict)
+    except toolkit.NotAuthorized:
+        toolkit.abort(403, toolkit._(u'Need to be system administrator '
+                                     u'to administer background jobs'))
+
+
+def _paginate(action, data_dict):
+    u'''
+    Get a page of jobs.
+
+    Fetches one job more than shown to find out whether there is a next
+    page, so that the jobs do not have to be counted.
+    '''
+    page = _get_page()
+    data_dict = dict(data_dict, offset=(page - 1) * PAGE_SIZE,
+                     limit=PAGE_SIZE + 1)
+    items = toolkit.get_action(action)({u'user': toolkit.c.user}, data_dict)
+    return {
+        u'items': items[:PAGE_SIZE],
+        u'page': page,
+        u'has_next': len(items) > PAGE_SIZE,
+    }
+
+
+class JobsController(toolkit.BaseController):
+
+    def dashboard(self):
+        _check_access(u'job_stats')
+        snapshot = dashboard.get_snapshot()
+        peak = max([1] + [max(m[u'enqueued'], m[u'finished'])
+                          for m in snapshot[u'history']])
+        return toolkit.render(u'admin/jobs.html', extra_vars={
+            u'snapshot': snapshot,
+            u'peak': peak,
+        })
+
+    def queue(self, queue):
+        _check_access(u'job_list')
+        filters = {}
+        for key in [u'q', u'function']:
+            value = toolkit.request.params.get(key, u'').strip()
+            if value:
+                filters[key] = value
+        page = _paginate(u'job_list', dict(filters, queues=[queue],
+                                           fields=_JOB_FIELDS))
+        return toolkit.render(u'admin/jobs_queue.html', extra_vars={
+            u'queue': queue,
+            u'filters': filters,
+            u'page': page,
+        })
+
+    def failed(self):
+        _check_access(u'job_failed_list')
+        page = _paginate(u'job_failed_list', {})
+        return toolkit.render(u'admin/jobs_failed.html', extra_vars={
+            u'page': page,
+        })
@@ -0,0 +1,123 @@
+# encoding: utf-8
+
+u'''
+Aggregate statistics for the sysadmin jobs dashboard.
+
+The dashboard at ``/ckan-admin/jobs`` shows the depth and throughput of
+the queues, the workers and the most recent failures. Collecting these
+takes a round trip to each Redis instance and work proportional to the
+number of queues and workers, which is too much to repeat for every page
+view of every sysadmin. The snapshot is therefore built at most once per
+:py:data:`CACHE_TTL_DEFAULT_VALUE` seconds (see the
+``ckanext.rq.dashboard_cache_ttl`` setting) and cached in Redis, so that
+it is shared by all web server processes.
+
+When the cached snapshot is outdated, a single process rebuilds it while
+the others keep serving the outdated one, so that an expired cache does
+not cause a burst of identical rebuilds.
+'''
+
+from __future__ import absolute_import
+
+import json
+import logging
+import time
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+from ckanext.rq import jobs, stats, top
+from ckanext.rq.redis import connect_to_redis
+
+
+log = logging.getLogger(__name__)
+
+CACHE_TTL_DEFAULT_VALUE = 5
+
+# Number of past minutes shown in the throughput graph
+HISTORY_MINUTES = 30
+
+# Outdated snapshots are kept for this many TTLs, so that they can be
+# served while a new one is built
+_STALE_FACTOR = 10
+
+# Maximum time in seconds to wait for another process to build the
+# snapshot when no snapshot is cached at all
+_BUILD_WAIT = 5
+
+
+def _get_cache_ttl():
+    return int(config.get(u'ckanext.rq.dashboard_cache_ttl',
+                          CACHE_TTL_DEFAULT_VALUE))
+
+
+def get_cache_key():
+    u'''
+    Get the key of the cached snapshot of this CKAN instance.
+    '''
+    return u'rq:dashboard:{}'.format(jobs.add_queue_name_prefix(u''))
+
+
+def build_snapshot():
+    u'''
+    Collect the statistics shown on the dashboard.
+
+    :returns: The snapshot of :py:func:`ckanext.rq.top.get_snapshot` with
+        the throughput of all queues for each of the last
+        :py:data:`HISTORY_MINUTES` minutes (``history``, see
+        :py:func:`ckanext.rq.stats.get_history`) and the time at which it
+        was built (``created``, in seconds since the epoch). Timestamps
+        are ISO 8601 strings, so that the snapshot can be serialized as
+        JSON.
+    :rtype: dict
+    '''
+    snapshot = top.get_snapshot()
+    for failure in snapshot[u'failures']:
+        if failure[u'ended'] is not None:
+            failure[u'ended'] = failure[u'ended'].isoformat()
+    snapshot[u'history'] = stats.get_history(jobs.get_all_queues(),
+                                             HISTORY_MINUTES)
+    snapshot[u'created'] = time.time()
+    return snapshot
+
+
+def get_snapshot():
+    u'''
+    Get the (cached) statistics shown on the dashboard.
+
+    :returns: The snapshot, see :py:func:`build_snapshot`. It may be up to
+        ``ckanext.rq.dashboard_cache_ttl`` seconds old, or older while
+        another process builds a new one.
+    :rtype: dict
+    '''
+    ttl = _get_cache_ttl()
+    if ttl <= 0:
+        return build_snapshot()
+    connection = connect_to_redis()
+    key = get_cache_key()
+    lock_key = key + u':lock'
+    deadline = time.time() + _BUILD_WAIT
+    while True:
+        data = connection.get(key)
+        snapshot = json.loads(data.decode(u'utf-8')) if data else None
+        if snapshot is not None and snapshot[u'created'] + ttl > time.time():
+            return snapshot
+        if connection.set(lock_key, 1, ex=_BUILD_WAIT, nx=True):
+            break
+        if snapshot is not None:
+            # Another process is building a new snapshot
+            return snapshot
+        if time.time() >= deadline:
+            log.warning(u'Timeout while waiting for the jobs dashboard '
+                        u'snapshot, building it without the cache')
+            return build_snapshot()
+        time.sleep(0.1)
+    try:
+        snapshot = build_snapshot()
+        connection.set(key, json.dumps(snapshot), ex=ttl * _STALE_FACTOR)
+    finally:
+        connection.delete(lock_key)
+    return snapshot
@@ -0,0 +1,225 @@
+# encoding: utf-8
+
+u'''
+Stream of background job lifecycle events.
+
+Instead of polling ``job_show`` to find out whether a job has finished,
+other services can follow the lifecycle events of the jobs of a CKAN
+site. If ``ckanext.rq.events_max_length`` is set then each job publishes
+an event when it is
+
+* ``enqueued`` (also when it is requeued by the reaper),
+* ``started`` by a worker, with the seconds it has waited in its queue
+  (``wait``) and the name of the worker,
+* ``finished`` successfully, with its run time in seconds (``duration``)
+  or, if it was finished right away with a cached result (see
+  :py:mod:`ckanext.rq.cache`), with ``cached`` set, or
+* ``failed``, with its run time, the name of the exception
+  (``exc_type``) and whether it will be retried (``retry``).
+
+The events are appended to the Redis Stream ``rq:events:<prefix>stream``
+(``<prefix>`` is the queue name prefix of the site), which is capped at
+about ``events_max_length`` events. Events are added in the same round
+trip as the change of the job that they describe, where possible. On a
+sharded setup (see :py:mod:`ckanext.rq.shards`) each shard has its own
+stream for its jobs. Streams need Redis 5.0 or later.
+
+Events can be read via :py:func:`iter_events` or ``paster jobs events``.
+'''
+
+from __future__ import absolute_import
+
+import calendar
+import datetime
+import time
+
+from rq.compat import as_text
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+from ckanext.rq import shards
+
+
+ENQUEUED = u'enqueued'
+STARTED = u'started'
+FINISHED = u'finished'
+FAILED = u'failed'
+
+# Maximum number of events that are read per round trip
+READ_COUNT = 1000
+
+# Seconds for which a follower blocks on a single Redis instance
+BLOCK_TIMEOUT = 5
+
+# Seconds between polls of a follower of several shards
+POLL_INTERVAL = 0.5
+
+# Fields of events that are numbers
+_NUMBER_FIELDS = [u'wait', u'duration']
+
+
+def get_max_length():
+    return int(config.get(u'ckanext.rq.events_max_length', 0))
+
+
+def get_stream_key(prefix):
+    u'''
+    Get the key of the event stream of a CKAN site.
+
+    :param string prefix: The queue name prefix of the CKAN site.
+    '''
+    return u'rq:events:{}stream'.format(prefix)
+
+
+def _get_prefix(origin):
+    return origin[:len(origin) - len(origin.split(u':', 2)[-1])]
+
+
+def publish(pipeline, event, id, origin, **fields):
+    u'''
+    Add the command for publishing an event to a pipeline.
+
+    Does nothing if events are disabled.
+
+    :param pipeline: The Redis pipeline (or connection) of the job's
+        shard.
+
+    :param string event: The type of event, e.g. :py:data:`FINISHED`.
+
+    :param string id: The ID of the job.
+
+    :param string origin: The full name of the job's queue.
+
+    :param fields: Additional fields of the event. Fields whose value is
+        ``None`` are left out, floats are rounded to milliseconds.
+    '''
+    max_length = get_max_length()
+    if max_length <= 0:
+        return
+    values = [u'event', event, u'job', id,
+              u'queue', origin.split(u':', 2)[-1]]
+    for key, value in sorted(fields.items()):
+        if value is None:
+            continue
+        if isinstance(value, float):
+            value = u'{:.3f}'.format(value)
+        values.extend([key, value])
+    # Command names must be native strings, since redis-py does not
+    # encode them and cannot join unicode with the pickled values of the
+    # other commands of a pipeline on Python 2
+    pipeline.execute_command('XADD', get_stream_key(_get_prefix(origin)),
+                             u'MAXLEN', u'~', max_length, u'*', *values)
+
+
+def get_seconds_since(timestamp):
+    u'''
+    Get the seconds since a UTC datetime, e.g. since a job was enqueued.
+
+    :returns: The seconds or ``None`` if no datetime is given.
+    :rtype: float
+    '''
+    if timestamp is None:
+        return None
+    return max(0, time.time() - calendar.timegm(timestamp.utctimetuple()) -
+               timestamp.microsecond / 1e6)
+
+
+def get_event_id(timestamp):
+    u'''
+    Get an event ID for reading the events from a certain time on.
+
+    :param datetime.datetime timestamp: The time (UTC).
+
+    :returns: An ID that is just before all events at or after the time.
+    :rtype: string
+    '''
+    ms = calendar.timegm(timestamp.utctimetuple()) * 1000 + (
+        timestamp.microsecond // 1000)
+    # IDs are exclusive when reading, so use the last possible ID of the
+    # previous millisecond
+    return u'{}-18446744073709551615'.format(ms - 1)
+
+
+def _parse_event(id, values):
+    id = as_text(id)
+    values = [as_text(v) for v in values]
+    event = dict(zip(values[::2], values[1::2]))
+    for field in _NUMBER_FIELDS:
+        if field in event:
+            event[field] = float(event[field])
+    event[u'id'] = id
+    timestamp = datetime.datetime.utcfromtimestamp(
+        int(id.split(u'-', 1)[0]) / 1000.0)
+    event[u'time'] = timestamp.isoformat()
+    return event
+
+
+def _read(connection, key, last_id, block=None):
+    u'''
+    Read the events after an ID from a stream.
+
+    :returns: The events, oldest first.
+    :rtype: list
+    '''
+    args = [u'COUNT', READ_COUNT]
+    if block is not None:
+        args.extend([u'BLOCK', int(block * 1000)])
+    reply = connection.execute_command('XREAD', *(args + [
+        u'STREAMS', key, last_id]))
+    if not reply:
+        return []
+    return [_parse_event(id, values) for id, values in reply[0][1]]
+
+
+def _get_last_id(connection, key):
+    entries = connection.execute_command('XREVRANGE', key, u'+', u'-',
+                                         u'COUNT', 1)
+    return as_text(entries[0][0]) if entries else u'0-0'
+
+
+def iter_events(since=None, follow=False):
+    u'''
+    Read the lifecycle events of the jobs of this CKAN site.
+
+    :param string since: Only return events after the event with this ID
+        (see also :py:func:`get_event_id`). If not given then all retained
+        events are returned or, if ``follow`` is true, only new events.
+
+    :param bool follow: Whether to wait for new events instead of
+        stopping after the last retained event.
+
+    :returns: The events as dicts with the fields described above, the
+        event's ``id`` and its ``time`` (UTC). Events of different shards
+        are not necessarily in order.
+    :rtype: generator of dicts
+    '''
+    from ckanext.rq import jobs
+    key = get_stream_key(jobs.add_queue_name_prefix(u''))
+    connections = shards.connect_to_all_shards()
+    if since is not None:
+        last_ids = [since] * len(connections)
+    elif follow:
+        last_ids = [_get_last_id(c, key) for c in connections]
+    else:
+        last_ids = [u'0-0'] * len(connections)
+    block = None
+    if follow and len(connections) == 1:
+        block = BLOCK_TIMEOUT
+    while True:
+        found = False
+        for i, connection in enumerate(connections):
+            events = _read(connection, key, last_ids[i], block)
+            if events:
+                found = True
+                last_ids[i] = events[-1][u'id']
+            for event in events:
+                yield event
+        if not found:
+            if not follow:
+                return
+            if block is None:
+                time.sleep(POLL_INTERVAL)
@@ -0,0 +1,268 @@
+# encoding: utf-8
+
+u'''
+Management of failed background jobs.
+
+RQ moves jobs that raised an exception to a single, global failed queue
+that is shared by all CKAN instances using the same Redis database. The
+functions in this module only consider failed jobs that originate from
+queues of this CKAN instance.
+
+Failed jobs are read in pages with one pipelined round trip per page,
+and requeued by a server-side script that passes over the failed queue
+only once, so that even very large numbers of failed jobs can be
+inspected and retried quickly.
+
+On a sharded setup (see :py:mod:`ckanext.rq.shards`) each shard has its
+own failed queue.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import uuid
+
+from rq.compat import as_text
+from rq.job import Job, unpickle
+from rq.queue import get_failed_queue as _get_failed_queue
+from rq.utils import utcformat, utcnow, utcparse
+
+from ckanext.rq import index, jobs, shards
+
+
+log = logging.getLogger(__name__)
+
+# Number of failed jobs that are fetched per round trip
+PAGE_SIZE = 1000
+
+# Number of IDs of failed jobs that are sent to Redis per round trip
+REQUEUE_BATCH_SIZE = 5000
+
+# Seconds after which the set of IDs of a requeue expires, in case the
+# requeue is interrupted
+_REQUEUE_KEY_TTL = 600
+
+_FIELDS = [u'origin', u'description', u'created_at', u'ended_at',
+           u'exc_info', u'meta']
+
+# Requeue failed jobs of a CKAN instance.
+#
+# KEYS[1]: The failed queue
+# KEYS[2]: A set of the IDs of the jobs to requeue
+# ARGV[1]: The queue name prefix of the CKAN instance
+# ARGV[2]: The current time (used as the new enqueue time)
+#
+# The failed queue is rebuilt without the requeued jobs in a single pass
+# instead of calling LREM (which is O(N)) once per job. Jobs are
+# requeued in the order in which they failed.
+_REQUEUE_SCRIPT = b'''
+    local failed_key = KEYS[1]
+    local prefix = ARGV[1]
+    local now = ARGV[2]
+    local items = redis.call('lrange', failed_key, 0, -1)
+    local kept = {}
+    local found = {}
+    local origins = {}
+    for _, id in ipairs(items) do
+        local origin = origins[id]
+        if origin == nil then
+            origin = false
+            if redis.call('sismember', KEYS[2], id) == 1 then
+                local value = redis.call('hget', 'rq:job:' .. id, 'origin')
+                if value and string.sub(value, 1, #prefix) == prefix then
+                    origin = value
+                end
+            end
+            origins[id] = origin
+        end
+        if origin then
+            table.insert(found, id)
+        else
+            table.insert(kept, id)
+        end
+    end
+    if #found == 0 then
+        return {}
+    end
+    redis.call('del', failed_key)
+    for i = 1, #kept, 1000 do
+        redis.call('rpush', failed_key,
+                   unpack(kept, i, math.min(i + 999, #kept)))
+    end
+    local requeued = {}
+    for _, id in ipairs(found) do
+        local origin = origins[id]
+        if origin then
+            local job_key = 'rq:job:' .. id
+            local queue_key = 'rq:queue:' .. origin
+            redis.call('hmset', job_key, 'status', 'queued',
+                       'enqueued_at', now)
+            redis.call('hdel', job_key, 'exc_info', 'ended_at')
+            redis.call('sadd', 'rq:queues', queue_key)
+            redis.call('rpush', queue_key, id)
+            table.insert(requeued, id)
+            origins[id] = false
+        end
+    end
+    return requeued
+'''
+
+
+def get_failed_queue(connection=None):
+    u'''
+    Get RQ's failed queue.
+
+    :param connection: Redis connection of the shard. If not given then
+        the first shard is used.
+
+    :rtype: ``rq.queue.FailedQueue``
+    '''
+    if connection is None:
+        connection = shards.connect_to_shard(0)
+    return _get_failed_queue(connection=connection)
+
+
+def exc_type_from_exc_info(exc_info):
+    u'''
+    Extract the exception type from a formatted traceback.
+
+    :param string exc_info: The traceback as stored by RQ.
+
+    :returns: The name of the exception type or ``None``.
+    :rtype: string
+    '''
+    if not exc_info:
+        return None
+    lines = exc_info.rstrip().splitlines()
+    # The exception line directly follows the last (indented) frame line
+    # of the traceback. Its message may span multiple lines.
+    index = 0
+    for i, line in enumerate(lines):
+        if line.startswith(u' '):
+            index = i + 1
+    if index >= len(lines):
+        return None
+    return lines[index].split(u':', 1)[0].strip() or None
+
+
+def matches_name(value, wanted):
+    u'''
+    Check whether a dotted name matches a (possibly unqualified) name.
+    '''
+    if value is None:
+        return False
+    return value == wanted or value.endswith(u'.' + wanted)
+
+
+def _dictize_failed_job(id, obj):
+    u'''
+    Convert the raw hash of a failed job to a dict.
+    '''
+    origin = as_text(obj[u'origin'])
+    description = as_text(obj[u'description']) or u''
+    meta = unpickle(obj[u'meta']) if obj[u'meta'] else {}
+    ended_at = as_text(obj[u'ended_at'])
+    if ended_at:
+        ended_at = utcparse(ended_at).strftime(u'%Y-%m-%dT%H:%M:%S')
+    return {
+        u'id': id,
+        u'title': meta.get(u'title'),
+        u'created': utcparse(as_text(obj[u'created_at'])).strftime(
+            u'%Y-%m-%dT%H:%M:%S'),
+        u'ended': ended_at,
+        u'queue': jobs.remove_queue_name_prefix(origin),
+        u'function': description.split(u'(', 1)[0],
+        u'exc_type': exc_type_from_exc_info(as_text(obj[u'exc_info'])),
+    }
+
+
+def iter_failed_jobs(queues=None, function=None, exc_type=None):
+    u'''
+    Iterate over the failed jobs of this CKAN instance.
+
+    Jobs are returned in the order in which they failed (shard by
+    shard). They are read from Redis in pages of :py:data:`PAGE_SIZE`
+    jobs.
+
+    :param list queues: Only return jobs from these queues.
+
+    :param string function: Only return jobs of this function. Can be
+        the fully qualified name or just the function name.
+
+    :param string exc_type: Only return jobs that failed with this
+        exception type. Can be the fully qualified name or just the
+        class name.
+
+    :returns: The dictized failed jobs.
+    :rtype: generator of dicts
+    '''
+    prefix = jobs.add_queue_name_prefix(u'')
+    if queues:
+        queues = set(jobs.add_queue_name_prefix(q) for q in queues)
+    for redis_conn in shards.connect_to_all_shards():
+        failed_key = get_failed_queue(redis_conn).key
+        start = 0
+        while True:
+            ids = [as_text(id) for id in redis_conn.lrange(
+                   failed_key, start, start + PAGE_SIZE - 1)]
+            if not ids:
+                break
+            start += len(ids)
+            with redis_conn.pipeline(transaction=False) as pipeline:
+                for id in ids:
+                    pipeline.hmget(Job.key_for(id), _FIELDS)
+                values = pipeline.execute()
+            for id, value in zip(ids, values):
+                obj = dict(zip(_FIELDS, value))
+                origin = as_text(obj[u'origin'])
+                if not origin or not origin.startswith(prefix):
+                    continue
+                if queues and origin not in queues:
+                    continue
+                job = _dictize_failed_job(id, obj)
+                if function and not matches_name(job[u'function'], function):
+                    continue
+                if exc_type and not matches_name(job[u'exc_type'], exc_type):
+                    continue
+                yield job
+
+
+def requeue_failed_jobs(ids):
+    u'''
+    Requeue failed jobs.
+
+    Each job is moved from the failed queue back to the queue it
+    originally came from. IDs of jobs that are not failed jobs of this
+    CKAN instance are ignored.
+
+    :param list ids: The IDs of the jobs.
+
+    :returns: The IDs of the requeued jobs.
+    :rtype: list
+    '''
+    prefix = jobs.add_queue_name_prefix(u'')
+    by_shard = {}
+    for id in ids:
+        by_shard.setdefault(shards.get_job_shard(id), []).append(id)
+    requeued = []
+    for shard, shard_ids in sorted(by_shard.items()):
+        redis_conn = shards.connect_to_shard(shard)
+        script = redis_conn.register_script(_REQUEUE_SCRIPT)
+        failed_key = get_failed_queue(redis_conn).key
+        ids_key = u'rq:requeue:{}'.format(uuid.uuid4())
+        try:
+            with redis_conn.pipeline() as pipeline:
+                for i in range(0, len(shard_ids), REQUEUE_BATCH_SIZE):
+                    pipeline.sadd(ids_key,
+                                  *shard_ids[i:i + REQUEUE_BATCH_SIZE])
+                    pipeline.expire(ids_key, _REQUEUE_KEY_TTL)
+                    pipeline.execute()
+            result = [as_text(id) for id in script(
+                keys=[failed_key, ids_key],
+                args=[prefix, utcformat(utcnow())])]
+        finally:
+            redis_conn.delete(ids_key)
+        index.index_jobs(result, redis_conn)
+        requeued.extend(result)
+    log.info(u'Requeued {} failed background job(s)'.format(len(requeued)))
+    return requeued
@@ -0,0 +1,822 @@
+# encoding: utf-8
+
+u'''
+Incremental garbage collection of stale job data.
+
+Most job data in Redis expires by itself, but some of it can be left
+behind for good: hashes of jobs that have been removed from their queue
+without being deleted, lists of dependents of jobs that no longer exist,
+registry and index entries of deleted jobs, members of the sets of
+queues and workers whose keys are gone, and the data of CKAN sites that
+have been decommissioned. Over months of uptime these add up.
+
+The garbage collector walks the keys of each Redis instance with
+``SCAN``. The scan's cursor (and the position in registries, indexes and
+the failed queue, which can be long) is kept in Redis, so that each run
+can be limited to a time budget and the next run continues where the
+previous one stopped. A job is stale if its hash has no TTL, it was
+created more than ``ckanext.rq.gc_min_age`` seconds ago and it is not
+referenced by the queue, registry or failed queue that its status
+implies. Each batch of jobs is checked and deleted atomically by a
+server-side script, other stale data is deleted in pipelined batches.
+
+Queues can be long, so jobs that are queued or failed are not looked for
+in their queue right away. They are suspected instead, and each queue
+with suspected jobs is then walked in pages (whose position is kept in
+Redis, too). Suspected jobs that a complete walk which started after
+they were suspected has not found are deleted::
+
+    # How often (in seconds) one of the workers collects garbage. 0 (the
+    # default) disables garbage collection in workers.
+    ckanext.rq.gc_interval = 3600
+
+    # Maximum duration of a garbage collection run of a worker in seconds
+    ckanext.rq.gc_time_budget = 1
+
+    # Jobs created less than this number of seconds ago are never
+    # collected. Defaults to one day.
+    ckanext.rq.gc_min_age = 86400
+
+    # IDs of the CKAN sites whose data is kept. If set, the data of all
+    # other sites in the same Redis instance is collected, otherwise only
+    # the data of this site is examined.
+    ckanext.rq.gc_sites = default other-site
+
+Garbage can also be collected via ``paster jobs gc``, which with
+``--dry-run`` reports what would be deleted and how much memory that
+would free.
+'''
+
+from __future__ import absolute_import
+
+import datetime
+import logging
+import time
+
+from redis.exceptions import ResponseError
+from rq.compat import as_text
+from rq.job import Job
+from rq.queue import Queue
+from rq.utils import utcformat, utcnow
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+from ckanext.rq import prefetch, shards
+from ckanext.rq.redis import connect_to_redis
+
+
+log = logging.getLogger(__name__)
+
+GC_INTERVAL_DEFAULT_VALUE = 0
+
+TIME_BUDGET_DEFAULT_VALUE = 1
+
+MIN_AGE_DEFAULT_VALUE = 86400
+
+# Number of keys that are requested per SCAN
+SCAN_COUNT = 1000
+
+# Number of registry entries that are checked per round trip
+PAGE_SIZE = 1000
+
+# Sorted sets whose members are job IDs, by the type in their key
+_REGISTRY_TYPES = [u'wip', u'finished', u'deferred', u'delayed', u'index']
+
+# Number of list entries that are walked per round trip when looking for
+# suspected jobs
+WALK_PAGE_SIZE = 1000
+
+# Compute the memory used by the stale jobs in the table ``stale`` and
+# their dependents (-1 if Redis cannot tell) and delete them if
+# ``delete`` is true. Shared by the scripts below.
+_DELETE_STALE = b'''
+    local memory = 0
+    for _, id in ipairs(stale) do
+        for _, key in ipairs({'rq:job:' .. id,
+                              'rq:job:' .. id .. ':dependents'}) do
+            if memory >= 0 and redis.call('exists', key) == 1 then
+                local ok, usage = pcall(redis.call, 'memory', 'usage', key)
+                if ok then
+                    memory = memory + usage
+                else
+                    memory = -1
+                end
+            end
+        end
+    end
+    if delete then
+        for _, id in ipairs(stale) do
+            redis.call('del', 'rq:job:' .. id,
+                       'rq:job:' .. id .. ':dependents')
+        end
+    end
+'''
+
+# Read the IDs of all prefetched jobs into the table ``prefetched``. The
+# set of workers with prefetched jobs is in KEYS[1].
+_IS_PREFETCHED = b'''
+    local prefetched = {}
+    for _, worker in ipairs(redis.call('smembers', KEYS[1])) do
+        local ids = redis.call('lrange', 'rq:prefetch:' .. worker, 0, -1)
+        for _, id in ipairs(ids) do
+            prefetched[id] = true
+        end
+    end
+'''
+
+# Find (and delete) stale jobs.
+#
+# KEYS[1]: The set of workers with prefetched jobs
+# KEYS[2]: The state of the walk through the lists (a hash)
+# KEYS[3]: The set of lists with suspected jobs
+# ARGV[1]: '1' to delete the stale jobs, '0' to only find them
+# ARGV[2]: Only jobs created before this time (in RQ's format) are stale
+# ARGV[3]: '1' if the jobs of CKAN sites that are not examined are stale,
+#          '0' if they are ignored
+# ARGV[4]: The prefix of the hashes of suspected jobs of each list
+# ARGV[5]: The number n of examined sites
+# ARGV[6:5 + n]: The queue name prefixes of the examined sites
+# ARGV[6 + n:]: The IDs of the jobs to check
+#
+# Jobs that are queued or failed would have to be looked for in their
+# queue, which can be long. Instead they are only suspected here: unless
+# ARGV[1] is '0' they are added to the hash of suspected jobs of their
+# list, together with the number of the current walk, and
+# ``_WALK_SCRIPT`` looks for them later. Queued jobs that a worker has
+# prefetched (see ``ckanext.rq.prefetch``) are not stale.
+#
+# Returns the IDs of the stale jobs, the memory used by them and their
+# dependents in bytes (-1 if Redis cannot tell) and pairs of ID and list
+# of the suspected jobs.
+_COLLECT_SCRIPT = b'''
+    local delete = ARGV[1] == '1'
+    local limit = ARGV[2]
+    local others = ARGV[3] == '1'
+    local n = tonumber(ARGV[5])
+    local prefixes = {}
+    for i = 6, 5 + n do
+        table.insert(prefixes, ARGV[i])
+    end
+    local function is_examined(origin)
+        for _, prefix in ipairs(prefixes) do
+            if string.sub(origin, 1, #prefix) == prefix then
+                return true
+            end
+        end
+        return false
+    end
+''' + _IS_PREFETCHED + b'''
+    local registries = {started = 'rq:wip:', scheduled = 'rq:delayed:',
+                        deferred = 'rq:deferred:',
+                        finished = 'rq:finished:'}
+    local walk = redis.call('hget', KEYS[2], 'walk') or '0'
+    local stale = {}
+    local suspected = {}
+    for i = 6 + n, #ARGV do
+        local id = ARGV[i]
+        local key = 'rq:job:' .. id
+        if redis.call('ttl', key) == -1 then
+            local v = redis.call('hmget', key, 'origin', 'status',
+                                 'created_at')
+            local origin, status, created = v[1], v[2], v[3]
+            if not origin then
+                -- Remains of a deleted job
+                table.insert(stale, id)
+            elseif not is_examined(origin) then
+                if others and string.sub(origin, 1, 5) == 'ckan:' then
+                    table.insert(stale, id)
+                end
+            elseif created and created < limit then
+                local list
+                if status == 'queued' then
+                    if not prefetched[id] then
+                        list = 'rq:queue:' .. origin
+                    end
+                elseif status == 'failed' then
+                    list = 'rq:queue:failed'
+                elseif registries[status] then
+                    if not redis.call('zscore', registries[status] .. origin,
+                                      id) then
+                        table.insert(stale, id)
+                    end
+                else
+                    table.insert(stale, id)
+                end
+                if list then
+                    if delete then
+                        redis.call('hsetnx', ARGV[4] .. list, id, walk)
+                        redis.call('sadd', KEYS[3], list)
+                    end
+                    table.insert(suspected, id)
+                    table.insert(suspected, list)
+                end
+            end
+        end
+    end
+''' + _DELETE_STALE + b'''
+    return {stale, memory, suspected}
+'''
+
+# Walk one page of a list with suspected jobs.
+#
+# KEYS[1]: The state of the walk (a hash)
+# KEYS[2]: The hash of suspected jobs of the list
+# KEYS[3]: The list
+# ARGV[1]: The number of entries per page
+#
+# Suspected jobs that are found in the list are no longer suspected. The
+# walk goes from the tail of the list towards its head: workers pop jobs
+# from the head and new jobs are pushed onto the tail, neither of which
+# moves the entries that have not been walked yet. The entry at which the
+# previous page stopped (the anchor) is looked for near its old position
+# in case entries behind it have been removed. If it is not found then
+# the walk starts over at the tail, which is slower but never skips an
+# entry.
+#
+# Returns 1 if the walk has reached the head of the list, 0 otherwise.
+_WALK_SCRIPT = b'''
+    local size = tonumber(ARGV[1])
+    local offset = tonumber(redis.call('hget', KEYS[1], 'offset') or '0')
+    local anchor = redis.call('hget', KEYS[1], 'anchor')
+    if anchor then
+        local last = math.min(size - offset, -1)
+        local ids = redis.call('lrange', KEYS[3], -(offset + size), last)
+        offset = 0
+        for i = #ids, 1, -1 do
+            if ids[i] == anchor then
+                offset = #ids - i - last
+                break
+            end
+        end
+    end
+    local ids = redis.call('lrange', KEYS[3], -(offset + size),
+                           -(offset + 1))
+    for _, id in ipairs(ids) do
+        redis.call('hdel', KEYS[2], id)
+    end
+    if #ids < size then
+        return 1
+    end
+    redis.call('hmset', KEYS[1], 'offset', offset + #ids, 'anchor', ids[1])
+    return 0
+'''
+
+# Delete the suspected jobs of a list that a complete walk has not found.
+#
+# KEYS[1]: The set of workers with prefetched jobs
+# KEYS[2]: The hash of suspected jobs of the list
+# ARGV[1]: Only jobs created before this time (in RQ's format) are stale
+# ARGV[2]: The number of the walk
+# ARGV[3]: The list
+# ARGV[4]: The number of entries at the head and tail of the list that
+#          are checked again
+# ARGV[5:]: The IDs of suspected jobs
+#
+# Only jobs that were suspected before the walk started are judged. They
+# are stale if their status still puts them into the list and they have
+# not been added to its head or tail since the walk passed there.
+#
+# Returns the IDs of the stale jobs and the memory used by them and their
+# dependents in bytes (-1 if Redis cannot tell).
+_JUDGE_SCRIPT = b'''
+    local delete = true
+''' + _IS_PREFETCHED + b'''
+    local size = tonumber(ARGV[4])
+    local ends = {}
+    for _, range in ipairs({{0, size - 1}, {-size, -1}}) do
+        for _, id in ipairs(redis.call('lrange', ARGV[3], range[1],
+                                       range[2])) do
+            ends[id] = true
+        end
+    end
+    local stale = {}
+    for i = 5, #ARGV do
+        local id = ARGV[i]
+        local walk = redis.call('hget', KEYS[2], id)
+        if walk and tonumber(walk) < tonumber(ARGV[2]) then
+            redis.call('hdel', KEYS[2], id)
+            local key = 'rq:job:' .. id
+            local v = redis.call('hmget', key, 'origin', 'status',
+                                 'created_at')
+            local list
+            if v[2] == 'queued' and v[1] and not prefetched[id] then
+                list = 'rq:queue:' .. v[1]
+            elseif v[2] == 'failed' then
+                list = 'rq:queue:failed'
+            end
+            if list == ARGV[3] and not ends[id] and v[3] and
+                    v[3] < ARGV[1] and redis.call('ttl', key) == -1 then
+                table.insert(stale, id)
+            end
+        end
+    end
+''' + _DELETE_STALE + b'''
+    return {stale, memory}
+'''
+
+# Finish the walk of a list.
+#
+# KEYS[1]: The state of the walk (a hash)
+# KEYS[2]: The hash of suspected jobs of the list
+# KEYS[3]: The set of lists with suspected jobs
+# ARGV[1]: The list
+_FINISH_SCRIPT = b'''
+    redis.call('hdel', KEYS[1], 'list', 'offset', 'anchor')
+    if redis.call('exists', KEYS[2]) == 0 then
+        redis.call('srem', KEYS[3], ARGV[1])
+    end
+'''
+
+
+# Remove queues from the set of queues.
+#
+# KEYS[1]: The set of queues
+# ARGV[1]: '1' to remove the queues, '0' to only count them
+# ARGV[2]: The number n of queues that are removed in any case
+# ARGV[3:2 + n]: The keys of these queues
+# ARGV[3 + n:]: The keys of queues that are removed if they are empty
+#              and have no jobs in progress or delayed
+#
+# The queues are checked in the same script that removes them, so a
+# queue that a job is pushed onto meanwhile is never removed.
+#
+# Returns the number of removed queues.
+_QUEUE_SET_SCRIPT = b'''
+    local remove = ARGV[1] == '1'
+    local n = tonumber(ARGV[2])
+    local count = 0
+    for i = 3, #ARGV do
+        local key = ARGV[i]
+        local name = string.sub(key, #'rq:queue:' + 1)
+        if i < 3 + n or (redis.call('exists', key) == 0 and
+                redis.call('exists', 'rq:wip:' .. name) == 0 and
+                redis.call('exists', 'rq:delayed:' .. name) == 0) then
+            if remove then
+                count = count + redis.call('srem', KEYS[1], key)
+            else
+                count = count + redis.call('sismember', KEYS[1], key)
+            end
+        end
+    end
+    return count
+'''
+
+
+def get_gc_interval():
+    return int(config.get(u'ckanext.rq.gc_interval',
+                          GC_INTERVAL_DEFAULT_VALUE))
+
+
+def get_time_budget():
+    return float(config.get(u'ckanext.rq.gc_time_budget',
+                            TIME_BUDGET_DEFAULT_VALUE))
+
+
+def get_min_age():
+    return int(config.get(u'ckanext.rq.gc_min_age', MIN_AGE_DEFAULT_VALUE))
+
+
+def get_kept_sites():
+    u'''
+    Get the IDs of the CKAN sites whose data is kept.
+
+    :returns: The site IDs from ``ckanext.rq.gc_sites``, or ``None`` if
+        that setting is not set (in which case only the data of this site
+        is examined).
+    :rtype: list
+    '''
+    sites = config.get(u'ckanext.rq.gc_sites', u'').split()
+    return sites or None
+
+
+def get_state_key(name):
+    u'''
+    Get the key of the garbage collector's state for this CKAN site.
+
+    :param string name: The name of the state, e.g. ``cursor``.
+    '''
+    from ckanext.rq import jobs
+    return u'rq:gc:{}{}'.format(jobs.add_queue_name_prefix(u''), name)
+
+
+def get_suspects_key(list_key):
+    u'''
+    Get the key of the hash of suspected stale jobs of a list.
+
+    :param string list_key: The key of the queue or the failed queue.
+    '''
+    return get_state_key(u'suspects:' + list_key)
+
+
+def _get_memory(connection, keys):
+    u'''
+    Get the memory used by keys in bytes, or ``None`` if Redis cannot
+    tell (it needs Redis 4.0 or later).
+    '''
+    if not keys:
+        return 0
+    try:
+        with connection.pipeline(transaction=False) as pipeline:
+            for key in keys:
+                pipeline.execute_command(u'MEMORY', u'USAGE', key)
+            return sum(usage or 0 for usage in pipeline.execute())
+    except ResponseError:
+        return None
+
+
+class _Collection(object):
+    u'''
+    A garbage collection run on a single Redis instance.
+    '''
+    def __init__(self, connection, dry_run, result):
+        from ckanext.rq import jobs
+        self.connection = connection
+        self.dry_run = dry_run
+        self.result = result
+        kept = get_kept_sites()
+        self.others = kept is not None
+        if kept is None:
+            self.prefixes = [jobs.add_queue_name_prefix(u'')]
+        else:
+            self.prefixes = [jobs.add_queue_name_prefix(u'', site)
+                             for site in kept]
+        min_age = datetime.timedelta(seconds=get_min_age())
+        self.limit = utcformat(utcnow() - min_age)
+        self.script = connection.register_script(_COLLECT_SCRIPT)
+        self.walk_script = connection.register_script(_WALK_SCRIPT)
+        self.judge_script = connection.register_script(_JUDGE_SCRIPT)
+        self.finish_script = connection.register_script(_FINISH_SCRIPT)
+        self.walk_key = get_state_key(u'walk')
+        self.lists_key = get_state_key(u'lists')
+        # Suspected jobs by list in a dry run, see ``collect_jobs``
+        self.suspected = {}
+        self.deadline = None
+
+    def is_overdue(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def add_memory(self, memory):
+        if memory is None or self.result[u'memory'] is None:
+            self.result[u'memory'] = None
+        else:
+            self.result[u'memory'] += memory
+
+    def get_state(self, name):
+        u'''
+        Tell whether a prefixed name (e.g. a queue name) belongs to an
+        examined site (``True``), to a site whose data is stale
+        (``False``) or to neither (``None``).
+        '''
+        if any(name.startswith(prefix) for prefix in self.prefixes):
+            return True
+        if self.others and name.startswith(u'ckan:'):
+            return False
+        return None
+
+    def delete(self, keys):
+        u'''
+        Delete whole keys.
+        '''
+        if not keys:
+            return
+        self.add_memory(_get_memory(self.connection, keys))
+        if not self.dry_run:
+            self.connection.delete(*keys)
+
+    def collect_jobs(self, ids):
+        if not ids:
+            return
+        args = [u'0' if self.dry_run else u'1', self.limit,
+                u'1' if self.others else u'0', get_suspects_key(u''),
+                len(self.prefixes)]
+        stale, memory, suspected = self.script(
+            keys=[prefetch.WORKERS_KEY, self.walk_key, self.lists_key],
+            args=args + self.prefixes + ids)
+        self.result[u'jobs'] += len(stale)
+        self.add_memory(None if memory < 0 else memory)
+        if self.dry_run:
+            for id, list_key in zip(suspected[::2], suspected[1::2]):
+                self.suspected.setdefault(as_text(list_key), set()).add(
+                    as_text(id))
+
+    def walk_lists(self):
+        u'''
+        Look for suspected jobs in their lists and delete those that are
+        not found.
+
+        The lists are walked one after another, in pages. The walk in
+        progress is kept in Redis, so that the next run continues it if
+        the deadline passes.
+
+        :returns: Whether all lists with suspected jobs have been walked
+            once.
+        '''
+        if self.dry_run:
+            self.estimate_suspected()
+            return True
+        walked = set()
+        while True:
+            list_key, walk = self.connection.hmget(self.walk_key,
+                                                   [u'list', u'walk'])
+            if list_key is None:
+                pending = set(as_text(key) for key in self.connection.smembers(
+                              self.lists_key)) - walked
+                if not pending:
+                    return True
+                list_key = min(pending)
+                walk = self.connection.hincrby(self.walk_key, u'walk', 1)
+                self.connection.hset(self.walk_key, u'list', list_key)
+            list_key = as_text(list_key)
+            walked.add(list_key)
+            suspects_key = get_suspects_key(list_key)
+            keys = [self.walk_key, suspects_key, list_key]
+            while True:
+                if self.is_overdue():
+                    return False
+                if self.walk_script(keys=keys, args=[WALK_PAGE_SIZE]):
+                    break
+            args = [self.limit, walk, list_key, WALK_PAGE_SIZE]
+            ids = []
+            for id, _ in self.connection.hscan_iter(suspects_key,
+                                                    count=PAGE_SIZE):
+                ids.append(as_text(id))
+                if len(ids) == PAGE_SIZE:
+                    self.judge(suspects_key, args + ids)
+                    ids = []
+            if ids:
+                self.judge(suspects_key, args + ids)
+            self.finish_script(keys=[self.walk_key, suspects_key,
+                                     self.lists_key], args=[list_key])
+
+    def judge(self, suspects_key, args):
+        stale, memory = self.judge_script(
+            keys=[prefetch.WORKERS_KEY, suspects_key], args=args)
+        self.result[u'jobs'] += len(stale)
+        self.add_memory(None if memory < 0 else memory)
+
+    def estimate_suspected(self):
+        u'''
+        Count the suspected jobs of a dry run that are not in their lists.
+
+        Since the lists are not walked atomically this is an estimate.
+        '''
+        for list_key, ids in sorted(self.suspected.items()):
+            start = 0
+            while ids:
+                entries = self.connection.lrange(list_key, start,
+                                                 start + PAGE_SIZE - 1)
+                if not entries:
+                    break
+                ids.difference_update(as_text(id) for id in entries)
+                start += len(entries)
+            self.result[u'jobs'] += len(ids)
+            keys = [Job.key_for(id) for id in ids]
+            keys += [Job.dependents_key_for(id) for id in ids]
+            self.add_memory(_get_memory(self.connection, keys))
+        self.suspected = {}
+
+    def collect_dependents(self, keys):
+        u'''
+        Delete the lists of dependents of jobs that do not exist.
+        '''
+        if not keys:
+            return
+        with self.connection.pipeline(transaction=False) as pipeline:
+            for key in keys:
+                pipeline.exists(key)
+                pipeline.exists(key[:-len(u':dependents')])
+            exists = pipeline.execute()
+        # The lists of stale jobs have already been deleted with them
+        stale = [key for i, key in enumerate(keys)
+                 if exists[2 * i] and not exists[2 * i + 1]]
+        self.result[u'dependents'] += len(stale)
+        self.delete(stale)
+
+    def prune(self, key, is_list=False):
+        u'''
+        Remove the entries of deleted jobs from a sorted set or from the
+        failed queue.
+
+        If the deadline passes then the position in the key is saved and
+        the next run continues there.
+
+        :param string key: The key of the sorted set or list.
+
+        :param bool is_list: Whether the key is a list.
+
+        :returns: Whether the whole key has been pruned.
+        '''
+        positions_key = get_state_key(u'positions')
+        start = 0
+        if self.deadline is not None:
+            start = int(self.connection.hget(positions_key, key) or 0)
+        read = self.connection.lrange if is_list else self.connection.zrange
+        while True:
+            if self.is_overdue():
+                if not self.dry_run:
+                    self.connection.hset(positions_key, key, start)
+                return False
+            ids = read(key, start, start + PAGE_SIZE - 1)
+            if not ids:
+                break
+            with self.connection.pipeline(transaction=False) as pipeline:
+                for id in ids:
+                    pipeline.exists(Job.key_for(as_text(id)))
+                exists = pipeline.execute()
+            missing = [id for id, e in zip(ids, exists) if not e]
+            self.result[u'entries'] += len(missing)
+            start += len(ids)
+            if missing and not self.dry_run:
+                if is_list:
+                    with self.connection.pipeline(
+                            transaction=False) as pipeline:
+                        for id in missing:
+                            pipeline.lrem(key, id, 1)
+                        pipeline.execute()
+                else:
+                    self.connection.zrem(key, *missing)
+                start -= len(missing)
+        if not self.dry_run:
+            self.connection.hdel(positions_key, key)
+        return True
+
+    def collect_keys(self, keys):
+        u'''
+        Collect the garbage among a batch of keys from ``SCAN``.
+        '''
+        with self.connection.pipeline(transaction=False) as pipeline:
+            for key in keys:
+                pipeline.ttl(key)
+            ttls = pipeline.execute()
+        job_ids = []
+        dependents = []
+        registries = []
+        stale = []
+        for key, ttl in zip(keys, ttls):
+            if ttl is not None and ttl >= 0:
+                # Expires anyway
+                continue
+            parts = key.split(u':', 2)
+            if len(parts) < 3:
+                continue
+            type_, name = parts[1], parts[2]
+            if type_ == u'job':
+                if name.endswith(u':dependents'):
+                    dependents.append(key)
+                else:
+                    job_ids.append(name)
+            elif key == Queue.redis_queue_namespace_prefix + u'failed':
+                self.prune(key, is_list=True)
+            elif type_ in [u'queue', u'gc', u'cache', u'events',
+                           u'slots'] + _REGISTRY_TYPES:
+                state = self.get_state(name)
+                if state is False:
+                    stale.append(key)
+                elif state and type_ in _REGISTRY_TYPES:
+                    registries.append(key)
+        self.collect_jobs(job_ids)
+        self.collect_dependents(dependents)
+        for key in registries:
+            self.prune(key)
+        self.result[u'keys'] += len(stale)
+        self.delete(stale)
+
+    def collect_queue_set(self):
+        u'''
+        Remove queues from the set of queues that are empty or belong to
+        a site whose data is stale.
+        '''
+        keys = sorted(as_text(k) for k in self.connection.smembers(
+                      Queue.redis_queues_keys))
+        prefix = Queue.redis_queue_namespace_prefix
+        candidates = []
+        stale = []
+        for key in keys:
+            state = self.get_state(key[len(prefix):])
+            if state is False:
+                stale.append(key)
+            elif state:
+                candidates.append(key)
+        script = self.connection.register_script(_QUEUE_SET_SCRIPT)
+        removed = script(keys=[Queue.redis_queues_keys],
+                         args=[u'0' if self.dry_run else u'1', len(stale)] +
+                         stale + candidates)
+        self.result[u'entries'] += removed
+
+    def collect_worker_set(self):
+        u'''
+        Remove workers whose key has expired from the set of workers.
+        '''
+        from ckanext.rq import jobs
+        keys = list(self.connection.smembers(jobs.Worker.redis_workers_keys))
+        with self.connection.pipeline(transaction=False) as pipeline:
+            for key in keys:
+                pipeline.exists(key)
+            exists = pipeline.execute()
+        stale = [key for key, e in zip(keys, exists) if not e]
+        self.result[u'entries'] += len(stale)
+        if stale and not self.dry_run:
+            self.connection.srem(jobs.Worker.redis_workers_keys, *stale)
+
+    def run(self, deadline=None):
+        u'''
+        Continue the scan of the keys and the walks of the lists with
+        suspected jobs until they are complete or the deadline has passed.
+
+        :returns: Whether the scan and the walks are complete.
+        '''
+        self.deadline = deadline
+        cursor_key = get_state_key(u'cursor')
+        cursor = 0
+        if not self.walk_lists():
+            return False
+        if deadline is not None:
+            cursor = int(self.connection.get(cursor_key) or 0)
+            # Continue with the keys in which previous runs stopped
+            failed_key = Queue.redis_queue_namespace_prefix + u'failed'
+            for key in sorted(as_text(key) for key in self.connection.hkeys(
+                              get_state_key(u'positions'))):
+                if not self.prune(key, is_list=key == failed_key):
+                    return False
+        while True:
+            cursor, keys = self.connection.scan(cursor, match=u'rq:*',
+                                                count=SCAN_COUNT)
+            cursor = int(cursor)
+            self.collect_keys(sorted(as_text(key) for key in keys))
+            if cursor == 0:
+                break
+            if self.is_overdue():
+                break
+        if deadline is not None and not self.dry_run:
+            self.connection.set(cursor_key, cursor)
+        # Jobs suspected during the scan are looked for right away
+        return self.walk_lists() and cursor == 0
+
+
+def collect(dry_run=False, time_budget=None):
+    u'''
+    Collect stale job data.
+
+    :param bool dry_run: If true then nothing is deleted.
+
+    :param float time_budget: Maximum duration of the run in seconds,
+        which is split evenly between the Redis instances. Each run then
+        continues the scan where the previous one stopped. By default all
+        keys are scanned.
+
+    :returns: The number of stale jobs (``jobs``), lists of dependents
+        (``dependents``), entries of registries, indexes and sets
+        (``entries``) and keys of other sites (``keys``), the memory that
+        these keys and jobs used in bytes (``memory``, ``None`` if Redis
+        cannot tell) and whether all keys have been scanned and all
+        suspected jobs checked (``complete``). In a dry run the registry
+        and index entries of the stale jobs themselves are not counted,
+        since these jobs still exist, and the number of stale queued and
+        failed jobs is an estimate.
+    :rtype: dict
+    '''
+    result = {
+        u'jobs': 0,
+        u'dependents': 0,
+        u'entries': 0,
+        u'keys': 0,
+        u'memory': 0,
+        u'complete': True,
+    }
+    connections = shards.connect_to_all_shards()
+    for connection in connections:
+        collection = _Collection(connection, dry_run, result)
+        deadline = None
+        if time_budget is not None:
+            deadline = time.time() + time_budget / len(connections)
+        if not collection.run(deadline):
+            result[u'complete'] = False
+        collection.collect_queue_set()
+    # Workers are always registered in the main Redis instance
+    _Collection(connect_to_redis(), dry_run, result).collect_worker_set()
+    if not dry_run:
+        log.info(u'Collected {jobs} stale job(s), {dependents} list(s) of '
+                 u'dependents, {entries} stale entries and {keys} key(s) '
+                 u'of other sites'.format(**result))
+    return result
+
+
+def collect_if_due():
+    u'''
+    Collect stale job data if no worker has done so for
+    ``ckanext.rq.gc_interval`` seconds.
+
+    :returns: The result of :py:func:`collect`, or ``None`` if garbage
+        collection is disabled or was not due.
+    '''
+    interval = get_gc_interval()
+    if interval <= 0:
+        return None
+    connection = connect_to_redis()
+    if not connection.set(get_state_key(u'lock'), 1, ex=interval, nx=True):
+        return None
+    return collect(time_budget=get_time_budget())
@@ -0,0 +1,412 @@
+# encoding: utf-8
+
+u'''
+Secondary indexes for searching enqueued background jobs.
+
+Listing the jobs of a queue means reading all of them. To find jobs by
+title, function or creation time without doing that, each waiting job
+(enqueued or scheduled for a retry) is recorded in sorted sets, scored
+by the job's creation time:
+
+* ``rq:index:<prefix>created`` contains all waiting jobs of a CKAN site,
+* ``rq:index:<prefix>function:<name>`` the jobs of a function (both its
+  fully qualified name and its plain name are indexed), and
+* ``rq:index:<prefix>title:<token>`` the jobs whose title contains a word.
+
+``<prefix>`` is the queue name prefix of the site. On a sharded setup
+(see :py:mod:`ckanext.rq.shards`) each shard has its own indexes for the
+jobs it stores.
+
+Jobs are added to the indexes in the pipeline that enqueues them and
+removed in the pipeline in which a worker starts them, so that keeping
+the indexes up to date costs no additional round trips. A search reads
+the smallest matching index (or the intersection of several) page by
+page, which takes O(log n + page) per page. Index entries of jobs that
+have been deleted or are no longer waiting are removed when a search
+encounters them, entries of cancelled jobs and of cleared queues right
+away. Jobs that were enqueued before the indexes existed can be indexed
+via ``paster jobs reindex``.
+'''
+
+from __future__ import absolute_import
+
+import calendar
+import fnmatch
+import heapq
+import re
+import uuid
+
+from rq.compat import as_text
+from rq.job import Job, JobStatus, unpickle
+from rq.utils import utcparse
+
+from ckanext.rq import shards
+
+
+# Number of index entries that are read per round trip
+PAGE_SIZE = 1000
+
+# Lifetime of the temporary intersection of several indexes in seconds
+TEMP_TTL = 60
+
+# Fields of a job's Redis hash that determine its index entries
+INDEX_FIELDS = [u'origin', u'created_at', u'description', u'meta']
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def get_index_key(prefix, name):
+    u'''
+    Get the key of an index.
+
+    :param string prefix: The queue name prefix of the CKAN site.
+
+    :param string name: The name of the index, e.g. ``created`` or
+        ``function:my_function``.
+    '''
+    return u'rq:index:{}{}'.format(prefix, name)
+
+
+def tokenize(title):
+    u'''
+    Split a title into the lower-case words that are indexed.
+
+    :rtype: list
+    '''
+    return sorted(set(t.lower() for t in _TOKEN_RE.findall(title or u'')))
+
+
+def _get_prefix(origin):
+    return origin[:len(origin) - len(origin.split(u':', 2)[-1])]
+
+
+def _get_names(function, title):
+    names = [u'created']
+    if function:
+        names.append(u'function:' + function)
+        short_name = function.rsplit(u'.', 1)[-1]
+        if short_name != function:
+            names.append(u'function:' + short_name)
+    names.extend(u'title:' + token for token in tokenize(title))
+    return names
+
+
+def _get_score(created_at):
+    # Jobs created in the same second are kept in order where the exact
+    # time is known. RQ only stores whole seconds.
+    return (calendar.timegm(created_at.utctimetuple()) +
+            created_at.microsecond / 1e6)
+
+
+def _parse_hash(obj):
+    u'''
+    Extract what determines the index entries of a job from its hash.
+    '''
+    meta = unpickle(obj[u'meta']) if obj.get(u'meta') else {}
+    function = as_text(obj[u'description'] or b'').split(u'(', 1)[0]
+    return (as_text(obj[u'origin']), utcparse(as_text(obj[u'created_at'])),
+            function, meta.get(u'title'))
+
+
+def _add(pipeline, id, origin, created_at, function, title):
+    prefix = _get_prefix(origin)
+    score = _get_score(created_at)
+    for name in _get_names(function, title):
+        pipeline.zadd(get_index_key(prefix, name), **{id: score})
+
+
+def _remove(pipeline, id, origin, function, title):
+    prefix = _get_prefix(origin)
+    for name in _get_names(function, title):
+        pipeline.zrem(get_index_key(prefix, name), id)
+
+
+def add_job(job, pipeline):
+    u'''
+    Add the commands for indexing a job to a pipeline.
+
+    :param rq.job.Job job: The job. Its ``origin`` must be set to the
+        full name of its queue.
+
+    :param pipeline: The Redis pipeline.
+    '''
+    _add(pipeline, job.id, job.origin, job.created_at,
+         (job.description or u'').split(u'(', 1)[0], job.meta.get(u'title'))
+
+
+def remove_job(job, pipeline):
+    u'''
+    Add the commands for removing a job from the indexes to a pipeline.
+
+    :param rq.job.Job job: The job.
+
+    :param pipeline: The Redis pipeline.
+    '''
+    _remove(pipeline, job.id, job.origin,
+            (job.description or u'').split(u'(', 1)[0],
+            job.meta.get(u'title'))
+
+
+def add_job_hash(id, obj, pipeline):
+    u'''
+    Add the commands for indexing a job given by its raw hash.
+
+    :param string id: The ID of the job.
+
+    :param dict obj: The job's hash, at least the
+        :py:data:`INDEX_FIELDS`.
+
+    :param pipeline: The Redis pipeline.
+    '''
+    _add(pipeline, id, *_parse_hash(obj))
+
+
+def remove_job_hash(id, obj, pipeline):
+    u'''
+    Add the commands for removing a job given by its raw hash from the
+    indexes to a pipeline.
+
+    :param string id: The ID of the job.
+
+    :param dict obj: The job's hash, at least the
+        :py:data:`INDEX_FIELDS`.
+
+    :param pipeline: The Redis pipeline.
+    '''
+    origin, _, function, title = _parse_hash(obj)
+    _remove(pipeline, id, origin, function, title)
+
+
+def get_job_hashes(ids, connection):
+    u'''
+    Read what determines the index entries of jobs from Redis.
+
+    :param list ids: The IDs of the jobs.
+
+    :param connection: The Redis connection of the jobs' shard.
+
+    :returns: The :py:data:`INDEX_FIELDS` of the jobs' hashes by the IDs
+        of the jobs. Jobs that do not exist are left out.
+    :rtype: dict
+    '''
+    if not ids:
+        return {}
+    with connection.pipeline(transaction=False) as pipeline:
+        for id in ids:
+            pipeline.hmget(Job.key_for(id), INDEX_FIELDS)
+        values = pipeline.execute()
+    objs = {}
+    for id, value in zip(ids, values):
+        obj = dict(zip(INDEX_FIELDS, value))
+        if obj[u'created_at']:
+            objs[id] = obj
+    return objs
+
+
+def unindex_jobs(ids, connection):
+    u'''
+    Remove jobs that are stored in Redis from the indexes.
+
+    Must be called before the jobs are deleted.
+
+    :param list ids: The IDs of the jobs. IDs of jobs that do not exist
+        are ignored.
+
+    :param connection: The Redis connection of the jobs' shard.
+    '''
+    objs = get_job_hashes(ids, connection)
+    if not objs:
+        return
+    with connection.pipeline() as pipeline:
+        for id, obj in objs.items():
+            remove_job_hash(id, obj, pipeline)
+        pipeline.execute()
+
+
+def unindex_queue(queue):
+    u'''
+    Remove the enqueued jobs of a queue from the indexes, for example
+    before the queue is emptied.
+
+    :param rq.queue.Queue queue: The queue.
+    '''
+    start = 0
+    while True:
+        ids = [as_text(id) for id in queue.connection.lrange(
+               queue.key, start, start + PAGE_SIZE - 1)]
+        if not ids:
+            break
+        unindex_jobs(ids, queue.connection)
+        start += len(ids)
+
+
+def index_jobs(ids, connection):
+    u'''
+    Index jobs that are stored in Redis.
+
+    :param list ids: The IDs of the jobs. IDs of jobs that do not exist
+        are ignored.
+
+    :param connection: The Redis connection of the jobs' shard.
+    '''
+    if not ids:
+        return
+    with connection.pipeline() as pipeline:
+        for id in ids:
+            pipeline.hmget(Job.key_for(id), INDEX_FIELDS)
+        values = pipeline.execute()
+        for id, value in zip(ids, values):
+            obj = dict(zip(INDEX_FIELDS, value))
+            if obj[u'created_at']:
+                add_job_hash(id, obj, pipeline)
+        pipeline.execute()
+
+
+def rebuild(queues=None):
+    u'''
+    Index the jobs that are currently enqueued.
+
+    :param list queues: Names of the queues whose jobs are indexed. If
+        not given then the jobs from all queues are indexed.
+
+    :returns: The number of indexed jobs.
+    :rtype: int
+    '''
+    from ckanext.rq import jobs
+    if queues:
+        queues = [jobs.get_queue(q) for q in queues]
+    else:
+        queues = jobs.get_all_queues()
+    count = 0
+    for queue in queues:
+        start = 0
+        while True:
+            ids = [as_text(id) for id in queue.connection.lrange(
+                   queue.key, start, start + PAGE_SIZE - 1)]
+            if not ids:
+                break
+            start += len(ids)
+            index_jobs(ids, queue.connection)
+            count += len(ids)
+    return count
+
+
+def _search(connection, prefix, names, since, until, queue_names,
+            hash_fields, fields):
+    u'''
+    Search the indexes of a single Redis instance.
+
+    :returns: Tuples of score, ID and dictized job, ordered by score.
+    '''
+    from ckanext.rq import jobs
+    from ckanext.rq.retry import SCHEDULED
+    keys = [get_index_key(prefix, name) for name in names]
+    if len(keys) == 1:
+        source = keys[0]
+    else:
+        source = get_index_key(prefix, u'tmp:{}'.format(uuid.uuid4()))
+        with connection.pipeline() as pipeline:
+            pipeline.zinterstore(source, keys, aggregate=u'MIN')
+            pipeline.expire(source, TEMP_TTL)
+            pipeline.execute()
+    min_score = u'-inf' if since is None else repr(_get_score(since))
+    max_score = u'+inf' if until is None else u'({!r}'.format(
+        _get_score(until))
+    read_fields = hash_fields + [f for f in [u'status', u'description']
+                                 if f not in hash_fields]
+    start = 0
+    try:
+        while True:
+            entries = connection.zrangebyscore(
+                source, min_score, max_score, start=start, num=PAGE_SIZE,
+                withscores=True)
+            if not entries:
+                break
+            start += len(entries)
+            with connection.pipeline(transaction=False) as pipeline:
+                for id, _ in entries:
+                    pipeline.hmget(Job.key_for(as_text(id)), read_fields)
+                values = pipeline.execute()
+            results = []
+            with connection.pipeline() as pipeline:
+                for (id, score), value in zip(entries, values):
+                    id = as_text(id)
+                    obj = dict(zip(read_fields, value))
+                    status = as_text(obj[u'status'] or b'')
+                    if not obj[u'created_at']:
+                        # The job has been deleted
+                        for key in keys:
+                            pipeline.zrem(key, id)
+                    elif status not in (JobStatus.QUEUED, SCHEDULED):
+                        remove_job_hash(id, obj, pipeline)
+                    else:
+                        if status == JobStatus.QUEUED and (
+                                queue_names is None or
+                                as_text(obj[u'origin']) in queue_names):
+                            results.append((score, id, jobs.dictize_job_hash(
+                                id, obj, fields)))
+                        continue
+                    if len(keys) == 1:
+                        # Removing the entry shifts the following ones
+                        start -= 1
+                pipeline.execute()
+            for result in results:
+                yield result
+    finally:
+        if len(keys) > 1:
+            connection.delete(source)
+
+
+def search_jobs(queues=None, q=None, function=None, since=None,
+                until=None, title=None, fields=()):
+    u'''
+    Find enqueued jobs using the indexes.
+
+    :param list queues: Names of the queues to search. If not given then
+        the jobs from all queues are searched.
+
+    :param string q: Only return jobs whose title contains all words of
+        this string (case-insensitive).
+
+    :param string function: Only return jobs of this function. Can be
+        the fully qualified name or just the function name.
+
+    :param datetime.datetime since: Only return jobs that were created
+        at or after this time (UTC).
+
+    :param datetime.datetime until: Only return jobs that were created
+        before this time (UTC).
+
+    :param string title: Only return jobs whose title matches this
+        shell-style pattern (e.g. ``'Harvest*'``). Unlike ``q`` this is
+        not answered from the indexes.
+
+    :param list fields: Optional attributes to include, see
+        :py:func:`ckanext.rq.jobs.dictize_job_hash`.
+
+    :returns: The dictized jobs, ordered by creation time. Jobs that
+        were enqueued before the indexes existed are only found after
+        ``paster jobs reindex``.
+    :rtype: generator of dicts
+    '''
+    from ckanext.rq import jobs
+    prefix = jobs.add_queue_name_prefix(u'')
+    names = [u'created']
+    if function:
+        names = [u'function:' + function]
+    names.extend(u'title:' + token for token in tokenize(q))
+    if len(names) > 1 and names[0] == u'created':
+        names.pop(0)
+    queue_names = None
+    if queues:
+        queue_names = set(jobs.add_queue_name_prefix(q) for q in queues)
+    hash_fields = jobs.get_hash_fields(fields)
+    results = [_search(connection, prefix, names, since, until,
+                       queue_names, hash_fields, fields)
+               for connection in shards.connect_to_all_shards()]
+    for _, _, job in heapq.merge(*results):
+        if title is not None and (
+                job[u'title'] is None or
+                not fnmatch.fnmatchcase(job[u'title'], title)):
+            continue
+        yield job
@@ -20,35 +20,115 @@ prefixed names. Use the functions ``add_queue_name_prefix`` and
 .. versionadded:: 2.7
 '''
 
+from __future__ import absolute_import
+
+import collections
+import fnmatch
+import itertools
 import logging
+import math
+import os
+import resource
+import signal
+import socket
+import sys
+import time
 
 import rq
+from redis.exceptions import ConnectionError as RedisConnectionError
 from rq.connections import push_connection
-from rq.exceptions import NoSuchJobError
-from rq.job import Job
-from rq.utils import ensure_list
+from rq.exceptions import DequeueTimeout, NoSuchJobError
+from rq.compat import as_text
+from rq.job import Job, JobStatus, unpickle
+from rq.queue import get_failed_queue
+from rq.registry import FinishedJobRegistry, StartedJobRegistry
+from rq.utils import (current_timestamp, ensure_list, utcformat, utcnow,
+                      utcparse)
+from rq.worker import (DEFAULT_RESULT_TTL, StopRequested, WorkerStatus,
+                       blue, green)
 
 # HACK
 from ckanext.rq.redis import connect_to_redis
+from ckanext.rq import cache
+from ckanext.rq import concurrency
+from ckanext.rq import events
+from ckanext.rq import garbage
+from ckanext.rq import index
+from ckanext.rq import prefetch
+from ckanext.rq import profile
+from ckanext.rq import reaper
+from ckanext.rq import reloader
+from ckanext.rq import retry as retry_
+from ckanext.rq import shards
+from ckanext.rq import spool
+from ckanext.rq import stats
+from ckanext.rq import timing
 try:
     from ckan.common import config
 except ImportError:
     # older CKAN versions
     from pylons import config
 
-from ckan.config.environment import load_environment
-from ckan.model import meta
-import ckan.plugins as plugins
+# CKAN's environment and model are only imported by the worker code that
+# uses them, so that importing this module (for example just to enqueue a
+# job) stays cheap.
 
 
 log = logging.getLogger(__name__)
 
 DEFAULT_QUEUE_NAME = u'default'
 
+# Seconds between polls of a worker whose queues are in different shards
+SHARD_POLL_INTERVAL = 0.5
+
+# Number of enqueued jobs that are fetched per round trip, see
+# ``iter_jobs``
+PAGE_SIZE = 1000
+
+# Optional attributes of dictized jobs, see ``dictize_job_hash``
+JOB_FIELDS = [u'status', u'enqueued', u'started', u'ended', u'duration',
+              u'worker', u'exc_info', u'meta']
+
+# Fields of a job's Redis hash that are needed for its optional attributes
+_HASH_FIELDS = {
+    u'status': [u'status'],
+    u'enqueued': [u'enqueued_at'],
+    u'started': [u'started_at'],
+    u'ended': [u'ended_at'],
+    u'duration': [u'started_at', u'ended_at'],
+    u'worker': [u'worker'],
+    u'exc_info': [u'exc_info'],
+    u'meta': [],
+}
+
+# Names of the resource limits of jobs, see ``Worker``
+_LIMITS = [u'timeout', u'max_memory', u'max_cpu']
+
 # RQ job queues. Do not use this directly, use ``get_queue`` instead.
 _queues = {}
 
 
+class JobResourceLimitExceeded(Exception):
+    u'''
+    Raised when a job exceeds one of its resource limits.
+    '''
+    pass
+
+
+class JobMemoryLimitExceeded(JobResourceLimitExceeded):
+    u'''
+    Raised when a job exceeds its memory limit.
+    '''
+    pass
+
+
+class JobCPULimitExceeded(JobResourceLimitExceeded):
+    u'''
+    Raised when a job exceeds its CPU time limit.
+    '''
+    pass
+
+
 def _connect():
     u'''
     Connect to Redis and tell RQ about it.
@@ -60,21 +140,29 @@ def _connect():
     return conn
 
 
-def _get_queue_name_prefix():
+def _get_queue_name_prefix(site_id=None):
     u'''
     Get the queue name prefix.
+
+    :param string site_id: The CKAN site ID. Defaults to the ID of this
+        site.
     '''
     # This must be done at runtime since we need a loaded config
-    return u'ckan:{}:'.format(config[u'ckan.site_id'])
+    if site_id is None:
+        site_id = config[u'ckan.site_id']
+    return u'ckan:{}:'.format(site_id)
 
 
-def add_queue_name_prefix(name):
+def add_queue_name_prefix(name, site_id=None):
     u'''
     Prefix a queue name.
 
+    :param string site_id: The ID of the CKAN site that the queue belongs
+        to. Defaults to the ID of this site.
+
     .. seealso:: :py:func:`remove_queue_name_prefix`
     '''
-    return _get_queue_name_prefix() + name
+    return _get_queue_name_prefix(site_id) + name
 
 
 def remove_queue_name_prefix(name):
@@ -91,6 +179,23 @@ def remove_queue_name_prefix(name):
     return name[len(prefix):]
 
 
+def split_queue_name(name):
+    u'''
+    Split a prefixed queue name into site ID and queue name.
+
+    Unlike :py:func:`remove_queue_name_prefix` this also works for the
+    queues of other CKAN sites.
+
+    :returns: Tuple of site ID and unprefixed queue name.
+
+    :raises ValueError: if the given name is not prefixed.
+    '''
+    parts = name.split(u':', 2)
+    if len(parts) != 3 or parts[0] != u'ckan':
+        raise ValueError(u'Queue name "{}" is not prefixed.'.format(name))
+    return parts[1], parts[2]
+
+
 def get_all_queues():
     u'''
     Return all job queues currently in use.
@@ -100,13 +205,16 @@ def get_all_queues():
 
     .. seealso:: :py:func:`get_queue`
     '''
-    redis_conn = _connect()
+    _connect()
     prefix = _get_queue_name_prefix()
-    return [q for q in rq.Queue.all(connection=redis_conn) if
-            q.name.startswith(prefix)]
+    queues = []
+    for redis_conn in shards.connect_to_all_shards():
+        queues.extend(q for q in rq.Queue.all(connection=redis_conn) if
+                      q.name.startswith(prefix))
+    return queues
 
 
-def get_queue(name=DEFAULT_QUEUE_NAME):
+def get_queue(name=DEFAULT_QUEUE_NAME, site_id=None):
     u'''
     Get a job queue.
 
@@ -115,26 +223,36 @@ def get_queue(name=DEFAULT_QUEUE_NAME):
     :param string name: The name of the queue. If not given then the
         default queue is returned.
 
+    :param string site_id: The ID of the CKAN site that the queue belongs
+        to. Defaults to the ID of this site.
+
     :returns: The job queue.
     :rtype: ``rq.queue.Queue``
 
     .. seealso:: :py:func:`get_all_queues`
     '''
     global _queues
-    fullname = add_queue_name_prefix(name)
+    fullname = add_queue_name_prefix(name, site_id)
     try:
         return _queues[fullname]
     except KeyError:
         log.debug(u'Initializing background job queue "{}"'.format(name))
-        redis_conn = _connect()
+        _connect()
+        redis_conn = shards.connect_to_shard(shards.get_queue_shard(fullname))
         queue = _queues[fullname] = rq.Queue(fullname, connection=redis_conn)
         return queue
 
 
-def enqueue(fn, args=None, kwargs=None, title=None, queue=DEFAULT_QUEUE_NAME):
+def enqueue(fn, args=None, kwargs=None, title=None, queue=DEFAULT_QUEUE_NAME,
+            retry=None, timeout=None, max_memory=None, max_cpu=None,
+            cache_ttl=None):
     u'''
     Enqueue a job to be run in the background.
 
+    If Redis is not available and the local spool is enabled (see
+    :py:mod:`ckanext.rq.spool`) then the job is spooled to disk and
+    added to its queue once Redis is back.
+
     :param function fn: Function to be executed in the background
 
     :param list args: List of arguments to be passed to the function.
@@ -149,17 +267,95 @@ def enqueue(fn, args=None, kwargs=None, title=None, queue=DEFAULT_QUEUE_NAME):
     :param string queue: Name of the queue. If not given then the
         default queue is used.
 
-    :returns: The enqueued job.
+    :param retry: Optional retry policy for the job. Either the maximum
+        number of attempts or a :py:class:`ckanext.rq.retry.Retry`
+        instance. If not given then the retry policy of the queue is
+        used.
+
+    :param int timeout: Optional maximum run time of the job in seconds.
+
+    :param int max_memory: Optional memory limit of the job in MB.
+
+    :param int max_cpu: Optional CPU time limit of the job in seconds.
+
+    Limits that are not given are taken from the configuration of the
+    queue when the job is executed (see :py:class:`Worker`).
+
+    :param int cache_ttl: If given then the job is cacheable (see
+        :py:mod:`ckanext.rq.cache`): its result is cached for this number
+        of seconds, and if a result of an identical job is cached then
+        the job is not enqueued but finished right away with that result.
+        The arguments of cacheable jobs must be JSON serializable.
+
+    :returns: The enqueued job. A job that was finished with a cached
+        result has the status ``finished`` and ``meta['cached']`` set.
     :rtype: ``rq.job.Job``
     '''
     if args is None:
         args = []
     if kwargs is None:
         kwargs = {}
-    job = get_queue(queue).enqueue_call(func=fn, args=args, kwargs=kwargs)
-    job.meta[u'title'] = title
-    job.save()
-    msg = u'Added background job {}'.format(job.id)
+    job_meta = {u'title': title}
+    if retry is not None:
+        if not isinstance(retry, retry_.Retry):
+            retry = retry_.Retry(retry)
+        job_meta[u'retry'] = retry.as_dict()
+    if timeout is not None:
+        job_meta[u'timeout'] = timeout
+    if max_memory is not None:
+        job_meta[u'max_memory'] = max_memory
+    if max_cpu is not None:
+        job_meta[u'max_cpu'] = max_cpu
+    rq_queue = get_queue(queue)
+    shard = shards.get_queue_shard(rq_queue.name)
+    job = rq_queue.job_class.create(
+        fn, args=args, kwargs=kwargs, connection=rq_queue.connection,
+        status=JobStatus.QUEUED, origin=rq_queue.name, timeout=timeout,
+        meta=job_meta, id=shards.new_job_id(shard))
+    job.enqueued_at = utcnow()
+    if cache_ttl is not None:
+        job.meta[u'cache_ttl'] = cache_ttl
+        job.meta[u'cache_key'] = cache.get_cache_key(
+            add_queue_name_prefix(u''),
+            cache.get_job_hash(job.func_name, args, kwargs))
+    spooled = False
+    try:
+        # Jobs that were spooled while Redis was down go first. Only a
+        # single batch is replayed here so that enqueueing stays fast,
+        # workers and ``paster jobs spool replay`` replay the rest. To
+        # keep the order of the jobs, new jobs are spooled behind the
+        # remaining ones until the spool is empty.
+        if spool.may_have_jobs():
+            spool.replay(max_batches=1)
+            spooled = spool.pending() > 0
+        cached = False
+        if cache_ttl is not None and not spooled:
+            cached, result = cache.get(job.meta[u'cache_key'],
+                                       rq_queue.connection)
+        if not spooled:
+            with rq_queue.connection.pipeline() as pipeline:
+                if cached:
+                    _finish_cached_job(job, result, pipeline)
+                else:
+                    _push_job(job, pipeline)
+                pipeline.execute()
+    except RedisConnectionError:
+        if not spool.is_enabled():
+            raise
+        spool.append(job)
+        log.warning(u'Redis is not available, spooled background job '
+                    u'{}'.format(job.id))
+        return job
+    if spooled:
+        spool.append(job)
+        log.info(u'Spooled background job {} behind older spooled '
+                 u'jobs'.format(job.id))
+        return job
+    if cached:
+        msg = u'Finished background job {} with a cached result'.format(
+            job.id)
+    else:
+        msg = u'Added background job {}'.format(job.id)
     if title:
         msg = u'{} ("{}")'.format(msg, title)
     msg = u'{} to queue "{}"'.format(msg, queue)
@@ -167,6 +363,58 @@ def enqueue(fn, args=None, kwargs=None, title=None, queue=DEFAULT_QUEUE_NAME):
     return job
 
 
+def _push_job(job, pipeline):
+    u'''
+    Add the commands for enqueueing a job to a pipeline.
+
+    This is equivalent to ``rq.queue.Queue.enqueue_job`` but saves the
+    job and pushes it onto its queue in a single round trip.
+
+    :param rq.job.Job job: The job. Its ``origin`` must be set to the
+        full name of the queue.
+
+    :param pipeline: The Redis pipeline.
+    '''
+    queue_key = rq.Queue.redis_queue_namespace_prefix + job.origin
+    pipeline.sadd(rq.Queue.redis_queues_keys, queue_key)
+    job.save(pipeline=pipeline)
+    pipeline.rpush(queue_key, job.id)
+    stats.count(job.origin, stats.ENQUEUED, pipeline)
+    index.add_job(job, pipeline)
+    events.publish(pipeline, events.ENQUEUED, job.id, job.origin)
+
+
+def _finish_cached_job(job, result, pipeline):
+    u'''
+    Add the commands for finishing a job with a cached result to a
+    pipeline.
+
+    The job is stored like a job that has been performed by a worker,
+    without being added to its queue.
+
+    :param rq.job.Job job: The job. Its ``origin`` must be set to the
+        full name of the queue.
+
+    :param result: The cached result.
+
+    :param pipeline: The Redis pipeline.
+    '''
+    job.meta[u'cached'] = True
+    job._result = result
+    job._status = JobStatus.FINISHED
+    job.started_at = job.ended_at = job.enqueued_at
+    job.save(pipeline=pipeline)
+    # Like ``FinishedJobRegistry.add``, which expects a ``StrictRedis``
+    # pipeline
+    registry = FinishedJobRegistry(job.origin, job.connection)
+    pipeline.zadd(registry.key,
+                  **{job.id: current_timestamp() + DEFAULT_RESULT_TTL})
+    job.cleanup(DEFAULT_RESULT_TTL, pipeline=pipeline)
+    stats.count(job.origin, stats.ENQUEUED, pipeline)
+    stats.count(job.origin, stats.FINISHED, pipeline)
+    events.publish(pipeline, events.FINISHED, job.id, job.origin, cached=1)
+
+
 def job_from_id(id):
     u'''
     Look up an enqueued job by its ID.
@@ -178,8 +426,10 @@ def job_from_id(id):
 
     :raises KeyError: if no job with that ID exists.
     '''
+    _connect()
+    redis_conn = shards.connect_to_shard(shards.get_job_shard(id))
     try:
-        return Job.fetch(id, connection=_connect())
+        return Job.fetch(id, connection=redis_conn)
     except NoSuchJobError:
         raise KeyError(u'There is no job with ID "{}".'.format(id))
 
@@ -204,6 +454,178 @@ def dictize_job(job):
     }
 
 
+def _format_timestamp(value):
+    u'''
+    Convert a timestamp stored by RQ to our format.
+    '''
+    if not value:
+        return None
+    return utcparse(as_text(value)).strftime(u'%Y-%m-%dT%H:%M:%S')
+
+
+def get_hash_fields(fields=()):
+    u'''
+    Get the fields of a job's Redis hash needed for dictizing it.
+
+    :param list fields: Optional attributes, see :py:data:`JOB_FIELDS`.
+
+    :rtype: list
+    '''
+    hash_fields = [u'origin', u'created_at', u'meta']
+    for field in fields:
+        for hash_field in _HASH_FIELDS[field]:
+            if hash_field not in hash_fields:
+                hash_fields.append(hash_field)
+    return hash_fields
+
+
+def dictize_job_hash(id, obj, fields=()):
+    u'''
+    Convert the raw Redis hash of a job to a dict.
+
+    Unlike :py:func:`dictize_job` this does not need an ``rq.job.Job``
+    instance, so jobs can be dictized directly from a pipelined read.
+
+    :param string id: The ID of the job.
+
+    :param dict obj: The fields of the hash, at least those returned by
+        :py:func:`get_hash_fields`.
+
+    :param list fields: Optional attributes to include in addition to
+        the ones returned by :py:func:`dictize_job`, see
+        :py:data:`JOB_FIELDS`: the job's ``status``, the times when it
+        was ``enqueued``, ``started`` and ``ended``, its ``duration`` in
+        seconds, the name of the ``worker`` that performed it, the
+        ``exc_info`` of a failed job and its ``meta`` data.
+
+    :returns: The dictized job.
+    :rtype: dict
+    '''
+    meta = unpickle(obj[u'meta']) if obj.get(u'meta') else {}
+    job_dict = {
+        u'id': id,
+        u'title': meta.get(u'title'),
+        u'created': _format_timestamp(obj[u'created_at']),
+        u'queue': remove_queue_name_prefix(as_text(obj[u'origin'])),
+    }
+    for field in fields:
+        if field in (u'enqueued', u'started', u'ended'):
+            value = _format_timestamp(obj.get(field + u'_at'))
+        elif field == u'duration':
+            value = None
+            if obj.get(u'started_at') and obj.get(u'ended_at'):
+                value = (utcparse(as_text(obj[u'ended_at'])) -
+                         utcparse(as_text(obj[u'started_at']))
+                         ).total_seconds()
+        elif field == u'meta':
+            value = meta
+        else:
+            value = as_text(obj[field]) if obj.get(field) else None
+        job_dict[field] = value
+    return job_dict
+
+
+def get_job_dict(id, fields=JOB_FIELDS):
+    u'''
+    Look up a job by its ID and dictize it.
+
+    Reads the job with a single Redis command.
+
+    :param string id: The ID of the job.
+
+    :param list fields: Optional attributes, see
+        :py:func:`dictize_job_hash`. By default all of them are included.
+
+    :returns: The dictized job.
+    :rtype: dict
+
+    :raises KeyError: if no job with that ID exists.
+    '''
+    _connect()
+    redis_conn = shards.connect_to_shard(shards.get_job_shard(id))
+    obj = redis_conn.hgetall(Job.key_for(id))
+    if not obj:
+        raise KeyError(u'There is no job with ID "{}".'.format(id))
+    obj = dict((as_text(key), value) for key, value in obj.items())
+    return dictize_job_hash(id, obj, fields)
+
+
+def iter_jobs(queues=None, since=None, until=None, title=None, fields=(),
+              offset=0):
+    u'''
+    Iterate over enqueued jobs.
+
+    Jobs are read from Redis in pages of :py:data:`PAGE_SIZE` jobs with
+    one pipelined round trip per page, so that the memory used does not
+    depend on the length of the queues. Jobs that are dequeued while
+    iterating may cause other jobs to be skipped.
+
+    :param list queues: Names of the queues to list jobs from. If not
+        given then the jobs from all queues are listed.
+
+    :param datetime.datetime since: Only return jobs that were created
+        at or after this time (UTC).
+
+    :param datetime.datetime until: Only return jobs that were created
+        before this time (UTC).
+
+    :param string title: Only return jobs whose title matches this
+        shell-style pattern (e.g. ``'Harvest*'``).
+
+    :param list fields: Optional attributes to include, see
+        :py:func:`dictize_job_hash`.
+
+    :param int offset: Number of matching jobs to skip. Without filters,
+        skipped jobs are not read from Redis at all.
+
+    :returns: The dictized jobs, see :py:func:`dictize_job_hash`.
+    :rtype: generator of dicts
+    '''
+    if queues:
+        queues = [get_queue(q) for q in queues]
+    else:
+        queues = get_all_queues()
+    hash_fields = get_hash_fields(fields)
+    filtered = since is not None or until is not None or title is not None
+    for queue in queues:
+        start = 0
+        if offset and not filtered:
+            length = queue.connection.llen(queue.key)
+            if offset >= length:
+                offset -= length
+                continue
+            start, offset = offset, 0
+        while True:
+            ids = [as_text(id) for id in queue.connection.lrange(
+                   queue.key, start, start + PAGE_SIZE - 1)]
+            if not ids:
+                break
+            start += len(ids)
+            with queue.connection.pipeline(transaction=False) as pipeline:
+                for id in ids:
+                    pipeline.hmget(Job.key_for(id), hash_fields)
+                values = pipeline.execute()
+            for id, value in zip(ids, values):
+                obj = dict(zip(hash_fields, value))
+                if not obj[u'created_at']:
+                    # The job has been deleted
+                    continue
+                created_at = utcparse(as_text(obj[u'created_at']))
+                if since is not None and created_at < since:
+                    continue
+                if until is not None and created_at >= until:
+                    continue
+                job = dictize_job_hash(id, obj, fields)
+                if title is not None and (
+                        job[u'title'] is None or
+                        not fnmatch.fnmatchcase(job[u'title'], title)):
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                yield job
+
+
 def test_job(*args):
     u'''Test job.
 
@@ -217,6 +639,24 @@ class Worker(rq.Worker):
     u'''
     CKAN-specific worker.
 
+    Each job is executed in a separate work horse process, which can be
+    subject to resource limits: a maximum run time (``timeout``, in
+    seconds), a maximum amount of memory (``max_memory``, in MB, which
+    includes the memory inherited from the worker) and a maximum amount
+    of CPU time (``max_cpu``, in seconds). Each limit is taken from the
+    first of these places where it is set:
+
+    1. The job (see :py:func:`enqueue`)
+    2. The configuration of the job's queue, e.g.
+       ``ckanext.rq.queue.my_queue.max_memory``
+    3. The constructor of the worker
+    4. The global configuration, e.g. ``ckanext.rq.max_memory``
+
+    A job that runs out of memory or CPU time fails with
+    :py:class:`JobMemoryLimitExceeded` or :py:class:`JobCPULimitExceeded`
+    and is not retried. A job that exceeds its run time fails with RQ's
+    ``JobTimeoutException``.
+
     Note that starting an instance of this class (via the ``work``
     method) disposes the currently active database engine and the
     associated session. This is necessary to prevent their corruption by
@@ -234,20 +674,151 @@ class Worker(rq.Worker):
         parameter is different.
 
         :param queues: The job queue(s) to listen on. Can be a string
-            with the name of a single queue or a list of queue names.
-            If not given then the default queue is used.
+            with the name of a single queue or a list of queue names or
+            ``rq.queue.Queue`` instances. If not given then the default
+            queue is used.
+
+        :param int timeout: Default maximum run time of jobs in seconds.
+
+        :param int max_memory: Default memory limit of jobs in MB.
+
+        :param int max_cpu: Default CPU time limit of jobs in seconds.
         '''
+        self.limits = {}
+        for name in _LIMITS:
+            value = kwargs.pop(name, None)
+            if value is None:
+                value = config.get(u'ckanext.rq.{}'.format(name))
+            self.limits[name] = value
         queues = queues or [DEFAULT_QUEUE_NAME]
-        queues = [get_queue(q) for q in ensure_list(queues)]
+        queues = [q if isinstance(q, rq.Queue) else get_queue(q)
+                  for q in ensure_list(queues)]
         rq.worker.logger.setLevel(logging.INFO)
         super(Worker, self).__init__(queues, *args, **kwargs)
+        # Exception handlers are called in reverse order, so this one
+        # runs before the job is moved to the failed queue
+        self.push_exc_handler(self.retry_job)
+        self._heartbeat = None
+        self._last_reap = None
+        self._last_gc = None
+        # Start of the job performed by this work horse, for its events
+        self._job_started = None
+        # Prefetched jobs that have not been started yet, as tuples of ID
+        # and queue, and the ID of the job that was dequeued last if it
+        # was prefetched
+        self._prefetched = collections.deque()
+        self._prefetched_id = None
+        # Concurrency slots of the job that is being performed and its
+        # ID, see ``ckanext.rq.concurrency``
+        self._slots = []
+        self._slots_job_id = None
+        self._home_connection = self.connection
+        # Command line for reloading the worker, see ``reload``
+        self.reload_command = None
+        # New process of the worker that is being started and whether it
+        # is ready to take jobs, see ``request_reload``
+        self._successor = None
+        self._successor_ready = False
+
+    def work(self, *args, **kwargs):
+        result = super(Worker, self).work(*args, **kwargs)
+        if self._successor is not None:
+            self.reload()
+        return result
+
+    def _install_signal_handlers(self):
+        super(Worker, self)._install_signal_handlers()
+        signal.signal(signal.SIGHUP, self.request_reload)
+
+    def request_stop(self, signum, frame):
+        # A new process of the worker that is still starting is stopped
+        # along with the worker
+        if self._successor is not None:
+            reloader._send_signal(self._successor, signum)
+        super(Worker, self).request_stop(signum, frame)
+
+    def request_force_stop(self, signum, frame):
+        if self._successor is not None:
+            reloader._send_signal(self._successor, signum)
+        super(Worker, self).request_force_stop(signum, frame)
+
+    def request_reload(self, signum, frame):
+        u'''
+        Signal handler for SIGHUP that reloads the worker.
+
+        A new process of the worker is started right away, which
+        re-imports all code and reloads the configuration. Meanwhile this
+        process keeps performing jobs. Once the new process is ready to
+        take jobs this process stops taking jobs, finishes its current job
+        and then hands over to the new process, see :py:meth:`reload`. If
+        the new process fails to start then this process keeps working.
+        '''
+        if self.reload_command is None:
+            log.warning(u'Worker {} cannot be reloaded, ignoring SIGHUP'
+                        .format(self.key))
+            return
+        if self._successor is not None:
+            log.info(u'Worker {} is already reloading, ignoring SIGHUP'
+                     .format(self.key))
+            return
+        log.info(u'Worker {} is reloading'.format(self.key))
+        self._successor_ready = False
+        signal.signal(reloader.READY_SIGNAL, self._notify_successor_ready)
+        self._successor = reloader.start_worker(self.reload_command)
+
+    def _notify_successor_ready(self, signum, frame):
+        self._successor_ready = True
+
+    def _is_replaced(self):
+        u'''
+        Check whether the new process of the worker is ready to take jobs.
+
+        :rtype: bool
+        '''
+        if self._successor is None:
+            return False
+        if self._successor_ready:
+            return True
+        if self._successor.poll() is not None:
+            log.error(u'New process of worker {} has exited with code {} '
+                      u'before it was ready, continuing'.format(
+                          self.key, self._successor.returncode))
+            self._successor = None
+        return False
+
+    def reload(self):
+        u'''
+        Hand over to the new process of the worker.
+
+        This process is replaced by a :py:class:`ckanext.rq.reloader.Reloader`
+        that keeps the PID of the worker, so that process supervisors do not
+        notice the reload, and that waits for the new process.
+        '''
+        log.info(u'Worker {} (PID {}) hands over to its new process {}'
+                 .format(self.key, self.pid, self._successor.pid))
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        command = [sys.executable, u'-m', u'ckanext.rq.reloader',
+                   u'{}'.format(self._successor.pid)] + self.reload_command
+        os.execv(command[0], command)
 
     def register_birth(self, *args, **kwargs):
         result = super(Worker, self).register_birth(*args, **kwargs)
-        names = [remove_queue_name_prefix(n) for n in self.queue_names()]
+        self.connection.hset(self.key, u'hostname', socket.gethostname())
+        connections = [self.connection] + [
+            c for c, _ in shards.group_by_connection(self.queues)]
+        self._heartbeat = reaper.Heartbeat(self.name, connections)
+        self._heartbeat.start()
+        self.replay_spool()
+        names = [self._queue_label(n) for n in self.queue_names()]
         names = u', '.join(u'"{}"'.format(n) for n in names)
         log.info(u'Worker {} (PID {}) has started on queue(s) {} '.format(
                  self.key, self.pid, names))
+        # If this worker replaces another one then that one stops taking
+        # jobs now
+        reloader.signal_ready()
         return result
 
     def execute_job(self, job, *args, **kwargs):
@@ -260,12 +831,13 @@ class Worker(rq.Worker):
         # Note that this rolls back any non-committed changes in the session.
         # Both `Session` and `engine` automatically re-initialize themselve
         # when they are used the next time.
+        from ckan.model import meta
         log.debug(u'Disposing database engine before fork')
         meta.Session.remove()
         meta.engine.dispose()
 
         # The original implementation performs the actual fork
-        queue = remove_queue_name_prefix(job.origin)
+        queue = self._queue_label(job.origin)
         log.info(u'Worker {} starts job {} from queue "{}"'.format(
                  self.key, job.id, queue))
 
@@ -274,33 +846,527 @@ class Worker(rq.Worker):
         #     plugin.before_fork()
         _dispose_engines()
 
-        result = super(Worker, self).execute_job(job, *args, **kwargs)
+        try:
+            result = super(Worker, self).execute_job(job, *args, **kwargs)
+        finally:
+            self._horse_pid = 0
+            self._release_slots(job.id, self._slots)
+            self._slots = []
+        try:
+            with job.connection.pipeline() as pipeline:
+                stats.count(job.origin, stats.FINISHED, pipeline)
+                pipeline.execute()
+        except Exception:
+            log.exception(u'Error while updating queue statistics')
         log.info(u'Worker {} has finished job {} from queue "{}"'.format(
                  self.key, job.id, queue))
 
         return result
 
+    def _queue_label(self, name):
+        u'''
+        Get the name of a queue for log messages.
+
+        :param string name: The prefixed name of the queue.
+        '''
+        return remove_queue_name_prefix(name)
+
     def register_death(self, *args, **kwargs):
+        self._return_prefetched()
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
         result = super(Worker, self).register_death(*args, **kwargs)
         log.info(u'Worker {} (PID {}) has stopped'.format(self.key, self.pid))
         return result
 
     def handle_exception(self, job, *exc_info):
+        if (issubclass(exc_info[0], MemoryError) and
+                self.get_job_limit(job, u'max_memory')):
+            # Lift the limit so that the failure can be handled
+            hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+            resource.setrlimit(resource.RLIMIT_AS, (hard, hard))
+            # Report the exceeded limit instead of a generic MemoryError
+            exc = JobMemoryLimitExceeded(
+                u'Job exceeded its memory limit ({} MB)'.format(
+                    self.get_job_limit(job, u'max_memory')))
+            exc_info = (JobMemoryLimitExceeded, exc, exc_info[2])
         log.exception(u'Job {} on worker {} raised an exception: {}'.format(
                       job.id, self.key, exc_info[1]))
-        return super(Worker, self).handle_exception(job, *exc_info)
+        result = super(Worker, self).handle_exception(job, *exc_info)
+        self._publish(job, events.FAILED, exc_type=exc_info[0].__name__,
+                      retry=int(job._status == retry_.SCHEDULED))
+        return result
+
+    def _publish(self, job, event, **fields):
+        u'''
+        Publish the end of a job that this work horse has performed.
+        '''
+        duration = None
+        if self._job_started is not None:
+            duration = time.time() - self._job_started
+        try:
+            events.publish(job.connection, event, job.id, job.origin,
+                           duration=duration, **fields)
+        except Exception:
+            log.exception(u'Error while publishing {} event of job {}'
+                          .format(event, job.id))
+
+    def retry_job(self, job, *exc_info):
+        u'''
+        Exception handler that schedules failed jobs for another attempt.
+
+        Uses the retry policy of the job or, if the job doesn't have one,
+        the retry policy of its queue. Jobs that are retried are not
+        passed on to the next exception handler.
+        '''
+        if issubclass(exc_info[0], JobResourceLimitExceeded):
+            return True
+        queue = remove_queue_name_prefix(job.origin)
+        policy = job.meta.get(u'retry')
+        if policy is None:
+            policy = retry_.Retry.from_config(queue)
+        else:
+            policy = retry_.Retry.from_dict(policy)
+        attempts = job.meta.get(u'attempts', 1)
+        if attempts >= policy.max_attempts:
+            return True
+        delay = policy.get_delay(attempts)
+        job.meta[u'attempts'] = attempts + 1
+        retry_.schedule(job, delay)
+        log.info(u'Job {} from queue "{}" will be retried in {:.0f} seconds '
+                 u'(attempt {} of {})'.format(job.id, queue, delay,
+                                              attempts + 1,
+                                              policy.max_attempts))
+        return False
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        # HACK: Copied from rq.Worker with support for delayed jobs,
+        # shards and concurrency limits. Due jobs are moved to their queues
+        # before each attempt to dequeue a job, and the blocking dequeue
+        # doesn't wait past the next one.
+        result = None
+        qnames = self.queue_names()
+        self._prefetched_id = None
+        if self._is_replaced():
+            # Remaining prefetched jobs are returned to their queues by
+            # ``register_death``
+            raise StopRequested()
+
+        # Prefetched jobs are started without any round trips in between
+        result = self._dequeue_prefetched()
+        while result is not None and not self._acquire_slots(result[0]):
+            result = self._dequeue_prefetched()
+        if result is not None:
+            return result
+
+        self.set_state(WorkerStatus.IDLE)
+        self.procline(u'Listening on {0}'.format(u','.join(qnames)))
+        self.log.info(u'')
+        self.log.info(u'*** Listening on {0}...'.format(
+                      green(u', '.join(qnames))))
+
+        while True:
+            if self._is_replaced():
+                raise StopRequested()
+            self.heartbeat()
+
+            self.reap()
+            self.collect_garbage()
+            self.replay_spool()
+            next_due = retry_.enqueue_due_jobs(self.queues)
+            dequeue_timeout = timeout
+            if timeout is not None and next_due is not None:
+                dequeue_timeout = max(1, min(timeout,
+                                             int(math.ceil(next_due))))
+            reap_interval = reaper.get_reap_interval()
+            if dequeue_timeout is not None and reap_interval > 0:
+                dequeue_timeout = max(1, min(dequeue_timeout, reap_interval))
+            if dequeue_timeout is not None and self._successor is not None:
+                # Wait for the new process of the worker to become ready
+                dequeue_timeout = min(dequeue_timeout,
+                                      reloader.POLL_INTERVAL)
+            # Queues whose slots are all taken are skipped, and slots that
+            # become free are noticed after at most a poll interval
+            limits = concurrency.get_queue_limits(self.queues)
+            full = concurrency.get_full_queues(limits)
+            queues = [q for q in self.queues if q.name not in full]
+            if dequeue_timeout is not None and limits:
+                dequeue_timeout = min(dequeue_timeout,
+                                      concurrency.POLL_INTERVAL)
+            if not queues:
+                if dequeue_timeout is None:
+                    break
+                time.sleep(dequeue_timeout)
+                continue
+            try:
+                result = self._prefetch(queues, limits)
+                if result is None:
+                    result = self._dequeue_any(dequeue_timeout, queues)
+                if result is not None:
+                    job, queue = result
+                    if not self._acquire_slots(job):
+                        result = None
+                        continue
+                    self.log.info(u'{0}: {1} ({2})'.format(
+                        green(queue.name), blue(job.description), job.id))
+                break
+            except DequeueTimeout:
+                pass
+            except RedisConnectionError:
+                # The blocking dequeue may have been interrupted by SIGHUP
+                # or by the new process of the worker becoming ready
+                if self._successor is None:
+                    raise
+
+        self.heartbeat()
+        return result
+
+    def _dequeue_any(self, timeout, queues=None):
+        u'''
+        Dequeue a job from any of the worker's queues.
+
+        If the queues are stored in different shards then the shards are
+        polled in turn, since a blocking dequeue can only wait on a
+        single Redis instance.
+
+        :param list queues: The queues to dequeue from. Defaults to all
+            queues of the worker.
+        '''
+        if queues is None:
+            queues = self.queues
+        groups = shards.group_by_connection(queues)
+        if len(groups) == 1:
+            return self.queue_class.dequeue_any(
+                queues, timeout, connection=groups[0][0])
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            for connection, group in groups:
+                result = self.queue_class.dequeue_any(
+                    group, None, connection=connection)
+                if result is not None:
+                    return result
+            if deadline is None:
+                return None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DequeueTimeout(timeout, self.queue_names())
+            time.sleep(min(SHARD_POLL_INTERVAL, remaining))
+
+    def _prefetch(self, queues=None, limits=None):
+        u'''
+        Prefetch jobs, see :py:mod:`ckanext.rq.prefetch`.
+
+        Jobs are only prefetched from the queues before the first queue
+        with a concurrency limit, so that the limit and the priorities of
+        the queues are kept.
+
+        :param list queues: The queues to prefetch from. Defaults to all
+            queues of the worker.
+
+        :param dict limits: The concurrency limits of the queues, see
+            :py:func:`ckanext.rq.concurrency.get_queue_limits`.
+
+        :returns: The first of the prefetched jobs and its queue, or
+            ``None`` if prefetching is disabled or there are no jobs.
+        '''
+        if self._prefetched:
+            return self._dequeue_prefetched()
+        count = prefetch.get_prefetch()
+        if count <= 0:
+            return None
+        if queues is None:
+            queues = self.queues
+        if limits:
+            queues = list(itertools.takewhile(
+                lambda q: q.name not in limits, queues))
+        # The job that is started right away is taken, too
+        count += 1
+        for connection, group in shards.group_by_connection(queues):
+            fetched = prefetch.fetch(self.name, group, count, connection)
+            self._prefetched.extend(fetched)
+            count -= len(fetched)
+            if count <= 0:
+                break
+        return self._dequeue_prefetched()
+
+    def _dequeue_prefetched(self):
+        u'''
+        Take the next prefetched job.
+
+        :returns: The job and its queue, or ``None`` if there are no
+            prefetched jobs.
+        '''
+        while self._prefetched:
+            id, queue = self._prefetched.popleft()
+            try:
+                job = queue.job_class.fetch(id, connection=queue.connection)
+            except NoSuchJobError:
+                # The job has been deleted in the meantime
+                queue.connection.lrem(prefetch.get_list_key(self.name), id)
+                continue
+            self._prefetched_id = id
+            self.log.info(u'{0}: {1} ({2})'.format(
+                green(queue.name), blue(job.description), job.id))
+            return job, queue
+        return None
+
+    def _acquire_slots(self, job):
+        u'''
+        Take the concurrency slots that a job needs, see
+        :py:mod:`ckanext.rq.concurrency`.
+
+        If they are not available then the job is scheduled to be tried
+        again later.
+
+        :returns: Whether the job can be started.
+        :rtype: bool
+        '''
+        slots = concurrency.get_job_slots(job)
+        if not slots:
+            return True
+        timeout = (self.get_job_limit(job, u'timeout') or
+                   self.queue_class.DEFAULT_TIMEOUT)
+        if concurrency.acquire(job, slots, timeout):
+            self._slots = slots
+            self._slots_job_id = job.id
+            return True
+        with job.connection._pipeline() as pipeline:
+            retry_.schedule(job, concurrency.DEFER_DELAY, pipeline)
+            if job.id == self._prefetched_id:
+                pipeline.lrem(prefetch.get_list_key(self.name), 1, job.id)
+            pipeline.execute()
+        self._prefetched_id = None
+        log.info(u'Job {} from queue "{}" has been deferred since its '
+                 u'concurrency limit has been reached'.format(
+                     job.id, self._queue_label(job.origin)))
+        return False
+
+    def _release_slots(self, job_id, slots):
+        u'''
+        Release the concurrency slots of a job.
+        '''
+        try:
+            concurrency.release(job_id, slots)
+        except Exception:
+            log.exception(u'Error while releasing the concurrency slots of '
+                          u'job {}'.format(job_id))
+
+    def _return_prefetched(self):
+        u'''
+        Move the jobs that the worker has prefetched but not started back
+        to their queues.
+        '''
+        if not self._prefetched:
+            return
+        # Group the jobs by Redis instance, like
+        # ``shards.group_by_connection``
+        by_pool = collections.OrderedDict()
+        for job_id, queue in self._prefetched:
+            pool = getattr(queue.connection, u'connection_pool',
+                           queue.connection)
+            by_pool.setdefault(id(pool), (queue.connection, []))[1].append(
+                job_id)
+        try:
+            count = 0
+            for connection, ids in by_pool.values():
+                count += len(prefetch.return_jobs(self.name, ids,
+                                                  connection))
+            log.info(u'Worker {} has returned {} prefetched job(s)'.format(
+                     self.key, count))
+        except Exception:
+            log.exception(u'Error while returning prefetched jobs')
+        self._prefetched.clear()
+
+    def reap(self):
+        u'''
+        Recover the orphaned jobs of the worker's queues.
+
+        Does nothing if the reaper has run less than
+        ``ckanext.rq.reap_interval`` seconds ago.
+        '''
+        interval = reaper.get_reap_interval()
+        if interval <= 0:
+            return
+        now = time.time()
+        if self._last_reap is not None and now - self._last_reap < interval:
+            return
+        self._last_reap = now
+        try:
+            reaper.reap(self.queues)
+        except Exception:
+            log.exception(u'Error while reaping orphaned jobs')
+
+    def replay_spool(self):
+        u'''
+        Move the jobs that were spooled on this host while Redis was down
+        to their queues, see :py:mod:`ckanext.rq.spool`.
+        '''
+        if not spool.may_have_jobs():
+            return
+        try:
+            spool.replay()
+        except Exception:
+            log.exception(u'Error while replaying spooled jobs')
+
+    def collect_garbage(self):
+        u'''
+        Collect stale job data, see :py:mod:`ckanext.rq.garbage`.
+
+        Does nothing unless ``ckanext.rq.gc_interval`` is set. Of all
+        workers only one collects garbage per interval, for at most
+        ``ckanext.rq.gc_time_budget`` seconds.
+        '''
+        interval = garbage.get_gc_interval()
+        if interval <= 0:
+            return
+        now = time.time()
+        if self._last_gc is not None and now - self._last_gc < interval:
+            return
+        self._last_gc = now
+        try:
+            garbage.collect_if_due()
+        except Exception:
+            log.exception(u'Error while collecting garbage')
+
+    def prepare_job_execution(self, job):
+        # HACK: Copied from rq.Worker, additionally stores the name of the
+        # worker in the job so that the reaper can check its heartbeat.
+        # The worker and the job may be stored in different shards.
+        timeout = (job.timeout or 180) + 60
+
+        with self._home_connection._pipeline() as pipeline:
+            self.set_state(WorkerStatus.BUSY, pipeline=pipeline)
+            self.set_current_job_id(job.id, pipeline=pipeline)
+            self.heartbeat(timeout, pipeline=pipeline)
+            pipeline.execute()
+        with job.connection._pipeline() as pipeline:
+            registry = StartedJobRegistry(job.origin, job.connection)
+            registry.add(job, timeout, pipeline=pipeline)
+            job.set_status(JobStatus.STARTED, pipeline=pipeline)
+            pipeline.hmset(job.key, {
+                u'started_at': utcformat(utcnow()),
+                u'worker': self.name,
+            })
+            index.remove_job(job, pipeline)
+            if job.id == self._prefetched_id:
+                pipeline.lrem(prefetch.get_list_key(self.name), 1, job.id)
+            events.publish(pipeline, events.STARTED, job.id, job.origin,
+                           worker=self.name,
+                           wait=events.get_seconds_since(job.enqueued_at))
+            pipeline.execute()
+        self._job_started = time.time()
+
+        msg = u'Processing {0} from {1} since {2}'
+        self.procline(msg.format(job.func_name, job.origin, time.time()))
+
+    def get_job_limit(self, job, name):
+        u'''
+        Get a resource limit for a job.
+
+        :param rq.job.Job job: The job.
+
+        :param string name: The name of the limit (``timeout``,
+            ``max_memory`` or ``max_cpu``).
+
+        :returns: The value of the limit or ``None`` if the limit is not
+            set.
+        :rtype: int
+        '''
+        value = job.meta.get(name)
+        if value is None:
+            value = config.get(u'ckanext.rq.queue.{}.{}'.format(
+                split_queue_name(job.origin)[1], name))
+        if value is None:
+            value = self.limits[name]
+        return int(value) if value is not None else None
+
+    def set_resource_limits(self, job):
+        u'''
+        Apply the memory and CPU time limits of a job.
+
+        Must only be called in the work horse process.
+        '''
+        max_memory = self.get_job_limit(job, u'max_memory')
+        if max_memory:
+            limit = max_memory * 1024 * 1024
+            hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+            resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+        max_cpu = self.get_job_limit(job, u'max_cpu')
+        if max_cpu:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            soft = int(math.ceil(usage.ru_utime + usage.ru_stime)) + max_cpu
+            # The kernel sends SIGXCPU once the soft limit is reached and
+            # kills the process once the hard limit is reached.
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, soft + 5))
+
+            def handle_cpu_limit(signum, frame):
+                raise JobCPULimitExceeded(
+                    u'Job exceeded its CPU time limit ({} seconds)'.format(
+                        max_cpu))
+
+            signal.signal(signal.SIGXCPU, handle_cpu_limit)
+
+    def load_job_environment(self, job):
+        u'''
+        Load the CKAN environment for performing a job.
+
+        Called in the work horse process.
+        '''
+        from ckan.config.environment import load_environment
+        load_environment(config[u'global_conf'], config)
 
     def main_work_horse(self, job, queue):
         # This method is called in a worker's work horse process right
-        # after forking.
-        load_environment(config[u'global_conf'], config)
+        # after forking. Reloading the worker must not affect the job.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.load_job_environment(job)
+        self.set_resource_limits(job)
         return super(Worker, self).main_work_horse(job, queue)
 
-    def perform_job(self, *args, **kwargs):
-        result = super(Worker, self).perform_job(*args, **kwargs)
+    def set_current_job_id(self, job_id, pipeline=None):
+        # The worker is always stored in the home Redis instance, but
+        # while a job is performed RQ passes a pipeline of the job's shard
+        # (see ``perform_job``).
+        if pipeline is None or self.connection is not self._home_connection:
+            pipeline = self._home_connection
+        super(Worker, self).set_current_job_id(job_id, pipeline=pipeline)
+
+    def perform_job(self, job, *args, **kwargs):
+        job.timeout = (self.get_job_limit(job, u'timeout') or
+                       self.queue_class.DEFAULT_TIMEOUT)
+        timing.timed(job)
+        profiler = None
+        if profile.should_profile(job):
+            profiler = profile.profiled(job)
+        # RQ uses the worker's connection for the job's registries and
+        # for the failed queue, so switch to the job's shard.
+        self.connection = job.connection
+        self.failed_queue = get_failed_queue(job.connection)
+        try:
+            result = super(Worker, self).perform_job(job, *args, **kwargs)
+        finally:
+            self.connection = self._home_connection
+            self.failed_queue = get_failed_queue(self.connection)
+        if profiler is not None:
+            try:
+                profile.save(job.id, profiler, self.connection)
+            except Exception:
+                log.exception(u'Error while storing profile of job {}'
+                              .format(job.id))
+        if result:
+            self._publish(job, events.FINISHED)
+        if result and job.meta.get(u'cache_key'):
+            try:
+                cache.store(job.meta[u'cache_key'], job.result,
+                            job.meta[u'cache_ttl'], job.connection)
+            except Exception:
+                log.exception(u'Error while caching the result of job {}'
+                              .format(job.id))
         # rq.Worker.main_work_horse does a hard exit via os._exit directly
         # after its call to perform_job returns. Hence here is the correct
         # location to clean up.
+        from ckan.model import meta
         try:
             meta.Session.remove()
         except Exception:
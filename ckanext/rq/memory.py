@@ -0,0 +1,349 @@
+# encoding: utf-8
+
+u'''
+Estimates of the Redis memory used by background jobs.
+
+``paster jobs memory`` shows how much memory the jobs of each queue, of
+each registry and of each job function use, which of them have the
+largest payloads and how much of the failed jobs' memory is taken up by
+their tracebacks. This tells where payloads should be made smaller, be
+given TTLs or be stored elsewhere.
+
+Measuring every job would take a round trip per job, so instead a fixed
+number of jobs is sampled from each queue and registry, evenly spread
+over it, and measured with ``MEMORY USAGE`` (which needs Redis 4.0 or
+later). The sizes are then extrapolated to the number of jobs. The cost
+of a report therefore depends on the number of queues but not on their
+length.
+'''
+
+from __future__ import absolute_import, division
+
+import heapq
+import random
+
+from redis.exceptions import ResponseError
+from rq.compat import as_text
+from rq.job import Job, unpickle
+
+from ckanext.rq import failed, shards
+
+
+# Number of jobs that are sampled from each queue and registry
+SAMPLE_SIZE = 100
+
+# Registries of each queue, by the prefix of their key
+_REGISTRIES = [
+    (u'rq:wip:', u'started'),
+    (u'rq:finished:', u'finished'),
+    (u'rq:deferred:', u'deferred'),
+    (u'rq:delayed:', u'scheduled'),
+]
+
+_JOB_FIELDS = [u'origin', u'description', u'meta']
+
+
+def format_bytes(size):
+    u'''
+    Format a number of bytes for humans, e.g. ``1.5 MB``.
+    '''
+    for unit in [u'bytes', u'KB', u'MB']:
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = u'GB'
+    if unit == u'bytes':
+        return u'{:.0f} {}'.format(size, unit)
+    return u'{:.1f} {}'.format(size, unit)
+
+
+def _get_positions(count, samples):
+    u'''
+    Choose evenly spread positions for sampling a list or sorted set.
+    '''
+    if count <= samples:
+        return list(range(count))
+    offset = random.random()
+    return [int((i + offset) * count / samples) for i in range(samples)]
+
+
+class _Source(object):
+    u'''
+    A list or sorted set of job IDs from which jobs are sampled.
+    '''
+    def __init__(self, connection, key, is_list, prefix=None, **info):
+        self.connection = connection
+        self.key = key
+        self.is_list = is_list
+        # Queue name prefix of the jobs that are included, for sources
+        # whose info does not give a queue
+        self.prefix = prefix
+        self.info = info
+        self.count = 0
+        self.key_memory = 0
+        self.samples = []
+
+    def add_count_commands(self, pipeline):
+        if self.is_list:
+            pipeline.llen(self.key)
+        else:
+            pipeline.zcard(self.key)
+        pipeline.execute_command(u'MEMORY', u'USAGE', self.key)
+
+    def add_position_commands(self, pipeline, positions):
+        for position in positions:
+            if self.is_list:
+                pipeline.lindex(self.key, position)
+            else:
+                pipeline.zrange(self.key, position, position)
+
+    def parse_id(self, value):
+        if not self.is_list:
+            value = value[0] if value else None
+        return as_text(value) if value else None
+
+
+def _execute(pipeline):
+    u'''
+    Execute a pipeline that measures memory with ``MEMORY USAGE``.
+
+    :raises ValueError: If Redis does not support ``MEMORY USAGE``.
+    '''
+    try:
+        return pipeline.execute()
+    except ResponseError as e:
+        raise ValueError(u'Estimating the memory used by jobs needs Redis '
+                         u'4.0 or later ({})'.format(e))
+
+
+def _sample(sources, samples):
+    u'''
+    Sample and measure the jobs of sources that share a Redis instance.
+    '''
+    if not sources:
+        return
+    connection = sources[0].connection
+    with connection.pipeline(transaction=False) as pipeline:
+        for source in sources:
+            source.add_count_commands(pipeline)
+        values = _execute(pipeline)
+    all_positions = []
+    with connection.pipeline(transaction=False) as pipeline:
+        for i, source in enumerate(sources):
+            source.count = values[2 * i]
+            source.key_memory = values[2 * i + 1] or 0
+            positions = _get_positions(source.count, samples)
+            source.add_position_commands(pipeline, positions)
+            all_positions.append(positions)
+        values = pipeline.execute()
+    ids = []
+    start = 0
+    for source, positions in zip(sources, all_positions):
+        ids.append([source.parse_id(v)
+                    for v in values[start:start + len(positions)]])
+        start += len(positions)
+    with connection.pipeline(transaction=False) as pipeline:
+        for source_ids in ids:
+            for id in source_ids:
+                key = Job.key_for(id or u'')
+                pipeline.execute_command(u'MEMORY', u'USAGE', key)
+                pipeline.hmget(key, _JOB_FIELDS)
+                pipeline.execute_command(u'HSTRLEN', key, u'data')
+                pipeline.execute_command(u'HSTRLEN', key, u'exc_info')
+        values = _execute(pipeline)
+    start = 0
+    for source, source_ids in zip(sources, ids):
+        for id in source_ids:
+            memory, fields, data, exc_info = values[start:start + 4]
+            start += 4
+            if not id or not memory:
+                # The job has been removed or deleted in the meantime
+                continue
+            origin, description, meta = fields
+            queue = source.info.get(u'queue')
+            if queue is None:
+                origin = as_text(origin or b'')
+                if not origin.startswith(source.prefix):
+                    continue
+                queue = origin[len(source.prefix):]
+            meta = unpickle(meta) if meta else {}
+            source.samples.append({
+                u'id': id,
+                u'queue': queue,
+                u'function': as_text(description or b'').split(u'(', 1)[0],
+                u'title': meta.get(u'title'),
+                u'memory': memory,
+                u'data': data,
+                u'exc_info': exc_info,
+            })
+
+
+def get_report(queues=None, samples=SAMPLE_SIZE, limit=10):
+    u'''
+    Estimate the memory used by jobs.
+
+    :param list queues: Names of the queues to include. If not given then
+        all queues are included.
+
+    :param int samples: Maximum number of jobs that are sampled from each
+        queue and registry.
+
+    :param int limit: Number of functions and of largest jobs that are
+        returned.
+
+    :returns: A dict with the estimated number of jobs and memory in
+        bytes (including the list or sorted set itself) of each queue
+        (``queues``), of each non-empty registry (``registries``) and of
+        the failed jobs (``failed``, which also gives the total and
+        average size of their tracebacks), the functions whose jobs use
+        the most memory (``functions``), the largest sampled jobs
+        (``largest``) and the number of sampled jobs (``sampled``).
+    :rtype: dict
+
+    :raises ValueError: If Redis does not support ``MEMORY USAGE`` (i.e.
+        it is older than 4.0).
+    '''
+    from ckanext.rq import jobs
+    if queues:
+        queues = [jobs.get_queue(q) for q in queues]
+    else:
+        queues = jobs.get_all_queues()
+    prefix = jobs.add_queue_name_prefix(u'')
+
+    sources = []
+    failed_sources = []
+    for connection, connection_queues in shards.group_by_connection(queues):
+        instance_sources = []
+        for queue in connection_queues:
+            name = jobs.remove_queue_name_prefix(queue.name)
+            instance_sources.append(_Source(connection, queue.key, True,
+                                            queue=name))
+            for key_prefix, registry in _REGISTRIES:
+                instance_sources.append(_Source(
+                    connection, key_prefix + queue.name, False, queue=name,
+                    registry=registry))
+        sources.extend(instance_sources)
+        _sample(instance_sources, samples)
+    for connection in shards.connect_to_all_shards():
+        source = _Source(connection, failed.get_failed_queue(connection).key,
+                         True, prefix=prefix)
+        failed_sources.append(source)
+        _sample([source], samples)
+
+    functions = {}
+    largest = []
+    sampled = 0
+
+    def add_samples(source):
+        # Each sampled job stands for the same number of jobs of its
+        # source, so jobs that were skipped (for example because they
+        # belong to another site) are left out of the estimates
+        weight = 0
+        if source.count:
+            weight = source.count / min(source.count, samples)
+        total_memory = 0
+        total_exc_info = 0
+        for sample in source.samples:
+            function = functions.setdefault(sample[u'function'], {
+                u'function': sample[u'function'],
+                u'jobs': 0,
+                u'memory': 0,
+            })
+            function[u'jobs'] += weight
+            function[u'memory'] += weight * sample[u'memory']
+            total_memory += weight * sample[u'memory']
+            total_exc_info += weight * sample[u'exc_info']
+            largest.append(sample)
+        return (int(round(weight * len(source.samples))),
+                int(round(total_memory)), int(round(total_exc_info)))
+
+    queue_results = []
+    registry_results = []
+    for source in sources:
+        count, memory, _ = add_samples(source)
+        sampled += len(source.samples)
+        result = {
+            u'queue': source.info[u'queue'],
+            u'jobs': count,
+            u'memory': memory + source.key_memory,
+        }
+        if u'registry' in source.info:
+            if count:
+                result[u'registry'] = source.info[u'registry']
+                registry_results.append(result)
+        else:
+            queue_results.append(result)
+
+    failed_result = {u'jobs': 0, u'memory': 0, u'exc_info': 0}
+    for source in failed_sources:
+        count, memory, exc_info = add_samples(source)
+        sampled += len(source.samples)
+        failed_result[u'jobs'] += count
+        failed_result[u'memory'] += memory
+        failed_result[u'exc_info'] += exc_info
+    failed_result[u'exc_info_avg'] = (
+        failed_result[u'exc_info'] // failed_result[u'jobs']
+        if failed_result[u'jobs'] else 0)
+
+    for function in functions.values():
+        function[u'jobs'] = int(round(function[u'jobs']))
+        function[u'memory'] = int(round(function[u'memory']))
+    return {
+        u'queues': queue_results,
+        u'registries': registry_results,
+        u'failed': failed_result,
+        u'functions': heapq.nlargest(limit, functions.values(),
+                                     key=lambda f: f[u'memory']),
+        u'largest': heapq.nlargest(limit, largest,
+                                   key=lambda s: s[u'memory']),
+        u'sampled': sampled,
+    }
+
+
+def format_report(report):
+    u'''
+    Format a report for display in a terminal.
+
+    :param dict report: The report, see :py:func:`get_report`.
+
+    :returns: The lines of the report.
+    :rtype: list
+    '''
+    lines = [u'{:<40} {:>10} {:>12}'.format(u'QUEUE', u'JOBS', u'MEMORY')]
+    for queue in report[u'queues']:
+        lines.append(u'{:<40} {:>10} {:>12}'.format(
+            queue[u'queue'], queue[u'jobs'], format_bytes(queue[u'memory'])))
+    lines.append(u'')
+    lines.append(u'{:<40} {:>10} {:>12}'.format(u'REGISTRY', u'JOBS',
+                                                u'MEMORY'))
+    for registry in report[u'registries']:
+        lines.append(u'{:<40} {:>10} {:>12}'.format(
+            u'{} ({})'.format(registry[u'queue'], registry[u'registry']),
+            registry[u'jobs'], format_bytes(registry[u'memory'])))
+    lines.append(u'')
+    failed_jobs = report[u'failed']
+    lines.append(u'FAILED JOBS: {} using {}, tracebacks {} '
+                 u'(average {})'.format(
+                     failed_jobs[u'jobs'],
+                     format_bytes(failed_jobs[u'memory']),
+                     format_bytes(failed_jobs[u'exc_info']),
+                     format_bytes(failed_jobs[u'exc_info_avg'])))
+    lines.append(u'')
+    lines.append(u'{:<40} {:>10} {:>12}'.format(u'FUNCTION', u'JOBS',
+                                                u'MEMORY'))
+    for function in report[u'functions']:
+        lines.append(u'{:<40} {:>10} {:>12}'.format(
+            function[u'function'] or u'-', function[u'jobs'],
+            format_bytes(function[u'memory'])))
+    lines.append(u'')
+    lines.append(u'LARGEST SAMPLED JOBS')
+    for sample in report[u'largest']:
+        lines.append(u'{} {} {} {} (payload {})'.format(
+            sample[u'id'], sample[u'queue'],
+            sample[u'title'] or sample[u'function'] or u'-',
+            format_bytes(sample[u'memory']), format_bytes(sample[u'data'])))
+    lines.append(u'')
+    lines.append(u'Estimated from {} sampled job(s).'.format(
+        report[u'sampled']))
+    return lines
@@ -2,18 +2,23 @@ import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
 from ckanext.rq.action import (
-    job_list, job_show, job_clear, job_cancel
+    job_list, job_show, job_clear, job_cancel, job_failed_list, job_requeue,
+    job_stats
 )
 from ckanext.rq.auth import (
     job_list as job_list_auth,
     job_show as job_show_auth,
     job_clear as job_clear_auth,
-    job_cancel as job_cancel_auth
+    job_cancel as job_cancel_auth,
+    job_failed_list as job_failed_list_auth,
+    job_requeue as job_requeue_auth,
+    job_stats as job_stats_auth
 )
 
 
 class RqPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IAuthFunctions)
 
@@ -23,6 +28,19 @@ class RqPlugin(plugins.SingletonPlugin):
         toolkit.add_template_directory(config_, 'templates')
         toolkit.add_public_directory(config_, 'public')
         toolkit.add_resource('fanstatic', 'rq')
+        toolkit.add_ckan_admin_tab(config_, 'ckanext_rq_jobs', 'Jobs')
+
+    # IRoutes
+
+    def before_map(self, map):
+        controller = 'ckanext.rq.controller:JobsController'
+        map.connect('ckanext_rq_jobs', '/ckan-admin/jobs',
+                    controller=controller, action='dashboard')
+        map.connect('ckanext_rq_jobs_failed', '/ckan-admin/jobs/failed',
+                    controller=controller, action='failed')
+        map.connect('ckanext_rq_jobs_queue', '/ckan-admin/jobs/queue/{queue}',
+                    controller=controller, action='queue')
+        return map
 
     # IActions
 
@@ -32,6 +50,9 @@ class RqPlugin(plugins.SingletonPlugin):
             'job_show': job_show,
             'job_clear': job_clear,
             'job_cancel': job_cancel,
+            'job_failed_list': job_failed_list,
+            'job_requeue': job_requeue,
+            'job_stats': job_stats,
         }
 
     # IAuthFunctions
@@ -42,4 +63,7 @@ class RqPlugin(plugins.SingletonPlugin):
             'job_show': job_show_auth,
             'job_clear': job_clear_auth,
             'job_cancel': job_cancel_auth,
+            'job_failed_list': job_failed_list_auth,
+            'job_requeue': job_requeue_auth,
+            'job_stats': job_stats_auth,
         }
@@ -0,0 +1,226 @@
+# encoding: utf-8
+
+u'''
+Prefetching of jobs by workers.
+
+Normally a worker goes back to Redis after each job to pop the next one,
+which for jobs that only take milliseconds is a large part of the time
+they spend. With prefetching a worker instead takes up to
+``ckanext.rq.prefetch`` jobs in addition to the one it starts, in a
+single round trip, and starts them one after another without waiting
+for Redis in between::
+
+    # Number of jobs that each worker prefetches. 0 (the default)
+    # disables prefetching.
+    ckanext.rq.prefetch = 10
+
+Prefetched jobs are moved atomically from their queues into a list of
+the worker (``rq:prefetch:<worker name>``, in the Redis instance of
+their queue), from which they are removed once the worker starts them.
+If the worker stops it moves its remaining prefetched jobs back to the
+heads of their queues. If the worker dies then the reaper (see
+:py:mod:`ckanext.rq.reaper`) does that once the worker's heartbeat has
+expired, so prefetched jobs are never lost.
+
+Prefetched jobs are not available to other workers, and jobs that are
+added to a worker's higher-priority queues meanwhile are only started
+after the prefetched ones. Prefetching therefore suits queues with many
+short jobs best.
+'''
+
+from __future__ import absolute_import
+
+from rq.compat import as_text
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+
+PREFETCH_DEFAULT_VALUE = 0
+
+# Set of the workers that have prefetched jobs in a Redis instance
+WORKERS_KEY = u'rq:prefetch'
+
+# Move jobs from queues to the list of prefetched jobs of a worker.
+#
+# KEYS[1]: The list of prefetched jobs of the worker
+# KEYS[2]: The set of workers with prefetched jobs
+# KEYS[3:]: The queues, in the order in which they are emptied
+# ARGV[1]: The name of the worker
+# ARGV[2]: The maximum number of jobs to prefetch
+#
+# Jobs that no longer exist are dropped from their queue. Returns pairs
+# of queue key and job ID.
+_FETCH_SCRIPT = b'''
+    local fetched = {}
+    local count = 0
+    local limit = tonumber(ARGV[2])
+    for i = 3, #KEYS do
+        while count < limit do
+            local id = redis.call('lpop', KEYS[i])
+            if not id then
+                break
+            end
+            if redis.call('exists', 'rq:job:' .. id) == 1 then
+                redis.call('rpush', KEYS[1], id)
+                table.insert(fetched, KEYS[i])
+                table.insert(fetched, id)
+                count = count + 1
+            end
+        end
+    end
+    if count > 0 then
+        redis.call('sadd', KEYS[2], ARGV[1])
+    end
+    return fetched
+'''
+
+# Move prefetched jobs of a worker back to the heads of their queues.
+#
+# KEYS[1]: The list of prefetched jobs of the worker
+# KEYS[2]: The set of workers with prefetched jobs
+# ARGV[1]: The name of the worker
+# ARGV[2:]: The IDs of the jobs, in the order in which they were
+#           prefetched
+#
+# Returns the IDs of the returned jobs.
+_RETURN_SCRIPT = b'''
+    local returned = {}
+    -- Push in reverse so that the jobs keep their order
+    for i = #ARGV, 2, -1 do
+        local id = ARGV[i]
+        if redis.call('lrem', KEYS[1], 1, id) == 1 then
+            local origin = redis.call('hget', 'rq:job:' .. id, 'origin')
+            if origin then
+                local queue_key = 'rq:queue:' .. origin
+                redis.call('sadd', 'rq:queues', queue_key)
+                redis.call('lpush', queue_key, id)
+                table.insert(returned, id)
+            end
+        end
+    end
+    if redis.call('llen', KEYS[1]) == 0 then
+        redis.call('srem', KEYS[2], ARGV[1])
+    end
+    return returned
+'''
+
+# Move the prefetched jobs of workers whose heartbeat has expired back to
+# the heads of their queues.
+#
+# KEYS[1]: The set of workers with prefetched jobs
+# ARGV: The full names of the queues whose jobs are returned
+#
+# Returns the IDs of the returned jobs.
+_REAP_SCRIPT = b'''
+    local origins = {}
+    for _, name in ipairs(ARGV) do
+        origins[name] = true
+    end
+    local returned = {}
+    for _, worker in ipairs(redis.call('smembers', KEYS[1])) do
+        if redis.call('exists', 'rq:heartbeat:' .. worker) == 0 then
+            local key = 'rq:prefetch:' .. worker
+            local ids = redis.call('lrange', key, 0, -1)
+            for i = #ids, 1, -1 do
+                local id = ids[i]
+                local origin = redis.call('hget', 'rq:job:' .. id, 'origin')
+                if not origin then
+                    redis.call('lrem', key, 1, id)
+                elseif origins[origin] then
+                    local queue_key = 'rq:queue:' .. origin
+                    redis.call('lrem', key, 1, id)
+                    redis.call('sadd', 'rq:queues', queue_key)
+                    redis.call('lpush', queue_key, id)
+                    table.insert(returned, id)
+                end
+            end
+            if redis.call('llen', key) == 0 then
+                redis.call('srem', KEYS[1], worker)
+            end
+        end
+    end
+    return returned
+'''
+
+
+def get_prefetch():
+    return int(config.get(u'ckanext.rq.prefetch', PREFETCH_DEFAULT_VALUE))
+
+
+def get_list_key(worker_name):
+    u'''
+    Get the key of the list of a worker's prefetched jobs.
+    '''
+    return u'rq:prefetch:{}'.format(worker_name)
+
+
+def fetch(worker_name, queues, count, connection):
+    u'''
+    Prefetch jobs for a worker.
+
+    :param string worker_name: The name of the worker.
+
+    :param list queues: The ``rq.queue.Queue`` instances to take jobs
+        from, in order of priority. They must all be stored in the same
+        Redis instance.
+
+    :param int count: The maximum number of jobs.
+
+    :param connection: The Redis connection of the queues.
+
+    :returns: Tuples of job ID and queue, in the order in which the jobs
+        should be started.
+    :rtype: list
+    '''
+    by_key = dict((queue.key, queue) for queue in queues)
+    script = connection.register_script(_FETCH_SCRIPT)
+    result = script(keys=[get_list_key(worker_name), WORKERS_KEY] +
+                    [queue.key for queue in queues],
+                    args=[worker_name, count])
+    return [(as_text(id), by_key[as_text(key)])
+            for key, id in zip(result[::2], result[1::2])]
+
+
+def return_jobs(worker_name, ids, connection):
+    u'''
+    Move prefetched jobs of a worker back to their queues.
+
+    Jobs that the worker has started meanwhile are not returned.
+
+    :param string worker_name: The name of the worker.
+
+    :param list ids: The IDs of the jobs, in the order in which they were
+        prefetched. They must all be stored in the same Redis instance.
+
+    :param connection: The Redis connection of the jobs.
+
+    :returns: The IDs of the returned jobs.
+    :rtype: list
+    '''
+    if not ids:
+        return []
+    script = connection.register_script(_RETURN_SCRIPT)
+    result = script(keys=[get_list_key(worker_name), WORKERS_KEY],
+                    args=[worker_name] + list(ids))
+    return [as_text(id) for id in result]
+
+
+def reap(queues, connection):
+    u'''
+    Move the prefetched jobs of dead workers back to their queues.
+
+    :param list queues: The ``rq.queue.Queue`` instances whose jobs are
+        returned. They must all be stored in the same Redis instance.
+
+    :param connection: The Redis connection of the queues.
+
+    :returns: The IDs of the returned jobs.
+    :rtype: list
+    '''
+    script = connection.register_script(_REAP_SCRIPT)
+    result = script(keys=[WORKERS_KEY], args=[q.name for q in queues])
+    return [as_text(id) for id in result]
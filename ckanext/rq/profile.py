@@ -0,0 +1,177 @@
+# encoding: utf-8
+
+u'''
+Profiling of background jobs.
+
+A configurable fraction of all jobs and/or all jobs of certain functions
+can be run under ``cProfile``::
+
+    # Profile 1% of all jobs
+    ckanext.rq.profile_rate = 0.01
+
+    # Profile all jobs of these functions (fully qualified or just the
+    # function name, separated by whitespace)
+    ckanext.rq.profile_functions = ckanext.harvest.queue.gather_callback
+
+The profile of a job is stored under the job's ID, either in a directory
+(``ckanext.rq.profile_dir``, one ``<ID>.prof`` file per job which can be
+loaded via ``pstats``) or, by default, in Redis where it expires after
+``ckanext.rq.profile_ttl`` seconds (7 days by default). A summary can be
+shown via ``paster jobs profile ID``.
+'''
+
+from __future__ import absolute_import
+
+import cProfile
+import logging
+import marshal
+import os
+import pstats
+import random
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+from ckanext.rq.redis import connect_to_redis
+
+
+log = logging.getLogger(__name__)
+
+PROFILE_TTL_DEFAULT_VALUE = 7 * 24 * 60 * 60
+
+
+class _RawStats(object):
+    u'''
+    Wrapper that lets ``pstats.Stats`` load raw profile data.
+    '''
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def get_profile_key(job_id):
+    u'''
+    Get the Redis key of the profile of a job.
+    '''
+    return u'rq:profile:{}'.format(job_id)
+
+
+def _get_profile_path(job_id):
+    profile_dir = config.get(u'ckanext.rq.profile_dir')
+    if not profile_dir:
+        return None
+    return os.path.join(profile_dir, u'{}.prof'.format(job_id))
+
+
+def should_profile(job):
+    u'''
+    Decide whether a job is profiled.
+
+    :param rq.job.Job job: The job.
+
+    :rtype: boolean
+    '''
+    functions = config.get(u'ckanext.rq.profile_functions', u'').split()
+    func_name = job.func_name
+    for name in functions:
+        if func_name == name or func_name.endswith(u'.' + name):
+            return True
+    rate = float(config.get(u'ckanext.rq.profile_rate', 0))
+    return rate > 0 and random.random() < rate
+
+
+def profiled(job):
+    u'''
+    Make a job run under a profiler.
+
+    Replaces the job's ``perform`` method so that only the job itself
+    (and not the worker's bookkeeping) is profiled.
+
+    :param rq.job.Job job: The job.
+
+    :returns: The profiler. Pass it to :py:func:`save` once the job has
+        been performed.
+    :rtype: ``cProfile.Profile``
+    '''
+    profiler = cProfile.Profile()
+    perform = job.perform
+    job.perform = lambda: profiler.runcall(perform)
+    return profiler
+
+
+def save(job_id, profiler, connection=None):
+    u'''
+    Store the profile of a job.
+
+    :param string job_id: The ID of the job.
+
+    :param cProfile.Profile profiler: The profiler the job ran under.
+
+    :param connection: Optional Redis connection.
+    '''
+    profiler.create_stats()
+    data = marshal.dumps(profiler.stats)
+    path = _get_profile_path(job_id)
+    if path:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, u'wb') as f:
+            f.write(data)
+    else:
+        ttl = int(config.get(u'ckanext.rq.profile_ttl',
+                             PROFILE_TTL_DEFAULT_VALUE))
+        connection = connection or connect_to_redis()
+        connection.setex(get_profile_key(job_id), data, ttl)
+    log.debug(u'Stored profile of job {}'.format(job_id))
+
+
+def load(job_id):
+    u'''
+    Load the profile of a job.
+
+    :param string job_id: The ID of the job.
+
+    :returns: The profile or ``None`` if there is no profile for the
+        job.
+    :rtype: ``pstats.Stats``
+    '''
+    path = _get_profile_path(job_id)
+    if path:
+        if not os.path.exists(path):
+            return None
+        with open(path, u'rb') as f:
+            data = f.read()
+    else:
+        data = connect_to_redis().get(get_profile_key(job_id))
+        if data is None:
+            return None
+    return pstats.Stats(_RawStats(marshal.loads(data)))
+
+
+def format_summary(stats, limit=20, sort=u'cumulative'):
+    u'''
+    Format the hot spots of a profile.
+
+    :param pstats.Stats stats: The profile.
+
+    :param int limit: Number of functions to show.
+
+    :param string sort: Sort key (see ``pstats.Stats.sort_stats``).
+
+    :rtype: string
+    '''
+    stream = StringIO()
+    stats.stream = stream
+    stats.strip_dirs().sort_stats(str(sort)).print_stats(limit)
+    return stream.getvalue()
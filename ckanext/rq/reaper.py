@@ -0,0 +1,292 @@
+# encoding: utf-8
+
+u'''
+Recovery of jobs whose worker has died.
+
+If a worker is killed hard (for example because its host went down)
+then the job it was performing stays in the queue's registry of started
+jobs until the job's timeout has passed, and is then merely moved to the
+failed queue.
+
+To detect this much faster, each worker refreshes a heartbeat key with a
+short TTL from a background thread and records its name in the jobs it
+starts. The reaper looks for started jobs whose worker's heartbeat has
+expired and, depending on the policy of the job's queue, requeues them
+(the default) or moves them to the failed queue::
+
+    # TTL of worker heartbeats in seconds
+    ckanext.rq.heartbeat_ttl = 30
+
+    # How often (in seconds) each worker runs the reaper for its queues.
+    # Defaults to the heartbeat TTL, 0 disables reaping in workers.
+    ckanext.rq.reap_interval = 30
+
+    # What to do with orphaned jobs: "requeue" or "fail"
+    ckanext.rq.reap_policy = requeue
+    ckanext.rq.queue.payments.reap_policy = fail
+
+On a sharded setup (see :py:mod:`ckanext.rq.shards`) the heartbeat is
+kept in every shard that the worker listens on, so that the reaper can
+check it atomically next to the jobs.
+
+The reaper can also be run via ``paster jobs reap``. Note that requeued
+jobs may be performed twice if the worker was not actually dead but
+could not refresh its heartbeat, so use ``fail`` for queues whose jobs
+must not run more than once.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from redis import ConnectionPool, Redis
+from rq.compat import as_text
+from rq.job import Job
+from rq.queue import get_failed_queue
+from rq.registry import StartedJobRegistry
+from rq.utils import utcformat, utcnow
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+from ckanext.rq import events, index, prefetch
+from ckanext.rq.shards import group_by_connection
+
+
+log = logging.getLogger(__name__)
+
+HEARTBEAT_TTL_DEFAULT_VALUE = 30
+
+REQUEUE = u'requeue'
+FAIL = u'fail'
+
+# Requeue or fail orphaned jobs.
+#
+# KEYS[1]: The failed queue
+# ARGV[1]: The current time
+# ARGV[2]: The error message for failed jobs
+# ARGV[3:]: Quadruples of job ID, origin, worker name and policy
+#
+# Each job is checked again before it is touched, so a job is never
+# reaped twice and never reaped if its worker has come back.
+_REAP_SCRIPT = b'''
+    local reaped = {}
+    for i = 3, #ARGV, 4 do
+        local id, origin, worker, policy = ARGV[i], ARGV[i + 1],
+                                           ARGV[i + 2], ARGV[i + 3]
+        local job_key = 'rq:job:' .. id
+        local wip_key = 'rq:wip:' .. origin
+        if redis.call('zscore', wip_key, id) and
+                redis.call('exists', 'rq:heartbeat:' .. worker) == 0 and
+                redis.call('hget', job_key, 'worker') == worker then
+            redis.call('zrem', wip_key, id)
+            redis.call('hdel', job_key, 'worker')
+            if policy == 'fail' then
+                redis.call('hmset', job_key, 'status', 'failed',
+                           'ended_at', ARGV[1], 'exc_info', ARGV[2])
+                redis.call('sadd', 'rq:queues', KEYS[1])
+                redis.call('rpush', KEYS[1], id)
+            else
+                local queue_key = 'rq:queue:' .. origin
+                redis.call('hmset', job_key, 'status', 'queued',
+                           'enqueued_at', ARGV[1])
+                redis.call('sadd', 'rq:queues', queue_key)
+                redis.call('rpush', queue_key, id)
+            end
+            table.insert(reaped, id)
+        end
+    end
+    return reaped
+'''
+
+
+class WorkerLost(Exception):
+    u'''
+    Reported for jobs that failed because their worker died.
+    '''
+    pass
+
+
+def get_heartbeat_key(worker_name):
+    u'''
+    Get the key of a worker's heartbeat.
+    '''
+    return u'rq:heartbeat:{}'.format(worker_name)
+
+
+def get_heartbeat_ttl():
+    return int(config.get(u'ckanext.rq.heartbeat_ttl',
+                          HEARTBEAT_TTL_DEFAULT_VALUE))
+
+
+def get_reap_interval():
+    return int(config.get(u'ckanext.rq.reap_interval',
+                          get_heartbeat_ttl()))
+
+
+def get_policy(queue):
+    u'''
+    Get the policy for orphaned jobs of a queue.
+
+    :param string queue: The name of the queue (without prefix).
+
+    :returns: :py:data:`REQUEUE` or :py:data:`FAIL`.
+    '''
+    policy = config.get(u'ckanext.rq.queue.{}.reap_policy'.format(queue),
+                        config.get(u'ckanext.rq.reap_policy', REQUEUE))
+    if policy not in (REQUEUE, FAIL):
+        raise ValueError(u'Invalid reap policy "{}" for queue "{}"'.format(
+                         policy, queue))
+    return policy
+
+
+class Heartbeat(threading.Thread):
+    u'''
+    Background thread that keeps a worker's heartbeat alive.
+
+    The thread uses its own Redis connections, so that it does not
+    interfere with the worker (or its work horses).
+
+    :param string worker_name: The name of the worker.
+
+    :param list connections: The Redis connections in which the
+        heartbeat is kept (duplicates are ignored).
+    '''
+    def __init__(self, worker_name, connections):
+        super(Heartbeat, self).__init__(name=u'heartbeat')
+        self.daemon = True
+        self.key = get_heartbeat_key(worker_name)
+        self.worker_name = worker_name
+        self.ttl = get_heartbeat_ttl()
+        self.connections = []
+        seen = set()
+        for connection in connections:
+            kwargs = connection.connection_pool.connection_kwargs
+            ident = tuple(sorted(kwargs.items()))
+            if ident not in seen:
+                seen.add(ident)
+                self.connections.append(
+                    Redis(connection_pool=ConnectionPool(**kwargs)))
+        self._stopped = threading.Event()
+
+    def beat(self):
+        for connection in self.connections:
+            connection.setex(self.key, self.worker_name, self.ttl)
+
+    def run(self):
+        interval = max(1, self.ttl / 3.0)
+        while not self._stopped.wait(interval):
+            try:
+                self.beat()
+            except Exception:
+                log.exception(u'Could not refresh heartbeat of worker {}'
+                              .format(self.worker_name))
+
+    def start(self):
+        # Make sure the heartbeat exists before the first job is started
+        self.beat()
+        super(Heartbeat, self).start()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        for connection in self.connections:
+            connection.delete(self.key)
+
+
+def find_orphaned_jobs(queues, connection):
+    u'''
+    Find started jobs whose worker's heartbeat has expired.
+
+    Uses three pipelined round trips, independent of the number of jobs.
+    Jobs that were started by workers without heartbeats are ignored.
+
+    :param list queues: The ``rq.queue.Queue`` instances to check. They
+        must all be stored in the same Redis instance.
+
+    :param connection: The Redis connection of the queues.
+
+    :returns: Tuples of job ID, origin and worker name.
+    :rtype: list
+    '''
+    with connection.pipeline(transaction=False) as pipeline:
+        for queue in queues:
+            pipeline.zrange(StartedJobRegistry(queue.name, connection).key,
+                            0, -1)
+        started = []
+        for queue, ids in zip(queues, pipeline.execute()):
+            started.extend((as_text(id), queue.name) for id in ids)
+        if not started:
+            return []
+        for id, origin in started:
+            pipeline.hget(Job.key_for(id), u'worker')
+        workers = [as_text(w) if w else None for w in pipeline.execute()]
+        candidates = [(id, origin, worker) for (id, origin), worker
+                      in zip(started, workers) if worker]
+        names = sorted(set(worker for _, _, worker in candidates))
+        for name in names:
+            pipeline.exists(get_heartbeat_key(name))
+        alive = dict(zip(names, pipeline.execute()))
+    return [c for c in candidates if not alive[c[2]]]
+
+
+def reap(queues):
+    u'''
+    Requeue or fail the orphaned jobs of some queues.
+
+    Jobs that dead workers had prefetched (see
+    :py:mod:`ckanext.rq.prefetch`) are returned to their queues, too.
+
+    :param list queues: The ``rq.queue.Queue`` instances to check.
+
+    :returns: The IDs of the reaped jobs.
+    :rtype: list
+    '''
+    reaped = []
+    for connection, group in group_by_connection(queues):
+        reaped.extend(_reap(group, connection))
+        returned = prefetch.reap(group, connection)
+        if returned:
+            log.warning(u'Returned {} job(s) prefetched by dead workers to '
+                        u'their queues'.format(len(returned)))
+        reaped.extend(returned)
+    return reaped
+
+
+def _reap(queues, connection):
+    # The queues may belong to other CKAN sites (see
+    # ``ckanext.rq.sites``), whose policies are taken from this site.
+    from ckanext.rq.jobs import split_queue_name
+    orphans = find_orphaned_jobs(queues, connection)
+    if not orphans:
+        return []
+    args = [utcformat(utcnow()),
+            u'{}: The worker performing the job has died'.format(
+                WorkerLost.__name__)]
+    policies = {}
+    for id, origin, worker in orphans:
+        policies[id] = get_policy(split_queue_name(origin)[1])
+        args.extend([id, origin, worker, policies[id]])
+    script = connection.register_script(_REAP_SCRIPT)
+    reaped = [as_text(id) for id in script(
+        keys=[get_failed_queue(connection).key], args=args)]
+    requeued = []
+    with connection.pipeline() as pipeline:
+        for id, origin, worker in orphans:
+            if id in reaped:
+                log.warning(u'Reaped job {} from queue "{}" of dead worker '
+                            u'{}'.format(id, split_queue_name(origin)[1],
+                                         worker))
+                if policies[id] != FAIL:
+                    requeued.append(id)
+                    events.publish(pipeline, events.ENQUEUED, id, origin)
+                else:
+                    events.publish(pipeline, events.FAILED, id, origin,
+                                   exc_type=WorkerLost.__name__, retry=0)
+        pipeline.execute()
+    index.index_jobs(requeued, connection)
+    return reaped
@@ -0,0 +1,257 @@
+# encoding: utf-8
+
+u'''
+Reloading of workers without a gap in throughput.
+
+When a worker that was started via ``paster jobs worker`` receives
+``SIGHUP`` it starts a new process of itself (see
+:py:func:`start_worker`) and keeps performing jobs while the new process
+imports CKAN and loads its configuration. Once the new process is ready
+to take jobs it notifies the old one (see :py:func:`signal_ready`), which
+then stops taking jobs, finishes its current job and replaces itself
+with a :py:class:`Reloader`::
+
+    python -m ckanext.rq.reloader PID COMMAND...
+
+The reloader keeps the PID of the original worker, so that process
+supervisors do not notice the reload. It waits for the worker process
+``PID`` and passes ``SIGTERM`` and ``SIGINT`` on to it. On ``SIGHUP`` it
+starts another worker process with ``COMMAND`` in the same way and stops
+the previous one (like on ``SIGTERM``, i.e. after its current job) once
+the new one is ready. The reloader exits with the exit status of its
+worker.
+
+If the new process exits before it is ready (for example because of a
+broken configuration) then the old one simply keeps on working.
+'''
+
+from __future__ import absolute_import
+
+import errno
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+
+log = logging.getLogger(__name__)
+
+# Environment variable in which the PID of the process that is notified
+# by a new worker process once it is ready to take jobs is passed
+NOTIFY_PID_ENV = u'CKANEXT_RQ_NOTIFY_PID'
+
+# Signal with which a new worker process notifies that it is ready
+READY_SIGNAL = signal.SIGUSR1
+
+# Seconds between checks of the worker processes of a reloader
+POLL_INTERVAL = 1
+
+
+def start_worker(command):
+    u'''
+    Start a new worker process that replaces the current process.
+
+    The new process notifies the current process via ``READY_SIGNAL``
+    once it is ready to take jobs, see :py:func:`signal_ready`. It runs in
+    a process group of its own, so that a ``SIGINT`` from the terminal
+    only reaches the current process, which passes it on.
+
+    :param list command: Command line of the new process.
+
+    :returns: The new process.
+    :rtype: subprocess.Popen
+    '''
+    env = dict(os.environ)
+    env[NOTIFY_PID_ENV] = u'{}'.format(os.getpid())
+    log.info(u'Starting new worker process: {}'.format(u' '.join(command)))
+    return subprocess.Popen(command, env=env, close_fds=True,
+                            preexec_fn=os.setpgrp)
+
+
+def signal_ready():
+    u'''
+    Notify the process that started this worker that it is ready.
+
+    Does nothing if this process was not started via
+    :py:func:`start_worker`.
+    '''
+    pid = os.environ.pop(NOTIFY_PID_ENV, None)
+    # If the parent has died in the meantime then we have been adopted
+    # by another process, which must not be signalled
+    if pid is not None and int(pid) == os.getppid():
+        os.kill(int(pid), READY_SIGNAL)
+
+
+def _send_signal(process, signum):
+    u'''
+    Send a signal to a process unless it has already exited.
+    '''
+    if process.poll() is not None:
+        return
+    try:
+        os.kill(process.pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def get_exit_code(returncode):
+    u'''
+    Get the exit code of a shell for a process' return code.
+
+    :param int returncode: Return code of a process as reported by
+        :py:meth:`subprocess.Popen.poll`, i.e. negative if the process
+        was killed by a signal.
+
+    :rtype: int
+    '''
+    if returncode < 0:
+        return 128 - returncode
+    return returncode
+
+
+class _Process(object):
+    u'''
+    A child process that was started by the worker that the reloader
+    has replaced.
+
+    Provides the parts of the interface of :py:class:`subprocess.Popen`
+    that the reloader uses.
+    '''
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                # Already collected
+                pid, status = self.pid, 0
+            if pid:
+                if os.WIFSIGNALED(status):
+                    self.returncode = -os.WTERMSIG(status)
+                else:
+                    self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+
+class Reloader(object):
+    u'''
+    Stand-in for a worker process that has been reloaded.
+
+    :param int pid: PID of the current worker process, which must be a
+        child of this process.
+
+    :param list command: Command line for starting new worker processes.
+    '''
+    def __init__(self, pid, command):
+        self.command = command
+        self.worker = _Process(pid)
+        # Worker process that is being started and whether it is ready
+        self.new_worker = None
+        self.new_worker_ready = False
+        # Previous worker processes that finish their current job
+        self.retiring = []
+        self.returncode = None
+        self._reload_requested = False
+        self._stop_requested = False
+
+    def run(self):
+        u'''
+        Wait until the worker has exited.
+
+        :returns: The return code of the worker.
+        :rtype: int
+        '''
+        self._install_signal_handlers()
+        while self.step():
+            time.sleep(POLL_INTERVAL)
+        return self.returncode
+
+    def _install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(READY_SIGNAL, self.notify_ready)
+
+    def request_stop(self, signum, frame):
+        u'''
+        Signal handler for SIGTERM and SIGINT that passes them on.
+        '''
+        self._stop_requested = True
+        for process in [self.worker, self.new_worker] + self.retiring:
+            if process is not None:
+                _send_signal(process, signum)
+
+    def request_reload(self, signum, frame):
+        u'''
+        Signal handler for SIGHUP that reloads the worker.
+        '''
+        self._reload_requested = True
+
+    def notify_ready(self, signum, frame):
+        u'''
+        Signal handler for ``READY_SIGNAL``.
+        '''
+        self.new_worker_ready = True
+
+    def step(self):
+        u'''
+        Start, replace and collect worker processes as needed.
+
+        :returns: Whether any worker processes are left.
+        :rtype: bool
+        '''
+        if self._reload_requested and not self._stop_requested:
+            self._reload_requested = False
+            if self.new_worker is not None:
+                log.info(u'Ignoring SIGHUP, a new worker process is '
+                         u'already starting')
+            elif self.worker.poll() is None:
+                self.new_worker_ready = False
+                self.new_worker = start_worker(self.command)
+        if self.new_worker is not None:
+            if self.new_worker_ready:
+                log.info(u'Worker process {} is ready, stopping worker '
+                         u'process {}'.format(self.new_worker.pid,
+                                              self.worker.pid))
+                _send_signal(self.worker, signal.SIGTERM)
+                self.retiring.append(self.worker)
+                self.worker = self.new_worker
+                self.new_worker = None
+            elif self.new_worker.poll() is not None:
+                log.error(u'New worker process {} has exited with code {} '
+                          u'before it was ready, keeping worker process {}'
+                          .format(self.new_worker.pid,
+                                  self.new_worker.returncode,
+                                  self.worker.pid))
+                self.new_worker = None
+        self.retiring = [p for p in self.retiring if p.poll() is None]
+        if self.returncode is None and self.worker.poll() is not None:
+            self.returncode = self.worker.returncode
+            log.info(u'Worker process {} has exited with code {}'.format(
+                     self.worker.pid, self.returncode))
+            if self.new_worker is not None:
+                _send_signal(self.new_worker, signal.SIGTERM)
+        return bool(self.returncode is None or self.retiring or
+                    (self.new_worker is not None and
+                     self.new_worker.poll() is None))
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    logging.basicConfig(
+        level=logging.INFO,
+        format=u'%(asctime)s %(levelname)-5.5s [%(name)s] %(message)s')
+    reloader = Reloader(int(args[0]), args[1:])
+    sys.exit(get_exit_code(reloader.run()))
+
+
+if __name__ == u'__main__':
+    main()
@@ -0,0 +1,264 @@
+# encoding: utf-8
+
+u'''
+Automatic retries of failed background jobs.
+
+A job that raises an exception can be retried automatically. Whether and
+how often a job is retried is controlled by a retry policy, which can be
+given when the job is enqueued (see :py:func:`ckanext.rq.jobs.enqueue`)
+or configured per queue::
+
+    # Defaults for all queues
+    ckanext.rq.retry_max_attempts = 3
+    ckanext.rq.retry_backoff = 10
+    ckanext.rq.retry_max_delay = 3600
+    ckanext.rq.retry_jitter = true
+
+    # Overrides for a single queue
+    ckanext.rq.queue.harvest.retry_max_attempts = 5
+
+Retries are delayed by an exponential backoff with (full) jitter, so that
+many jobs failing at the same time (e.g. during an outage) do not all
+retry at the same time. Jobs that wait for their retry are kept in a
+sorted set per queue, scored by the time of their next attempt, instead
+of blocking a worker. Workers move due jobs back to their queues.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import random
+import time
+
+from rq.compat import as_text
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+from paste.deploy.converters import asbool
+
+from ckanext.rq import index
+from ckanext.rq.shards import group_by_connection
+
+
+log = logging.getLogger(__name__)
+
+# Status of jobs that wait for their next attempt
+SCHEDULED = u'scheduled'
+
+# Maximum number of due jobs that are moved to a queue per round trip
+PROMOTE_BATCH_SIZE = 1000
+
+# Move due jobs from delayed sets to their queues.
+#
+# KEYS: Pairs of delayed set and queue
+# ARGV[1]: The current timestamp
+# ARGV[2]: The maximum number of jobs to move per queue
+#
+# Returns the number of moved jobs for each queue and the timestamp at
+# which the next delayed job is due (or an empty string).
+_PROMOTE_SCRIPT = b'''
+    local moved = {}
+    local next_due = nil
+    for i = 1, #KEYS, 2 do
+        local ids = redis.call('zrangebyscore', KEYS[i], '-inf', ARGV[1],
+                               'LIMIT', 0, ARGV[2])
+        for _, id in ipairs(ids) do
+            redis.call('zrem', KEYS[i], id)
+            local job_key = 'rq:job:' .. id
+            if redis.call('exists', job_key) == 1 then
+                redis.call('hset', job_key, 'status', 'queued')
+                redis.call('sadd', 'rq:queues', KEYS[i + 1])
+                redis.call('rpush', KEYS[i + 1], id)
+            end
+        end
+        table.insert(moved, #ids)
+        local head = redis.call('zrange', KEYS[i], 0, 0, 'WITHSCORES')
+        if head[2] then
+            local score = tonumber(head[2])
+            if next_due == nil or score < next_due then
+                next_due = score
+            end
+        end
+    end
+    return {moved, next_due and tostring(next_due) or ''}
+'''
+
+# Delete the jobs in a delayed set and the set itself.
+#
+# KEYS[1]: The delayed set
+_CLEAR_SCRIPT = b'''
+    local ids = redis.call('zrange', KEYS[1], 0, -1)
+    for _, id in ipairs(ids) do
+        redis.call('del', 'rq:job:' .. id, 'rq:job:' .. id .. ':dependents')
+    end
+    redis.call('del', KEYS[1])
+    return #ids
+'''
+
+
+class Retry(object):
+    u'''
+    Retry policy for a background job.
+
+    The delay before attempt ``n + 1`` is ``backoff * 2 ** (n - 1)``
+    seconds, but at most ``max_delay`` seconds. If ``jitter`` is true then
+    the actual delay is chosen randomly between 0 and that value.
+
+    :param int max_attempts: Maximum number of attempts, including the
+        first one. A value of 1 or less disables retries.
+
+    :param int backoff: Delay in seconds before the first retry.
+
+    :param int max_delay: Upper bound for the delay in seconds.
+
+    :param boolean jitter: Whether to randomize the delay.
+    '''
+    def __init__(self, max_attempts, backoff=10, max_delay=3600,
+                 jitter=True):
+        self.max_attempts = int(max_attempts)
+        self.backoff = int(backoff)
+        self.max_delay = int(max_delay)
+        self.jitter = asbool(jitter)
+
+    @classmethod
+    def from_config(cls, queue):
+        u'''
+        Get the configured retry policy of a queue.
+
+        :param string queue: The name of the queue (without prefix).
+
+        :rtype: :py:class:`Retry`
+        '''
+        def get(name, default):
+            return config.get(
+                u'ckanext.rq.queue.{}.{}'.format(queue, name),
+                config.get(u'ckanext.rq.{}'.format(name), default))
+        return cls(get(u'retry_max_attempts', 0),
+                   backoff=get(u'retry_backoff', 10),
+                   max_delay=get(u'retry_max_delay', 3600),
+                   jitter=get(u'retry_jitter', True))
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    def as_dict(self):
+        return {
+            u'max_attempts': self.max_attempts,
+            u'backoff': self.backoff,
+            u'max_delay': self.max_delay,
+            u'jitter': self.jitter,
+        }
+
+    def get_delay(self, attempts):
+        u'''
+        Get the delay before the next attempt.
+
+        :param int attempts: The number of attempts that have been made
+            so far.
+
+        :returns: The delay in seconds.
+        :rtype: float
+        '''
+        delay = min(self.max_delay,
+                    self.backoff * 2 ** max(0, attempts - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def __eq__(self, other):
+        return (isinstance(other, Retry) and
+                self.as_dict() == other.as_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return u'<Retry max_attempts={} backoff={} max_delay={} ' \
+               u'jitter={}>'.format(self.max_attempts, self.backoff,
+                                    self.max_delay, self.jitter)
+
+
+def get_delayed_key(queue_name):
+    u'''
+    Get the key of the sorted set of delayed jobs of a queue.
+
+    :param string queue_name: The full (prefixed) name of the queue.
+    '''
+    return u'rq:delayed:{}'.format(queue_name)
+
+
+def schedule(job, delay, pipeline=None):
+    u'''
+    Schedule a job for a later attempt.
+
+    :param rq.job.Job job: The job.
+
+    :param float delay: Seconds until the job is moved back to its queue.
+
+    :param pipeline: Optional Redis pipeline.
+    '''
+    connection = pipeline if pipeline is not None else job.connection
+    job.set_status(SCHEDULED, pipeline=connection)
+    job.save(pipeline=connection)
+    connection.zadd(get_delayed_key(job.origin),
+                    **{job.id: time.time() + delay})
+    index.add_job(job, connection)
+
+
+def enqueue_due_jobs(queues):
+    u'''
+    Move delayed jobs whose time has come back to their queues.
+
+    :param list queues: The ``rq.queue.Queue`` instances to check.
+
+    :returns: Seconds until the next delayed job of these queues is due
+        or ``None`` if there are no delayed jobs.
+    :rtype: float
+    '''
+    now = time.time()
+    result = None
+    for connection, group in group_by_connection(queues):
+        script = connection.register_script(_PROMOTE_SCRIPT)
+        keys = []
+        for queue in group:
+            keys.extend([get_delayed_key(queue.name), queue.key])
+        moved, next_due = script(keys=keys,
+                                 args=[repr(now), PROMOTE_BATCH_SIZE])
+        for queue, count in zip(group, moved):
+            if count:
+                log.info(u'Moved {} delayed job(s) to queue "{}"'.format(
+                         count, queue.name))
+        if next_due:
+            delay = float(next_due) - now
+            result = delay if result is None else min(result, delay)
+    return result
+
+
+def clear_delayed(queue):
+    u'''
+    Delete all delayed jobs of a queue.
+
+    :param rq.queue.Queue queue: The queue.
+
+    :returns: The number of deleted jobs.
+    :rtype: int
+    '''
+    index.unindex_jobs(get_delayed_job_ids(queue), queue.connection)
+    script = queue.connection.register_script(_CLEAR_SCRIPT)
+    return script(keys=[get_delayed_key(queue.name)])
+
+
+def get_delayed_job_ids(queue):
+    u'''
+    Get the IDs of the delayed jobs of a queue, ordered by due date.
+
+    :param rq.queue.Queue queue: The queue.
+
+    :rtype: list
+    '''
+    return [as_text(id) for id in
+            queue.connection.zrange(get_delayed_key(queue.name), 0, -1)]
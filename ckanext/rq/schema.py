@@ -2,16 +2,74 @@ import ckan.plugins as p
 
 get_validator = p.toolkit.get_validator
 ignore_missing = get_validator('ignore_missing')
+boolean_validator = get_validator('boolean_validator')
 list_of_strings = get_validator('list_of_strings')
+natural_number_validator = get_validator('natural_number_validator')
+isodate = get_validator('isodate')
+
+
+def job_fields_validator(value, context):
+    from ckanext.rq.jobs import JOB_FIELDS
+    for field in value:
+        if field not in JOB_FIELDS:
+            raise p.toolkit.Invalid(u'Unknown job field "{}"'.format(field))
+    return value
 
 
 def job_list_schema():
     return {
         u'queues': [ignore_missing, list_of_strings],
+        u'fields': [ignore_missing, list_of_strings, job_fields_validator],
+        u'limit': [ignore_missing, natural_number_validator],
+        u'offset': [ignore_missing, natural_number_validator],
+        u'q': [ignore_missing, unicode],
+        u'title': [ignore_missing, unicode],
+        u'function': [ignore_missing, unicode],
+        u'since': [ignore_missing, isodate],
+        u'until': [ignore_missing, isodate],
     }
 
 
 def job_clear_schema():
     return {
         u'queues': [ignore_missing, list_of_strings],
+        u'title': [ignore_missing, unicode],
+        u'function': [ignore_missing, unicode],
+        u'min_age': [ignore_missing, natural_number_validator],
+        u'arg': [ignore_missing, unicode],
+    }
+
+
+def job_cancel_schema():
+    return {
+        u'id': [ignore_missing, unicode],
+        u'ids': [ignore_missing, list_of_strings],
+    }
+
+
+def job_failed_list_schema():
+    return {
+        u'queues': [ignore_missing, list_of_strings],
+        u'function': [ignore_missing, unicode],
+        u'exc_type': [ignore_missing, unicode],
+        u'limit': [ignore_missing, natural_number_validator],
+        u'offset': [ignore_missing, natural_number_validator],
+    }
+
+
+def job_requeue_schema():
+    return {
+        u'id': [ignore_missing, unicode],
+        u'ids': [ignore_missing, list_of_strings],
+        u'queues': [ignore_missing, list_of_strings],
+        u'function': [ignore_missing, unicode],
+        u'exc_type': [ignore_missing, unicode],
+        u'all': [ignore_missing, boolean_validator],
+    }
+
+
+def job_stats_schema():
+    return {
+        u'queues': [ignore_missing, list_of_strings],
+        u'window': [ignore_missing, natural_number_validator],
     }
@@ -0,0 +1,195 @@
+# encoding: utf-8
+
+u'''
+Distribution of job queues across several Redis instances.
+
+By default all queues and jobs are stored in the Redis instance given by
+``ckan.redis.url``. To spread the load over several Redis instances
+(shards) list them in ``ckanext.rq.redis_shards``::
+
+    ckanext.rq.redis_shards = redis://redis1:6379/0 redis://redis2:6379/0
+
+Each queue is assigned to a shard by consistent hashing of its name, so
+that adding a shard only moves a small fraction of the queues. The IDs of
+jobs on a sharded setup start with the number of their shard (e.g.
+``s1.0c7f...``), so that jobs can be looked up without knowing their
+queue. Jobs with plain IDs are looked up on the first shard.
+
+Shards are identified by their position in the list, so new shards must
+only ever be appended to the list. When switching from a single Redis
+instance to shards, list the existing instance first. Queues that are
+moved to another shard by adding a shard keep their existing jobs on the
+old shard; these are still listed and can be cleared, but workers only
+listen on the new shard, so let queues drain before adding shards.
+
+Workers, heartbeats and profiles are always stored in ``ckan.redis.url``.
+'''
+
+from __future__ import absolute_import
+
+import bisect
+import hashlib
+import uuid
+
+from redis import ConnectionPool, Redis
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+from ckanext.rq import redis as redis_
+
+
+SHARDS_SETTING_NAME = u'ckanext.rq.redis_shards'
+
+# Number of points per shard on the hash ring
+VIRTUAL_NODES = 100
+
+# Connection pools of the shards, by URL
+_pools = {}
+
+# Hash ring, by shard URLs
+_rings = {}
+
+
+def get_shard_urls():
+    u'''
+    Get the URLs of the configured shards.
+
+    :returns: The URLs or an empty list if sharding is disabled.
+    :rtype: list
+    '''
+    return config.get(SHARDS_SETTING_NAME, u'').split()
+
+
+def is_sharded():
+    u'''
+    Check whether sharding is enabled.
+
+    :rtype: boolean
+    '''
+    return bool(get_shard_urls())
+
+
+def get_shard_count():
+    return max(1, len(get_shard_urls()))
+
+
+def connect_to_shard(index):
+    u'''
+    (Lazily) connect to a shard.
+
+    :param int index: The number of the shard.
+
+    :rtype: ``redis.Redis``
+    '''
+    urls = get_shard_urls()
+    if not urls:
+        return redis_.connect_to_redis()
+    url = urls[index]
+    try:
+        pool = _pools[url]
+    except KeyError:
+        pool = _pools[url] = ConnectionPool.from_url(url)
+    return Redis(connection_pool=pool)
+
+
+def connect_to_all_shards():
+    u'''
+    Connect to all shards.
+
+    :rtype: list of ``redis.Redis``
+    '''
+    return [connect_to_shard(i) for i in range(get_shard_count())]
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode(u'utf-8')).hexdigest()[:8], 16)
+
+
+def _get_ring(count):
+    try:
+        return _rings[count]
+    except KeyError:
+        points = sorted((_hash(u'shard-{}-{}'.format(index, node)), index)
+                        for index in range(count)
+                        for node in range(VIRTUAL_NODES))
+        ring = _rings[count] = ([p[0] for p in points],
+                                [p[1] for p in points])
+        return ring
+
+
+def get_queue_shard(queue_name):
+    u'''
+    Get the shard of a queue.
+
+    :param string queue_name: The full (prefixed) name of the queue.
+
+    :returns: The number of the shard.
+    :rtype: int
+    '''
+    count = get_shard_count()
+    if count == 1:
+        return 0
+    hashes, indexes = _get_ring(count)
+    position = bisect.bisect(hashes, _hash(queue_name)) % len(hashes)
+    return indexes[position]
+
+
+def get_job_shard(job_id):
+    u'''
+    Get the shard of a job.
+
+    :param string job_id: The ID of the job.
+
+    :returns: The number of the shard.
+    :rtype: int
+    '''
+    if job_id.startswith(u's') and u'.' in job_id:
+        try:
+            index = int(job_id[1:job_id.index(u'.')])
+        except ValueError:
+            return 0
+        if index < get_shard_count():
+            return index
+    return 0
+
+
+def new_job_id(index):
+    u'''
+    Create the ID for a new job.
+
+    :param int index: The number of the job's shard.
+
+    :returns: The ID or ``None`` (to let RQ create one) if sharding is
+        disabled.
+    :rtype: string
+    '''
+    if not is_sharded():
+        return None
+    return u's{}.{}'.format(index, uuid.uuid4())
+
+
+def group_by_connection(queues):
+    u'''
+    Group queues by the Redis instance they are stored in.
+
+    :param list queues: ``rq.queue.Queue`` instances.
+
+    :returns: Tuples of connection and list of queues, in the order in
+        which the connections first appear in ``queues``.
+    :rtype: list
+    '''
+    groups = []
+    by_pool = {}
+    for queue in queues:
+        pool = getattr(queue.connection, u'connection_pool',
+                       queue.connection)
+        try:
+            by_pool[id(pool)][1].append(queue)
+        except KeyError:
+            group = by_pool[id(pool)] = (queue.connection, [queue])
+            groups.append(group)
+    return groups
@@ -0,0 +1,117 @@
+# encoding: utf-8
+
+u'''
+Workers that serve several CKAN sites.
+
+The queues of a CKAN site are prefixed with its site ID, so a normal
+worker only performs the jobs of the site whose configuration it has
+loaded. A :py:class:`MultiSiteWorker` listens on the queues of several
+sites that share the same Redis instance (or shards, see
+:py:mod:`ckanext.rq.shards`) instead, so that one pool of workers can
+serve all of them::
+
+    paster jobs worker --site /etc/ckan/a.ini --site /etc/ckan/b.ini
+
+Each site's configuration file is parsed once and cached. The work horse
+of each job then switches to the configuration of the job's site and
+loads that site's environment (plugins, database, ...), just like a
+normal worker loads the environment of its own site for every job.
+Settings of queues (for example retry policies or resource limits) are
+therefore taken from the job's site, while settings of the worker itself
+(for example the heartbeat TTL) are taken from the configuration the
+worker was started with.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import os
+
+from paste.deploy import appconfig
+from rq.utils import ensure_list
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+from ckan.config.environment import load_environment
+
+from ckanext.rq import jobs, shards
+from ckanext.rq.redis import REDIS_URL_SETTING_NAME, REDIS_URL_DEFAULT_VALUE
+
+
+log = logging.getLogger(__name__)
+
+# Parsed configurations of CKAN sites, by path of their config file. Do
+# not use this directly, use ``load_site_config`` instead.
+_site_configs = {}
+
+# Settings that must be the same for all sites served by a worker
+_SHARED_SETTINGS = [
+    (REDIS_URL_SETTING_NAME, REDIS_URL_DEFAULT_VALUE),
+    (shards.SHARDS_SETTING_NAME, u''),
+]
+
+
+def load_site_config(path):
+    u'''
+    (Lazily) parse the configuration file of a CKAN site.
+
+    :param string path: Path of the configuration file.
+
+    :returns: The configuration, with the attributes ``global_conf`` and
+        ``local_conf`` as expected by ``load_environment``.
+    '''
+    path = os.path.abspath(path)
+    try:
+        return _site_configs[path]
+    except KeyError:
+        log.debug(u'Loading configuration of CKAN site from {}'.format(path))
+        site_config = _site_configs[path] = appconfig(u'config:' + path)
+        return site_config
+
+
+class MultiSiteWorker(jobs.Worker):
+    u'''
+    Worker that performs the jobs of several CKAN sites.
+
+    :param list sites: Paths of the configuration files of the sites.
+
+    :param queues: The name(s) of the queue(s) to listen on, for each of
+        the sites. If not given then the default queue is used.
+
+    Accepts the other arguments of :py:class:`ckanext.rq.jobs.Worker`.
+
+    :raises ValueError: if the sites do not share the Redis instance of
+        the worker or if a site is given more than once.
+    '''
+    def __init__(self, sites, queues=None, *args, **kwargs):
+        self.sites = {}
+        for path in sites:
+            site_config = load_site_config(path)
+            site_id = site_config[u'ckan.site_id']
+            if site_id in self.sites:
+                raise ValueError(u'Site "{}" is given more than once'.format(
+                                 site_id))
+            for key, default in _SHARED_SETTINGS:
+                if site_config.get(key, default) != config.get(key, default):
+                    raise ValueError(
+                        u'Site "{}" uses a different value for "{}"'.format(
+                            site_id, key))
+            self.sites[site_id] = path
+        names = ensure_list(queues or [jobs.DEFAULT_QUEUE_NAME])
+        rq_queues = [jobs.get_queue(name, site_id)
+                     for site_id in sorted(self.sites) for name in names]
+        super(MultiSiteWorker, self).__init__(rq_queues, *args, **kwargs)
+
+    def _queue_label(self, name):
+        return u'{}/{}'.format(*jobs.split_queue_name(name))
+
+    def load_job_environment(self, job):
+        site_id = jobs.split_queue_name(job.origin)[0]
+        site_config = load_site_config(self.sites[site_id])
+        config.clear()
+        config.update(site_config)
+        load_environment(site_config.global_conf, site_config.local_conf)
@@ -0,0 +1,261 @@
+# encoding: utf-8
+
+u'''
+Local disk spool for background jobs.
+
+If Redis cannot be reached while a job is enqueued then the job is
+appended to a SQLite journal on the local disk instead of being lost.
+Once Redis is available again the spooled jobs are replayed into their
+queues in batches, in the order in which they were spooled: by workers on
+the same host, by ``paster jobs spool replay`` and, a batch at a time, by
+the next enqueued jobs. Jobs that are enqueued while older jobs are still
+spooled are spooled behind them, so that jobs reach their queues in the
+order in which they were enqueued. Whether there are spooled jobs is
+checked via the modification times of the spool files, so the spool is
+only opened after a job has been spooled.
+
+The spool is disabled unless ``ckanext.rq.spool_path`` is set. All
+processes on a host that use the same path share the same spool.
+'''
+
+import logging
+import os
+import sqlite3
+
+from rq.job import Job, dumps, loads
+from rq.queue import Queue
+
+from ckanext.rq import events, index, shards, stats
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+
+
+log = logging.getLogger(__name__)
+
+SPOOL_PATH_SETTING_NAME = u'ckanext.rq.spool_path'
+
+# Number of jobs that are moved from the spool to Redis per round trip
+BATCH_SIZE = 500
+
+_SCHEMA = u'''
+    CREATE TABLE IF NOT EXISTS jobs (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id TEXT UNIQUE NOT NULL,
+        queue TEXT NOT NULL,
+        data BLOB NOT NULL
+    )
+'''
+
+# Modification times and sizes of spool files when they were last found
+# empty, by path of the spool
+_empty_states = {}
+
+
+def get_spool_path():
+    u'''
+    Get the path of the spool file.
+
+    :returns: The path or ``None`` if the spool is disabled.
+    :rtype: string
+    '''
+    return config.get(SPOOL_PATH_SETTING_NAME) or None
+
+
+def is_enabled():
+    u'''
+    Check whether the spool is enabled.
+
+    :rtype: boolean
+    '''
+    return get_spool_path() is not None
+
+
+def _get_file_state(path):
+    u'''
+    Get the modification times and sizes of the files of a spool.
+    '''
+    state = []
+    for file_path in [path, path + u'-wal']:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            state.append(None)
+        else:
+            state.append((stat.st_mtime, stat.st_size))
+    return state
+
+
+def may_have_jobs():
+    u'''
+    Check cheaply whether there may be spooled jobs.
+
+    Unlike :py:func:`pending` this does not open the spool but only
+    checks whether its files have changed since it was last found empty.
+
+    :rtype: boolean
+    '''
+    if not is_enabled():
+        return False
+    path = get_spool_path()
+    if not os.path.exists(path):
+        return False
+    return _empty_states.get(path) != _get_file_state(path)
+
+
+def _connect(create=True):
+    u'''
+    Open the spool database.
+
+    A new connection is opened for each operation so that the spool can
+    safely be used from forked processes and multiple threads.
+
+    :param boolean create: Whether to create the spool file if it does
+        not exist yet.
+
+    :returns: The connection or ``None`` if the spool does not exist
+        and ``create`` is false.
+    '''
+    path = get_spool_path()
+    if not create and not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute(u'PRAGMA journal_mode=WAL')
+    conn.execute(u'PRAGMA synchronous=NORMAL')
+    conn.execute(_SCHEMA)
+    return conn
+
+
+def append(job):
+    u'''
+    Append a job to the spool.
+
+    The job must have been created but not saved to Redis. Its ID and
+    origin queue are kept, so the job can be looked up under the same ID
+    once it has been replayed.
+
+    :param rq.job.Job job: The job to spool.
+    '''
+    conn = _connect()
+    try:
+        conn.execute(
+            u'INSERT OR IGNORE INTO jobs (id, queue, data) VALUES (?, ?, ?)',
+            (job.id, job.origin, sqlite3.Binary(dumps(job.to_dict()))))
+    finally:
+        conn.close()
+    _empty_states.pop(get_spool_path(), None)
+
+
+def pending():
+    u'''
+    Get the number of spooled jobs.
+
+    :rtype: int
+    '''
+    if not is_enabled():
+        return 0
+    conn = _connect(create=False)
+    if conn is None:
+        return 0
+    try:
+        count = conn.execute(u'SELECT COUNT(*) FROM jobs').fetchone()[0]
+    finally:
+        conn.close()
+    if not count:
+        _empty_states[get_spool_path()] = _get_file_state(get_spool_path())
+    return count
+
+
+def _push_rows(redis_conn, rows):
+    u'''
+    Push spooled jobs of a single shard to Redis.
+
+    :returns: The number of jobs that were added to Redis.
+    '''
+    count = 0
+    with redis_conn.pipeline() as pipeline:
+        for row in rows:
+            pipeline.exists(Job.key_for(row[1]))
+        exists = pipeline.execute()
+        for row, job_exists in zip(rows, exists):
+            if job_exists:
+                log.debug(u'Spooled job {} is already in Redis'.format(
+                          row[1]))
+                continue
+            queue_key = Queue.redis_queue_namespace_prefix + row[2]
+            obj = loads(bytes(row[3]))
+            pipeline.sadd(Queue.redis_queues_keys, queue_key)
+            pipeline.hmset(Job.key_for(row[1]), obj)
+            pipeline.rpush(queue_key, row[1])
+            stats.count(row[2], stats.ENQUEUED, pipeline)
+            index.add_job_hash(row[1], obj, pipeline)
+            events.publish(pipeline, events.ENQUEUED, row[1], row[2])
+            count += 1
+        pipeline.execute()
+    return count
+
+
+def replay(batch_size=None, max_batches=None):
+    u'''
+    Move the spooled jobs into their Redis queues.
+
+    Jobs are replayed in batches. Each batch is locked in the spool
+    while it is pushed to Redis and only removed from the spool once
+    Redis has accepted it. Jobs whose ID already exists in Redis (for
+    example because a previous replay was interrupted) are skipped, so
+    replaying never duplicates a job.
+
+    :param int batch_size: Number of jobs per batch. Defaults to
+        :py:data:`BATCH_SIZE`.
+
+    :param int max_batches: Maximum number of batches. The remaining jobs
+        stay in the spool. By default all jobs are replayed.
+
+    :returns: The number of jobs that were added to Redis.
+    :rtype: int
+
+    :raises redis.exceptions.ConnectionError: if Redis is not available.
+    '''
+    if not is_enabled():
+        return 0
+    conn = _connect(create=False)
+    if conn is None:
+        return 0
+    batch_size = batch_size or BATCH_SIZE
+    count = 0
+    batches = 0
+    empty = False
+    try:
+        while max_batches is None or batches < max_batches:
+            batches += 1
+            conn.execute(u'BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(
+                    u'SELECT seq, id, queue, data FROM jobs ORDER BY seq '
+                    u'LIMIT ?', (batch_size,)).fetchall()
+                if not rows:
+                    conn.execute(u'COMMIT')
+                    empty = True
+                    break
+                by_shard = {}
+                for row in rows:
+                    by_shard.setdefault(shards.get_job_shard(row[1]),
+                                        []).append(row)
+                for shard, shard_rows in sorted(by_shard.items()):
+                    count += _push_rows(shards.connect_to_shard(shard),
+                                        shard_rows)
+                conn.execute(u'DELETE FROM jobs WHERE seq <= ?',
+                             (rows[-1][0],))
+                conn.execute(u'COMMIT')
+            except Exception:
+                conn.execute(u'ROLLBACK')
+                raise
+    finally:
+        conn.close()
+    if empty:
+        _empty_states[get_spool_path()] = _get_file_state(get_spool_path())
+    if count:
+        log.info(u'Replayed {} spooled background job(s)'.format(count))
+    return count
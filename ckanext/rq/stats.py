@@ -0,0 +1,197 @@
+# encoding: utf-8
+
+u'''
+Throughput statistics of background job queues.
+
+For each queue the number of enqueued and finished (successfully or not)
+jobs is counted per minute in Redis. Together with the current length of
+a queue this gives its arrival rate, its drain rate and an estimate of
+how long it will take until the queue is empty. The counters expire
+after :py:data:`COUNTER_TTL` seconds.
+'''
+
+from __future__ import absolute_import
+
+import time
+
+from rq.registry import StartedJobRegistry
+
+from ckanext.rq.shards import group_by_connection
+
+# Lifetime of the per-minute counters in seconds
+COUNTER_TTL = 60 * 60
+
+# Default number of minutes over which rates are averaged
+DEFAULT_WINDOW = 5
+
+ENQUEUED = u'enqueued'
+FINISHED = u'finished'
+
+
+def get_counter_key(queue_name, minute):
+    u'''
+    Get the key of the counters of a queue for a minute.
+
+    :param string queue_name: The full (prefixed) name of the queue.
+
+    :param int minute: Minutes since the epoch.
+    '''
+    return u'rq:stats:{}:{}'.format(queue_name, minute)
+
+
+def count(queue_name, field, pipeline, amount=1):
+    u'''
+    Add the commands for incrementing a counter to a pipeline.
+
+    :param string queue_name: The full (prefixed) name of the queue.
+
+    :param string field: :py:data:`ENQUEUED` or :py:data:`FINISHED`.
+
+    :param pipeline: The Redis pipeline.
+    '''
+    key = get_counter_key(queue_name, int(time.time() // 60))
+    pipeline.hincrby(key, field, amount)
+    pipeline.expire(key, COUNTER_TTL)
+
+
+def get_minutes(window=DEFAULT_WINDOW):
+    u'''
+    Get the minutes over which rates are averaged.
+
+    :param int window: Number of past minutes. The current minute is
+        included in addition.
+
+    :returns: Tuple of the list of minutes (since the epoch) and the
+        length of the averaging period in minutes.
+    '''
+    now = time.time()
+    minute = int(now // 60)
+    minutes = list(range(minute - window, minute + 1))
+    period = window + (now % 60) / 60.0
+    return minutes, period
+
+
+def add_stats_commands(queue, minutes, pipeline):
+    u'''
+    Add the commands for reading the statistics of a queue to a pipeline.
+
+    :param rq.queue.Queue queue: The queue.
+
+    :param list minutes: The minutes, see :py:func:`get_minutes`.
+
+    :param pipeline: A Redis pipeline for the queue's Redis instance.
+
+    :returns: The number of added commands.
+    :rtype: int
+    '''
+    pipeline.llen(queue.key)
+    pipeline.zcard(StartedJobRegistry(queue.name, queue.connection).key)
+    for m in minutes:
+        pipeline.hmget(get_counter_key(queue.name, m), [ENQUEUED, FINISHED])
+    return 2 + len(minutes)
+
+
+def parse_stats(queue, values, period):
+    u'''
+    Compute the statistics of a queue.
+
+    :param rq.queue.Queue queue: The queue.
+
+    :param list values: The results of the commands added by
+        :py:func:`add_stats_commands`.
+
+    :param float period: The averaging period, see
+        :py:func:`get_minutes`.
+
+    :returns: The statistics, see :py:func:`get_queue_stats`.
+    :rtype: dict
+    '''
+    depth, running = values[0], values[1]
+    enqueued = sum(int(c[0] or 0) for c in values[2:])
+    finished = sum(int(c[1] or 0) for c in values[2:])
+    arrival_rate = enqueued / period
+    drain_rate = finished / period
+    if depth == 0:
+        drain_time = 0
+    elif drain_rate > arrival_rate:
+        drain_time = int(depth / (drain_rate - arrival_rate) * 60)
+    else:
+        drain_time = None
+    return {
+        u'name': queue.name,
+        u'depth': depth,
+        u'running': running,
+        u'arrival_rate': round(arrival_rate, 2),
+        u'drain_rate': round(drain_rate, 2),
+        u'drain_time': drain_time,
+    }
+
+
+def get_queue_stats(queues, window=DEFAULT_WINDOW):
+    u'''
+    Get the statistics of queues.
+
+    Uses a single pipelined round trip for all queues (per shard, see
+    :py:mod:`ckanext.rq.shards`).
+
+    :param list queues: The ``rq.queue.Queue`` instances.
+
+    :param int window: Number of past minutes over which rates are
+        averaged. The current minute is included in addition.
+
+    :returns: For each queue a dict with the number of queued jobs
+        (``depth``), the number of jobs currently being performed
+        (``running``), the numbers of enqueued and finished jobs per
+        minute (``arrival_rate`` and ``drain_rate``) and the estimated
+        number of seconds until the queue is empty (``drain_time``,
+        ``None`` if the queue is not shrinking).
+    :rtype: list
+    '''
+    minutes, period = get_minutes(window)
+    results = {}
+    for connection, group in group_by_connection(queues):
+        with connection.pipeline(transaction=False) as pipeline:
+            counts = [add_stats_commands(queue, minutes, pipeline)
+                      for queue in group]
+            values = pipeline.execute()
+        start = 0
+        for queue, count in zip(group, counts):
+            results[id(queue)] = parse_stats(
+                queue, values[start:start + count], period)
+            start += count
+    return [results[id(queue)] for queue in queues]
+
+
+def get_history(queues, minutes=60):
+    u'''
+    Get the number of enqueued and finished jobs per minute.
+
+    Uses a single pipelined round trip (per shard).
+
+    :param list queues: The ``rq.queue.Queue`` instances. Their counters
+        are added up.
+
+    :param int minutes: Number of past minutes, at most
+        ``COUNTER_TTL / 60``. The current minute is included in addition.
+
+    :returns: For each minute, starting with the oldest one, a dict with
+        the ``minute`` (since the epoch) and the numbers of ``enqueued``
+        and ``finished`` jobs.
+    :rtype: list
+    '''
+    now = int(time.time() // 60)
+    history = [{u'minute': m, u'enqueued': 0, u'finished': 0}
+               for m in range(now - minutes, now + 1)]
+    for connection, group in group_by_connection(queues):
+        with connection.pipeline(transaction=False) as pipeline:
+            for queue in group:
+                for entry in history:
+                    pipeline.hmget(get_counter_key(queue.name,
+                                                   entry[u'minute']),
+                                   [ENQUEUED, FINISHED])
+            values = pipeline.execute()
+        for i, (enqueued, finished) in enumerate(values):
+            entry = history[i % len(history)]
+            entry[u'enqueued'] += int(enqueued or 0)
+            entry[u'finished'] += int(finished or 0)
+    return history
@@ -39,6 +39,13 @@ def changed_config(key, value):
         config.update(_original_config)
 
 
+def failing_job(*args):
+    u'''
+    A background job that fails.
+    '''
+    raise RuntimeError(u'JOB FAILURE')
+
+
 class RQTestBase(object):
     '''
     Base class for tests of RQ functionality.
@@ -53,6 +60,12 @@ class RQTestBase(object):
             queue.empty()
             redis_conn.srem(rq.Queue.redis_queues_keys, queue._key)
             redis_conn.delete(queue._key)
+        for pattern in [u'rq:delayed:*', u'rq:wip:*', u'rq:heartbeat:*',
+                        u'rq:stats:*', u'rq:dashboard:*', u'rq:index:*',
+                        u'rq:finished:*', u'rq:gc:*', u'rq:cache:*',
+                        u'rq:events:*', u'rq:prefetch*', u'rq:slots:*']:
+            for key in redis_conn.keys(pattern):
+                redis_conn.delete(key)
 
     def all_jobs(self):
         u'''
@@ -2,17 +2,22 @@ import re
 import nose
 import datetime
 
+import mock
+
 from nose.tools import eq_ as eq, ok_ as ok, assert_raises, raises
 
-from ckantoolkit import ObjectNotFound
+from ckantoolkit import ObjectNotFound, ValidationError
 from ckantoolkit.tests import helpers
 try:
     from ckan.tests.helpers import call_action
 except ImportError:
     from ckanext.rq.tests.helpers import call_action
 
-from ckanext.rq.tests.helpers import FunctionalRQTestBase, recorded_logs
-from ckanext.rq import jobs
+from ckanext.rq.tests.helpers import (
+    failing_job, FunctionalRQTestBase, recorded_logs
+)
+from ckanext.rq import index, jobs
+from ckanext.rq.redis import connect_to_redis
 
 
 class TestJobList(FunctionalRQTestBase):
@@ -43,6 +48,48 @@ class TestJobList(FunctionalRQTestBase):
         eq(len(jobs), 3)
         eq({job[u'id'] for job in jobs}, {job2.id, job3.id, job4.id})
 
+    def test_filters(self):
+        '''
+        Test finding jobs via the job indexes.
+        '''
+        self.enqueue(title=u'Harvest source 1')
+        job2 = self.enqueue(title=u'Harvest source 2', queue=u'q1')
+        job3 = self.enqueue(title=u'Harvest source 3', queue=u'q1')
+        jobs = call_action(u'job_list', q=u'harvest source', offset=1,
+                           queues=[u'q1'])
+        eq([job[u'id'] for job in jobs], [job3.id])
+        jobs = call_action(u'job_list', q=u'harvest', title=u'* 2')
+        eq([job[u'id'] for job in jobs], [job2.id])
+        jobs = call_action(u'job_list', function=u'test_job', limit=2)
+        eq(len(jobs), 2)
+
+    def test_limit_and_offset(self):
+        '''
+        Test getting a page of jobs.
+        '''
+        ids = [self.enqueue(queue=u'q1').id for _ in range(3)]
+        jobs = call_action(u'job_list', queues=[u'q1'], limit=1, offset=1)
+        eq([job[u'id'] for job in jobs], ids[1:2])
+        jobs = call_action(u'job_list', queues=[u'q1'], offset=1)
+        eq([job[u'id'] for job in jobs], ids[1:])
+
+    def test_fields(self):
+        '''
+        Test getting additional job attributes.
+        '''
+        self.enqueue(title=u'Title')
+        job = call_action(u'job_list', fields=[u'status', u'meta'])[0]
+        eq(job[u'status'], u'queued')
+        eq(job[u'meta'], {u'title': u'Title'})
+        ok(u'worker' not in job)
+
+    @raises(ValidationError)
+    def test_unknown_field(self):
+        '''
+        Test requesting an unknown job attribute.
+        '''
+        call_action(u'job_list', fields=[u'foo'])
+
 
 class TestJobShow(FunctionalRQTestBase):
 
@@ -59,6 +106,20 @@ class TestJobShow(FunctionalRQTestBase):
         now = datetime.datetime.utcnow()
         ok(abs((now - dt).total_seconds()) < 10)
 
+    def test_performed_job(self):
+        '''
+        Test showing a job that has been performed.
+        '''
+        job = self.enqueue(failing_job)
+        jobs.Worker(name=u'show-worker').work(burst=True)
+        d = call_action(u'job_show', id=job.id)
+        eq(d[u'status'], u'failed')
+        eq(d[u'worker'], u'show-worker')
+        ok(d[u'started'] <= d[u'ended'])
+        ok(d[u'duration'] >= 0)
+        ok(u'JOB FAILURE' in d[u'exc_info'])
+        ok(u'timings' in d)
+
     @nose.tools.raises(ObjectNotFound)
     def test_not_existing_job(self):
         '''
@@ -81,6 +142,9 @@ class TestJobClear(FunctionalRQTestBase):
         eq({jobs.DEFAULT_QUEUE_NAME, u'q'}, set(queues))
         all_jobs = self.all_jobs()
         eq(len(all_jobs), 0)
+        key = index.get_index_key(jobs.add_queue_name_prefix(u''),
+                                  u'created')
+        eq(connect_to_redis().zcard(key), 0)
 
     def test_specific_queues(self):
         '''
@@ -99,6 +163,24 @@ class TestJobClear(FunctionalRQTestBase):
         logs.assert_log(u'info', u'q1')
         logs.assert_log(u'info', u'q2')
 
+    def test_filters(self):
+        '''
+        Test clearing only the jobs that match filters.
+        '''
+        job1 = self.enqueue(title=u'Harvest source 1')
+        job2 = self.enqueue(title=u'Update index')
+        job3 = self.enqueue(jobs.test_job, [u'foo'], title=u'Harvest 2')
+        job4 = self.enqueue(failing_job, [u'foo'])
+        queues = call_action(u'job_clear', title=u'Harvest*', arg=u'foo')
+        eq(queues, [jobs.DEFAULT_QUEUE_NAME])
+        eq([job.id for job in self.all_jobs()], [job1.id, job2.id, job4.id])
+        call_action(u'job_clear', function=u'failing_job')
+        eq([job.id for job in self.all_jobs()], [job1.id, job2.id])
+        call_action(u'job_clear', min_age=3600)
+        eq(len(self.all_jobs()), 2)
+        call_action(u'job_clear', min_age=0)
+        eq(len(self.all_jobs()), 0)
+
 
 class TestJobCancel(FunctionalRQTestBase):
 
@@ -119,3 +201,105 @@ class TestJobCancel(FunctionalRQTestBase):
     @raises(ObjectNotFound)
     def test_not_existing_job(self):
         call_action(u'job_cancel', id=u'does-not-exist')
+
+    def test_multiple_jobs(self):
+        '''
+        Test cancelling several jobs at once.
+        '''
+        job1 = self.enqueue(queue=u'q1')
+        job2 = self.enqueue(queue=u'q1')
+        job3 = self.enqueue(queue=u'q2')
+        cancelled = call_action(u'job_cancel',
+                                ids=[job1.id, job3.id, u'does-not-exist'])
+        eq(cancelled, [job1.id, job3.id])
+        eq(self.all_jobs(), [job2])
+
+
+class FailedJobsTestBase(FunctionalRQTestBase):
+
+    def fail(self, *args, **kwargs):
+        u'''
+        Enqueue a failing job and run it.
+        '''
+        job = self.enqueue(failing_job, *args, **kwargs)
+        jobs.Worker([kwargs.get(u'queue', jobs.DEFAULT_QUEUE_NAME)]).work(
+            burst=True)
+        return job
+
+
+class TestJobFailedList(FailedJobsTestBase):
+
+    def test_all_queues(self):
+        job1 = self.fail()
+        job2 = self.fail(queue=u'q')
+        failed = call_action(u'job_failed_list')
+        eq([job[u'id'] for job in failed], [job1.id, job2.id])
+        eq(failed[0][u'exc_type'], u'RuntimeError')
+        eq(failed[0][u'function'], u'ckanext.rq.tests.helpers.failing_job')
+        eq(failed[1][u'queue'], u'q')
+
+    def test_filters(self):
+        job1 = self.fail(queue=u'q1')
+        self.fail(queue=u'q2')
+        failed = call_action(u'job_failed_list', queues=[u'q1'])
+        eq([job[u'id'] for job in failed], [job1.id])
+        eq(call_action(u'job_failed_list', function=u'failing_job',
+                       exc_type=u'RuntimeError', queues=[u'q1']), failed)
+        eq(call_action(u'job_failed_list', exc_type=u'KeyError'), [])
+
+    def test_pagination(self):
+        failed_jobs = [self.fail() for _ in range(5)]
+        failed = call_action(u'job_failed_list', offset=1, limit=2)
+        eq([job[u'id'] for job in failed],
+           [job.id for job in failed_jobs[1:3]])
+
+
+class TestJobRequeue(FailedJobsTestBase):
+
+    def test_single_job(self):
+        job1 = self.fail()
+        job2 = self.fail()
+        eq(call_action(u'job_requeue', id=job1.id), [job1.id])
+        eq([job[u'id'] for job in call_action(u'job_failed_list')],
+           [job2.id])
+        eq(jobs.get_queue().job_ids, [job1.id])
+        eq(jobs.job_from_id(job1.id).get_status(), u'queued')
+
+    @raises(ObjectNotFound)
+    def test_not_failed_job(self):
+        job = self.enqueue()
+        call_action(u'job_requeue', id=job.id)
+
+    def test_filter(self):
+        job1 = self.fail(queue=u'q1')
+        job2 = self.fail(queue=u'q2')
+        job3 = self.fail(queue=u'q1')
+        requeued = call_action(u'job_requeue', queues=[u'q1'])
+        eq(requeued, [job1.id, job3.id])
+        eq(jobs.get_queue(u'q1').job_ids, [job1.id, job3.id])
+        eq([job[u'id'] for job in call_action(u'job_failed_list')],
+           [job2.id])
+
+    @raises(ValidationError)
+    def test_no_ids_and_no_filters(self):
+        self.fail()
+        call_action(u'job_requeue')
+
+    def test_empty_ids(self):
+        failed_job = self.fail()
+        eq(call_action(u'job_requeue', ids=[]), [])
+        eq([job[u'id'] for job in call_action(u'job_failed_list')],
+           [failed_job.id])
+
+    def test_ids_are_sent_in_batches(self):
+        failed_jobs = [self.fail() for _ in range(5)]
+        ids = [job.id for job in failed_jobs]
+        with mock.patch(u'ckanext.rq.failed.REQUEUE_BATCH_SIZE', 2):
+            eq(call_action(u'job_requeue', ids=ids[::-1]), ids)
+        eq(call_action(u'job_failed_list'), [])
+
+    def test_all(self):
+        job1 = self.fail(queue=u'q1')
+        job2 = self.fail(queue=u'q2')
+        eq(call_action(u'job_requeue', all=True), [job1.id, job2.id])
+        eq(call_action(u'job_failed_list'), [])
@@ -0,0 +1,148 @@
+# encoding: utf-8
+
+import os
+import time
+
+from nose.tools import assert_equal, assert_not_equal
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import stats
+from ckanext.rq.autoscale import (Autoscaler, count_workers,
+                                  get_desired_workers)
+
+try:
+    from ckan.tests.helpers import call_action
+except ImportError:
+    from ckanext.rq.tests.helpers import call_action
+
+from ckanext.rq.tests.helpers import RQTestBase
+
+
+def sleeping_job(seconds):
+    time.sleep(seconds)
+
+
+def _stats(depth=0, running=0, arrival_rate=0, drain_rate=0):
+    return {
+        u'depth': depth,
+        u'running': running,
+        u'arrival_rate': arrival_rate,
+        u'drain_rate': drain_rate,
+    }
+
+
+class TestGetDesiredWorkers(object):
+
+    def test_empty_queue(self):
+        assert_equal(get_desired_workers([_stats()], 3, 1, 8), 1)
+
+    def test_running_jobs_keep_their_workers(self):
+        assert_equal(get_desired_workers([_stats(running=2)], 3, 0, 8), 2)
+
+    def test_grow_without_throughput_data(self):
+        assert_equal(get_desired_workers([_stats(depth=100)], 2, 1, 8), 3)
+
+    def test_backlog(self):
+        # 2 workers perform 10 jobs per minute, 30 jobs per minute are
+        # needed to drain 100 jobs in 5 minutes while 10 new jobs arrive
+        # per minute.
+        s = _stats(depth=100, arrival_rate=10, drain_rate=10)
+        assert_equal(get_desired_workers([s], 2, 1, 8, drain_time=300), 6)
+
+    def test_other_workers(self):
+        # 2 local and 3 other workers perform 10 jobs per minute, 30 jobs
+        # per minute are needed, so 15 workers, 12 of them local
+        s = _stats(depth=100, arrival_rate=10, drain_rate=10)
+        assert_equal(get_desired_workers([s], 2, 1, 20, drain_time=300,
+                                         others=3), 12)
+        # Running jobs of other workers need no local workers
+        assert_equal(get_desired_workers([_stats(running=2)], 3, 0, 8,
+                                         others=2), 0)
+
+    def test_limits(self):
+        s = _stats(depth=10000, arrival_rate=10, drain_rate=10)
+        assert_equal(get_desired_workers([s, s], 2, 1, 8), 8)
+        assert_equal(get_desired_workers([_stats()], 2, 2, 8), 2)
+
+
+class TestJobStats(RQTestBase):
+
+    def test_job_stats(self):
+        self.enqueue()
+        self.enqueue(queue=u'q')
+        self.enqueue(queue=u'q')
+        results = call_action(u'job_stats', queues=[u'q'])
+        assert_equal(len(results), 1)
+        assert_equal(results[0][u'name'], u'q')
+        assert_equal(results[0][u'depth'], 2)
+        assert_equal(results[0][u'running'], 0)
+        assert_equal(results[0][u'drain_time'], None)
+        assert results[0][u'arrival_rate'] > 0
+
+    def test_drain_rate(self):
+        for _ in range(3):
+            self.enqueue()
+        jobs.Worker().work(burst=True)
+        queue = jobs.get_queue()
+        result = stats.get_queue_stats([queue])[0]
+        assert_equal(result[u'depth'], 0)
+        assert_equal(result[u'drain_time'], 0)
+        assert_equal(result[u'drain_rate'], result[u'arrival_rate'])
+
+    def test_drain_time(self):
+        queue = jobs.get_queue()
+        with queue.connection.pipeline() as pipeline:
+            stats.count(queue.name, stats.FINISHED, pipeline, 600)
+            pipeline.execute()
+        self.enqueue()
+        result = stats.get_queue_stats([queue])[0]
+        assert result[u'drain_time'] is not None
+        assert result[u'drain_time'] < 60
+
+
+class TestAutoscaler(RQTestBase):
+
+    def test_scale_and_stop(self):
+        autoscaler = Autoscaler(min_workers=1, max_workers=2)
+        try:
+            assert_equal(autoscaler.scale(), 1)
+            for _ in range(3):
+                self.enqueue()
+            assert_equal(autoscaler.scale(), 2)
+            # Wait for the workers to drain the queue
+            deadline = time.time() + 30
+            while jobs.get_queue().count and time.time() < deadline:
+                time.sleep(0.2)
+            assert_equal(jobs.get_queue().count, 0)
+        finally:
+            autoscaler.stop()
+        assert_equal(autoscaler.workers, [])
+        assert_equal(autoscaler.retiring, [])
+
+    def test_count_workers(self):
+        worker = jobs.Worker([u'q'], name=u'other-worker')
+        worker.register_birth()
+        try:
+            assert_equal(count_workers([jobs.get_queue(u'q')]), 1)
+            assert_equal(count_workers([jobs.get_queue(u'q')],
+                                       [u'other-worker']), 0)
+            assert_equal(count_workers([jobs.get_queue()]), 0)
+        finally:
+            worker.register_death()
+
+    def test_worker_finishes_job_when_retired(self):
+        autoscaler = Autoscaler(min_workers=1, max_workers=1)
+        job = self.enqueue(sleeping_job, [2])
+        try:
+            autoscaler.scale()
+            deadline = time.time() + 30
+            while (job.get_status() != u'started' and
+                    time.time() < deadline):
+                time.sleep(0.1)
+            assert_equal(job.get_status(), u'started')
+            # The worker does not get SIGINT from the terminal
+            process = autoscaler.workers[0]
+            assert_not_equal(os.getpgid(process.pid), os.getpgrp())
+        finally:
+            autoscaler.stop()
+        assert_equal(job.get_status(), u'finished')
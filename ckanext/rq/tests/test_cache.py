@@ -0,0 +1,115 @@
+# encoding: utf-8
+
+import datetime
+import time
+
+from nose.tools import assert_equal, assert_not_equal, ok_, raises
+from rq.job import JobStatus
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import cache
+from ckanext.rq.redis import connect_to_redis
+
+from ckanext.rq.tests.helpers import changed_config, RQTestBase
+
+
+def adding_job(a, b=0):
+    return a + b
+
+
+class TestJobHash(object):
+
+    def test_canonical_arguments(self):
+        assert_equal(
+            cache.get_job_hash(u'f', (1, 2), {u'x': {u'a': 1, u'b': 2}}),
+            cache.get_job_hash(u'f', [1, 2], {u'x': {u'b': 2, u'a': 1}}))
+        assert_equal(cache.get_job_hash(u'f', [set([3, 1, 2])], {}),
+                     cache.get_job_hash(u'f', [set([2, 3, 1])], {}))
+
+    def test_different_jobs(self):
+        hashes = set([cache.get_job_hash(u'f', [1], {}),
+                      cache.get_job_hash(u'g', [1], {}),
+                      cache.get_job_hash(u'f', [2], {}),
+                      cache.get_job_hash(u'f', [], {u'a': 1})])
+        assert_equal(len(hashes), 4)
+
+    def test_dates(self):
+        assert_not_equal(
+            cache.get_job_hash(u'f', [datetime.date(2000, 1, 1)], {}),
+            cache.get_job_hash(u'f', [datetime.date(2000, 1, 2)], {}))
+
+    @raises(TypeError)
+    def test_unsupported_argument(self):
+        cache.get_job_hash(u'f', [object()], {})
+
+
+class TestCache(RQTestBase):
+
+    def test_cached_result(self):
+        job = jobs.enqueue(adding_job, [1], {u'b': 2}, cache_ttl=60)
+        jobs.Worker().work(burst=True)
+        job = jobs.enqueue(adding_job, [1], {u'b': 2}, cache_ttl=60)
+        assert_equal(job.get_status(), JobStatus.FINISHED)
+        assert_equal(job.result, 3)
+        ok_(job.meta[u'cached'])
+        assert_equal(jobs.get_queue().job_ids, [])
+        job = jobs.job_from_id(job.id)
+        assert_equal(job.result, 3)
+
+    def test_different_arguments_are_not_cached(self):
+        jobs.enqueue(adding_job, [1], cache_ttl=60)
+        jobs.Worker().work(burst=True)
+        job = jobs.enqueue(adding_job, [2], cache_ttl=60)
+        assert_equal(job.get_status(), JobStatus.QUEUED)
+
+    def test_jobs_are_not_cached_by_default(self):
+        jobs.enqueue(adding_job, [1])
+        jobs.Worker().work(burst=True)
+        job = jobs.enqueue(adding_job, [1], cache_ttl=60)
+        assert_equal(job.get_status(), JobStatus.QUEUED)
+        job = jobs.enqueue(adding_job, [1])
+        assert_equal(job.get_status(), JobStatus.QUEUED)
+
+    def test_failures_are_not_cached(self):
+        jobs.enqueue(adding_job, [1, u'x'], cache_ttl=60)
+        jobs.Worker().work(burst=True)
+        job = jobs.enqueue(adding_job, [1, u'x'], cache_ttl=60)
+        assert_equal(job.get_status(), JobStatus.QUEUED)
+
+    def test_ttl(self):
+        job = jobs.enqueue(adding_job, [1], cache_ttl=60)
+        jobs.Worker().work(burst=True)
+        ttl = connect_to_redis().ttl(job.meta[u'cache_key'])
+        ok_(0 < ttl <= 60)
+
+    def test_least_recently_used_results_are_evicted(self):
+        redis_conn = connect_to_redis()
+        keys = [cache.get_cache_key(jobs.add_queue_name_prefix(u''), i)
+                for i in u'abc']
+        with changed_config(u'ckanext.rq.cache_max_entries', u'2'):
+            cache.store(keys[0], 0, 60, redis_conn)
+            time.sleep(0.01)
+            cache.store(keys[1], 1, 60, redis_conn)
+            time.sleep(0.01)
+            assert_equal(cache.get(keys[0], redis_conn), (True, 0))
+            time.sleep(0.01)
+            cache.store(keys[2], 2, 60, redis_conn)
+        assert_equal(cache.get(keys[0], redis_conn), (True, 0))
+        assert_equal(cache.get(keys[1], redis_conn), (False, None))
+        assert_equal(cache.get(keys[2], redis_conn), (True, 2))
+
+    def test_many_entries_are_evicted_at_once(self):
+        redis_conn = connect_to_redis()
+        prefix = jobs.add_queue_name_prefix(u'')
+        lru_key = cache.get_cache_key(prefix, u'lru')
+        keys = [cache.get_cache_key(prefix, i) for i in range(10000)]
+        with redis_conn.pipeline() as pipeline:
+            for i, key in enumerate(keys):
+                pipeline.set(key, u'')
+                pipeline.zadd(lru_key, **{key: i})
+            pipeline.execute()
+        key = cache.get_cache_key(prefix, u'new')
+        with changed_config(u'ckanext.rq.cache_max_entries', u'1'):
+            cache.store(key, 1, 60, redis_conn)
+        assert_equal(redis_conn.zrange(lru_key, 0, -1), [key])
+        assert_equal(redis_conn.exists(keys[-1]), False)
@@ -0,0 +1,79 @@
+# encoding: utf-8
+
+from nose.tools import assert_equal, assert_raises
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import cancel, index, retry
+from ckanext.rq.redis import connect_to_redis
+
+from ckanext.rq.tests.helpers import RQTestBase
+
+
+class TestCancelJobs(RQTestBase):
+
+    def test_batches(self):
+        ids = [self.enqueue().id for _ in range(10)]
+        original_batch_size = cancel.CANCEL_BATCH_SIZE
+        cancel.CANCEL_BATCH_SIZE = 3
+        try:
+            cancelled = cancel.cancel_jobs(ids[::2])
+        finally:
+            cancel.CANCEL_BATCH_SIZE = original_batch_size
+        assert_equal(cancelled, ids[::2])
+        assert_equal(jobs.get_queue().job_ids, ids[1::2])
+        assert_raises(KeyError, jobs.job_from_id, ids[0])
+
+    def test_delayed_job(self):
+        job = self.enqueue()
+        jobs.get_queue().remove(job)
+        retry.schedule(job, 3600)
+        assert_equal(cancel.cancel_jobs([job.id]), [job.id])
+        assert_equal(retry.get_delayed_job_ids(jobs.get_queue()), [])
+
+    def test_cancelled_jobs_are_unindexed(self):
+        job = self.enqueue(title=u'Cancelled')
+        assert_equal(cancel.cancel_jobs([job.id]), [job.id])
+        key = index.get_index_key(jobs.add_queue_name_prefix(u''),
+                                  u'title:cancelled')
+        assert_equal(connect_to_redis().zcard(key), 0)
+
+    def test_other_site(self):
+        job = jobs.get_queue(site_id=u'other-site').enqueue(jobs.test_job)
+        assert_equal(cancel.cancel_jobs([job.id]), [])
+        assert_equal(jobs.get_queue(site_id=u'other-site').job_ids, [job.id])
+
+
+class TestClearJobs(RQTestBase):
+
+    def test_pages(self):
+        ids = [self.enqueue(jobs.test_job, [i % 3]).id for i in range(10)]
+        original_page_size = jobs.PAGE_SIZE
+        jobs.PAGE_SIZE = 2
+        try:
+            assert_equal(cancel.clear_jobs(jobs.DEFAULT_QUEUE_NAME, arg=0), 4)
+        finally:
+            jobs.PAGE_SIZE = original_page_size
+        assert_equal(jobs.get_queue().job_ids,
+                     [id for i, id in enumerate(ids) if i % 3])
+
+    def test_dequeued_while_clearing(self):
+        ids = [self.enqueue(jobs.test_job, [i % 2]).id for i in range(10)]
+        queue = jobs.get_queue()
+        original_lrange = queue.connection.lrange
+
+        def lrange(*args):
+            # Simulate a worker that dequeues two jobs before each page
+            queue.connection.lpop(queue.key)
+            queue.connection.lpop(queue.key)
+            return original_lrange(*args)
+
+        original_page_size = jobs.PAGE_SIZE
+        jobs.PAGE_SIZE = 3
+        queue.connection.lrange = lrange
+        try:
+            cancel.clear_jobs(jobs.DEFAULT_QUEUE_NAME, arg=1)
+        finally:
+            del queue.connection.lrange
+            jobs.PAGE_SIZE = original_page_size
+        remaining = queue.job_ids
+        assert_equal([id for id in remaining if ids.index(id) % 2], [])
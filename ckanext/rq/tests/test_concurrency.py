@@ -0,0 +1,101 @@
+# encoding: utf-8
+
+import time
+
+from nose.tools import assert_equal, ok_
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import concurrency, retry
+from ckanext.rq.redis import connect_to_redis
+
+from ckanext.rq.tests.helpers import changed_config, RQTestBase
+
+
+QUEUE_LIMIT = u'ckanext.rq.queue.limited.max_concurrency'
+FUNCTION_LIMIT = u'ckanext.rq.function.ckanext.rq.jobs.test_job.' \
+                 u'max_concurrency'
+
+
+class TestConcurrency(RQTestBase):
+
+    def get_slots(self, name):
+        key = concurrency.get_slots_key(name)
+        return connect_to_redis().zrange(key, 0, -1)
+
+    def take_slot(self, queue=u'limited'):
+        job = self.enqueue(queue=queue)
+        jobs.get_queue(queue).remove(job.id)
+        ok_(concurrency.acquire(job, concurrency.get_job_slots(job), 60))
+        return job
+
+    def test_job_slots(self):
+        job = self.enqueue(queue=u'limited')
+        assert_equal(concurrency.get_job_slots(job), [])
+        with changed_config(QUEUE_LIMIT, u'2'):
+            with changed_config(FUNCTION_LIMIT, u'1'):
+                slots = concurrency.get_job_slots(job)
+        assert_equal(slots, [
+            (u'rq:slots:' + job.origin, 2),
+            (u'rq:slots:' + jobs.add_queue_name_prefix(
+                u'function:ckanext.rq.jobs.test_job'), 1)])
+
+    def test_jobs_take_slots_up_to_limit(self):
+        with changed_config(QUEUE_LIMIT, u'2'):
+            first = self.take_slot()
+            second = self.take_slot()
+            third = self.enqueue(queue=u'limited')
+            slots = concurrency.get_job_slots(third)
+            ok_(not concurrency.acquire(third, slots, 60))
+            assert_equal(sorted(self.get_slots(first.origin)),
+                         sorted([first.id, second.id]))
+            concurrency.release(first.id, slots)
+            ok_(concurrency.acquire(third, slots, 60))
+
+    def test_slots_are_taken_all_or_none(self):
+        with changed_config(QUEUE_LIMIT, u'2'):
+            with changed_config(FUNCTION_LIMIT, u'1'):
+                self.take_slot(queue=u'other')
+                other = self.enqueue(queue=u'limited')
+                ok_(not concurrency.acquire(
+                    other, concurrency.get_job_slots(other), 60))
+        assert_equal(self.get_slots(other.origin), [])
+
+    def test_expired_slots_are_free(self):
+        with changed_config(QUEUE_LIMIT, u'1'):
+            job = self.enqueue(queue=u'limited')
+            key = concurrency.get_slots_key(job.origin)
+            connect_to_redis().zadd(key, expired=time.time() - 1)
+            queue = jobs.get_queue(u'limited')
+            limits = concurrency.get_queue_limits([queue])
+            assert_equal(limits, {queue.name: 1})
+            assert_equal(concurrency.get_full_queues(limits), set())
+            ok_(concurrency.acquire(job, concurrency.get_job_slots(job), 60))
+        assert_equal(self.get_slots(job.origin), [job.id])
+
+    def test_worker_skips_full_queues(self):
+        with changed_config(QUEUE_LIMIT, u'1'):
+            self.take_slot()
+            self.enqueue(queue=u'limited')
+            job = self.enqueue()
+            worker = jobs.Worker([u'limited', jobs.DEFAULT_QUEUE_NAME])
+            result = worker.dequeue_job_and_maintain_ttl(None)
+            assert_equal(result[0].id, job.id)
+            ok_(worker.dequeue_job_and_maintain_ttl(None) is None)
+        assert_equal(len(jobs.get_queue(u'limited').job_ids), 1)
+
+    def test_worker_defers_jobs_of_full_functions(self):
+        with changed_config(FUNCTION_LIMIT, u'1'):
+            self.take_slot(queue=u'other')
+            job = self.enqueue()
+            worker = jobs.Worker()
+            ok_(worker.dequeue_job_and_maintain_ttl(None) is None)
+        job = jobs.job_from_id(job.id)
+        assert_equal(job.get_status(), retry.SCHEDULED)
+        assert_equal(retry.get_delayed_job_ids(jobs.get_queue()), [job.id])
+
+    def test_worker_releases_slots(self):
+        with changed_config(QUEUE_LIMIT, u'1'):
+            job = self.enqueue(queue=u'limited')
+            jobs.Worker([u'limited']).work(burst=True)
+            assert_equal(self.all_jobs(), [])
+        assert_equal(self.get_slots(job.origin), [])
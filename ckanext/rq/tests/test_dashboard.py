@@ -0,0 +1,53 @@
+# encoding: utf-8
+
+import json
+
+import mock
+from nose.tools import assert_equal, ok_
+
+from ckanext.rq import dashboard
+from ckanext.rq.redis import connect_to_redis
+
+from ckanext.rq.tests.helpers import changed_config, RQTestBase
+
+
+class TestDashboard(RQTestBase):
+
+    def test_build_snapshot(self):
+        self.enqueue(queue=u'q1')
+        snapshot = dashboard.build_snapshot()
+        assert_equal([q[u'name'] for q in snapshot[u'queues']], [u'q1'])
+        assert_equal(len(snapshot[u'history']),
+                     dashboard.HISTORY_MINUTES + 1)
+        assert_equal(snapshot[u'history'][-1][u'enqueued'], 1)
+        assert_equal(json.loads(json.dumps(snapshot)), snapshot)
+
+    def test_snapshot_is_cached(self):
+        self.enqueue(queue=u'q1')
+        first = dashboard.get_snapshot()
+        self.enqueue(queue=u'q1')
+        with mock.patch.object(dashboard, u'build_snapshot') as build:
+            second = dashboard.get_snapshot()
+        assert_equal(build.call_count, 0)
+        assert_equal(second, first)
+
+    def test_outdated_snapshot_is_rebuilt(self):
+        dashboard.get_snapshot()
+        self.enqueue(queue=u'q1')
+        with changed_config(u'ckanext.rq.dashboard_cache_ttl', u'0'):
+            snapshot = dashboard.get_snapshot()
+        assert_equal([q[u'depth'] for q in snapshot[u'queues']], [1])
+
+    def test_outdated_snapshot_is_served_while_rebuilding(self):
+        old = dashboard.build_snapshot()
+        old[u'created'] -= 3600
+        connection = connect_to_redis()
+        connection.set(dashboard.get_cache_key(), json.dumps(old))
+        connection.set(dashboard.get_cache_key() + u':lock', 1)
+        with mock.patch.object(dashboard, u'build_snapshot') as build:
+            snapshot = dashboard.get_snapshot()
+        assert_equal(build.call_count, 0)
+        assert_equal(snapshot, old)
+        connection.delete(dashboard.get_cache_key() + u':lock')
+        snapshot = dashboard.get_snapshot()
+        ok_(snapshot[u'created'] > old[u'created'])
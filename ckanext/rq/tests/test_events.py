@@ -0,0 +1,76 @@
+# encoding: utf-8
+
+import datetime
+import itertools
+
+from nose.tools import assert_equal, ok_
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import events
+
+from ckanext.rq.tests.helpers import (
+    changed_config, failing_job, RQTestBase
+)
+
+
+class TestEvents(RQTestBase):
+
+    def setup(self):
+        super(TestEvents, self).setup()
+        self._max_length = changed_config(u'ckanext.rq.events_max_length',
+                                          u'100')
+        self._max_length.__enter__()
+
+    def teardown(self):
+        self._max_length.__exit__(None, None, None)
+
+    def test_lifecycle(self):
+        job = self.enqueue(queue=u'my_queue')
+        jobs.Worker([u'my_queue']).work(burst=True)
+        all_events = list(events.iter_events())
+        assert_equal([e[u'event'] for e in all_events],
+                     [events.ENQUEUED, events.STARTED, events.FINISHED])
+        for event in all_events:
+            assert_equal(event[u'job'], job.id)
+            assert_equal(event[u'queue'], u'my_queue')
+        ok_(all_events[1][u'wait'] >= 0)
+        ok_(all_events[1][u'worker'])
+        ok_(all_events[2][u'duration'] >= 0)
+
+    def test_failed(self):
+        self.enqueue(failing_job)
+        jobs.Worker().work(burst=True)
+        event = list(events.iter_events())[-1]
+        assert_equal(event[u'event'], events.FAILED)
+        assert_equal(event[u'exc_type'], u'RuntimeError')
+        assert_equal(event[u'retry'], u'0')
+
+    def test_since(self):
+        first = self.enqueue()
+        second = self.enqueue()
+        all_events = list(events.iter_events())
+        assert_equal([e[u'job'] for e in all_events], [first.id, second.id])
+        later = list(events.iter_events(since=all_events[0][u'id']))
+        assert_equal([e[u'job'] for e in later], [second.id])
+        since = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        assert_equal(list(events.iter_events(
+            since=events.get_event_id(since))), [])
+
+    def test_follow(self):
+        self.enqueue()
+        self.enqueue()
+        followed = events.iter_events(since=u'0-0', follow=True)
+        assert_equal(len(list(itertools.islice(followed, 2))), 2)
+        jobs.Worker().work(burst=True)
+        assert_equal(next(followed)[u'event'], events.STARTED)
+
+    def test_disabled(self):
+        with changed_config(u'ckanext.rq.events_max_length', u'0'):
+            self.enqueue()
+        assert_equal(list(events.iter_events()), [])
+
+    def test_capped(self):
+        with changed_config(u'ckanext.rq.events_max_length', u'1'):
+            for _ in range(300):
+                self.enqueue()
+        ok_(len(list(events.iter_events())) < 300)
@@ -0,0 +1,238 @@
+# encoding: utf-8
+
+import time
+
+import mock
+from ckantoolkit import config
+from nose.tools import assert_equal, ok_
+from rq.job import Job
+from rq.queue import Queue
+from rq.registry import StartedJobRegistry
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import garbage, index, prefetch
+from ckanext.rq.redis import connect_to_redis
+
+from ckanext.rq.tests.helpers import changed_config, RQTestBase
+
+
+class TestGarbage(RQTestBase):
+
+    def age(self, job):
+        u'''
+        Make a job look old.
+        '''
+        job.connection.hset(job.key, u'created_at', u'2000-01-01T00:00:00Z')
+
+    def exists(self, key):
+        return connect_to_redis().exists(key)
+
+    def test_job_that_is_not_enqueued_is_collected(self):
+        job = self.enqueue()
+        self.age(job)
+        jobs.get_queue().connection.lrem(jobs.get_queue().key, job.id)
+        result = garbage.collect()
+        ok_(result[u'jobs'] >= 1)
+        ok_(result[u'complete'])
+        ok_(not self.exists(job.key))
+
+    def test_enqueued_job_is_kept(self):
+        job = self.enqueue()
+        self.age(job)
+        garbage.collect()
+        ok_(self.exists(job.key))
+        assert_equal(jobs.get_queue().job_ids, [job.id])
+
+    def test_new_job_is_kept(self):
+        job = self.enqueue()
+        jobs.get_queue().connection.lrem(jobs.get_queue().key, job.id)
+        garbage.collect()
+        ok_(self.exists(job.key))
+
+    def test_started_job_is_kept(self):
+        job = self.enqueue()
+        self.age(job)
+        job = jobs.get_queue().dequeue()
+        jobs.Worker(name=u'gc-worker').prepare_job_execution(job)
+        garbage.collect()
+        ok_(self.exists(job.key))
+
+    def test_prefetched_job_is_kept(self):
+        job = self.enqueue()
+        self.age(job)
+        queue = jobs.get_queue()
+        prefetch.fetch(u'gc-worker', [queue], 1, queue.connection)
+        assert_equal(queue.job_ids, [])
+        garbage.collect()
+        ok_(self.exists(job.key))
+
+    def test_dry_run(self):
+        job = self.enqueue()
+        self.age(job)
+        jobs.get_queue().connection.lrem(jobs.get_queue().key, job.id)
+        result = garbage.collect(dry_run=True)
+        ok_(result[u'jobs'] >= 1)
+        ok_(result[u'memory'] > 0)
+        ok_(self.exists(job.key))
+
+    def test_registry_entries_of_deleted_jobs_are_removed(self):
+        job = self.enqueue()
+        job = jobs.get_queue().dequeue()
+        jobs.Worker(name=u'gc-worker').prepare_job_execution(job)
+        job.delete()
+        garbage.collect()
+        registry = StartedJobRegistry(jobs.get_queue().name,
+                                      connect_to_redis())
+        assert_equal(registry.get_job_ids(), [])
+
+    def test_dependents_of_deleted_jobs_are_deleted(self):
+        redis_conn = connect_to_redis()
+        key = Job.dependents_key_for(u'does-not-exist')
+        redis_conn.sadd(key, u'some-job')
+        garbage.collect()
+        ok_(not redis_conn.exists(key))
+
+    def test_other_sites(self):
+        queue = jobs.get_queue(site_id=u'other-site')
+        other_job = queue.enqueue(jobs.test_job)
+        job = self.enqueue()
+        garbage.collect()
+        ok_(self.exists(other_job.key))
+        with changed_config(u'ckanext.rq.gc_sites', config[u'ckan.site_id']):
+            result = garbage.collect()
+        assert_equal(jobs.get_queue().job_ids, [job.id])
+        ok_(result[u'keys'] >= 1)
+        ok_(not self.exists(other_job.key))
+        ok_(not self.exists(queue.key))
+
+    def test_time_budget(self):
+        redis_conn = connect_to_redis()
+        with changed_config(u'ckanext.rq.gc_interval', u'3600'):
+            with changed_config(u'ckanext.rq.gc_time_budget', u'0'):
+                ok_(garbage.collect_if_due() is not None)
+                # Not due again before the interval has passed
+                ok_(garbage.collect_if_due() is None)
+        ok_(redis_conn.exists(garbage.get_state_key(u'cursor')))
+
+    def test_failed_queue_is_pruned_within_time_budget(self):
+        redis_conn = connect_to_redis()
+        key = Queue.redis_queue_namespace_prefix + u'failed'
+        job = self.enqueue()
+        redis_conn.rpush(key, u'deleted-1', job.id, u'deleted-2')
+        positions_key = garbage.get_state_key(u'positions')
+        original_page_size = garbage.PAGE_SIZE
+        garbage.PAGE_SIZE = 1
+        try:
+            collection = garbage._Collection(redis_conn, False,
+                                             {u'entries': 0})
+            collection.deadline = 0
+            ok_(not collection.prune(key, is_list=True))
+            assert_equal(redis_conn.hget(positions_key, key), b'0')
+            redis_conn.hset(positions_key, key, 1)
+            collection.deadline = time.time() + 60
+            ok_(collection.prune(key, is_list=True))
+        finally:
+            garbage.PAGE_SIZE = original_page_size
+        # Continued at the saved position
+        assert_equal(redis_conn.lrange(key, 0, -1),
+                     [b'deleted-1', job.id.encode(u'ascii')])
+        garbage.collect()
+        assert_equal(redis_conn.lrange(key, 0, -1),
+                     [job.id.encode(u'ascii')])
+        ok_(not redis_conn.exists(positions_key))
+
+    def test_registry_is_pruned_within_time_budget(self):
+        redis_conn = connect_to_redis()
+        ids = [self.enqueue().id for _ in range(3)]
+        redis_conn.delete(Job.key_for(ids[0]), Job.key_for(ids[2]))
+        key = index.get_index_key(jobs.add_queue_name_prefix(u''),
+                                  u'created')
+        positions_key = garbage.get_state_key(u'positions')
+        collection = garbage._Collection(redis_conn, False, {u'entries': 0})
+        collection.deadline = 0
+        ok_(not collection.prune(key))
+        assert_equal(redis_conn.hget(positions_key, key), b'0')
+        assert_equal(redis_conn.zcard(key), 3)
+        # The next run continues with the registry before scanning
+        collection = garbage._Collection(redis_conn, False, {u'entries': 0})
+        with mock.patch.object(collection, u'collect_keys') as collect_keys:
+            collection.run(time.time() + 60)
+        ok_(collect_keys.called)
+        assert_equal(redis_conn.zrange(key, 0, -1),
+                     [ids[1].encode(u'ascii')])
+        ok_(not redis_conn.exists(positions_key))
+
+    def test_suspected_job_is_deleted_after_walk(self):
+        job = self.enqueue()
+        self.age(job)
+        queue = jobs.get_queue()
+        queue.connection.lrem(queue.key, job.id)
+        collection = garbage._Collection(connect_to_redis(), False,
+                                         {u'jobs': 0, u'memory': 0})
+        collection.collect_jobs([job.id])
+        ok_(self.exists(job.key))
+        ok_(collection.walk_lists())
+        assert_equal(collection.result[u'jobs'], 1)
+        ok_(not self.exists(job.key))
+        ok_(not self.exists(garbage.get_suspects_key(queue.key)))
+
+    def test_walk_is_continued(self):
+        ids = [self.enqueue().id for _ in range(7)]
+        queue = jobs.get_queue()
+        for id in ids:
+            self.age(jobs.job_from_id(id))
+        # ids[5] is stale, the others are queued
+        queue.connection.lrem(queue.key, ids[5])
+        redis_conn = connect_to_redis()
+        original_page_size = garbage.WALK_PAGE_SIZE
+        garbage.WALK_PAGE_SIZE = 2
+        try:
+            collection = garbage._Collection(redis_conn, False,
+                                             {u'jobs': 0, u'memory': 0})
+            collection.collect_jobs(ids)
+            with mock.patch.object(collection, u'is_overdue',
+                                   side_effect=[False, True]):
+                ok_(not collection.walk_lists())
+            # A worker takes jobs, another job is enqueued and a job that
+            # has already been walked goes missing
+            worker = jobs.Worker(name=u'gc-worker')
+            worker.prepare_job_execution(queue.dequeue())
+            worker.prepare_job_execution(queue.dequeue())
+            new_job = self.enqueue()
+            queue.connection.lrem(queue.key, ids[6])
+            collection.collect_jobs([ids[6]])
+            collection = garbage._Collection(redis_conn, False,
+                                             {u'jobs': 0, u'memory': 0})
+            ok_(collection.walk_lists())
+        finally:
+            garbage.WALK_PAGE_SIZE = original_page_size
+        assert_equal(collection.result[u'jobs'], 1)
+        ok_(not self.exists(Job.key_for(ids[5])))
+        # ids[6] was suspected during the walk, so it is only deleted by
+        # the next one
+        ok_(self.exists(Job.key_for(ids[6])))
+        assert_equal(queue.job_ids, ids[2:5] + [new_job.id])
+        ok_(collection.walk_lists())
+        ok_(not self.exists(Job.key_for(ids[6])))
+
+    def test_empty_queues_are_removed_from_queue_set(self):
+        redis_conn = connect_to_redis()
+        job = self.enqueue()
+        empty = jobs.get_queue(u'empty')
+        redis_conn.sadd(Queue.redis_queues_keys, empty.key)
+        result = garbage.collect(dry_run=True)
+        ok_(result[u'entries'] >= 1)
+        ok_(redis_conn.sismember(Queue.redis_queues_keys, empty.key))
+        garbage.collect()
+        ok_(not redis_conn.sismember(Queue.redis_queues_keys, empty.key))
+        ok_(redis_conn.sismember(Queue.redis_queues_keys,
+                                 jobs.get_queue().key))
+        assert_equal(jobs.get_queue().job_ids, [job.id])
+
+    def test_worker_collects_garbage(self):
+        job = self.enqueue()
+        self.age(job)
+        jobs.get_queue().connection.lrem(jobs.get_queue().key, job.id)
+        with changed_config(u'ckanext.rq.gc_interval', u'3600'):
+            jobs.Worker().work(burst=True)
+        ok_(not self.exists(job.key))
@@ -0,0 +1,122 @@
+# encoding: utf-8
+
+import datetime
+
+from nose.tools import assert_equal, ok_
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import failed, index, retry
+from ckanext.rq.redis import connect_to_redis
+
+from ckanext.rq.tests.helpers import failing_job, RQTestBase
+
+
+def _ids(found):
+    return [job[u'id'] for job in found]
+
+
+class TestIndex(RQTestBase):
+
+    def get_created_key(self):
+        return index.get_index_key(jobs.add_queue_name_prefix(u''),
+                                   u'created')
+
+    def test_tokenize(self):
+        assert_equal(index.tokenize(u'Harvest source "Foo", foo-2'),
+                     [u'2', u'foo', u'harvest', u'source'])
+        assert_equal(index.tokenize(None), [])
+
+    def test_title(self):
+        job1 = self.enqueue(title=u'Harvest source Foo')
+        self.enqueue(title=u'Harvest source Bar')
+        self.enqueue(title=u'Update index')
+        self.enqueue()
+        assert_equal(_ids(index.search_jobs(q=u'source foo')),
+                     [job1.id])
+        assert_equal(len(list(index.search_jobs(q=u'HARVEST'))), 2)
+        assert_equal(list(index.search_jobs(q=u'nothing')), [])
+
+    def test_title_pattern(self):
+        job1 = self.enqueue(title=u'Harvest source Foo')
+        self.enqueue(title=u'Update source Foo')
+        self.enqueue()
+        assert_equal(_ids(index.search_jobs(q=u'foo', title=u'Harvest*')),
+                     [job1.id])
+        assert_equal(list(index.search_jobs(q=u'foo', title=u'harvest*')),
+                     [])
+
+    def test_function(self):
+        job1 = self.enqueue(failing_job)
+        job2 = self.enqueue(title=u'Other')
+        assert_equal(_ids(index.search_jobs(function=u'failing_job')),
+                     [job1.id])
+        assert_equal(_ids(index.search_jobs(function=jobs.test_job.__module__
+                                            + u'.test_job')), [job2.id])
+        assert_equal(_ids(index.search_jobs(function=u'failing_job',
+                                            q=u'other')), [])
+
+    def test_since_and_until(self):
+        job = self.enqueue()
+        created = job.created_at.replace(microsecond=0)
+        second = datetime.timedelta(seconds=1)
+        assert_equal(_ids(index.search_jobs(since=created)), [job.id])
+        assert_equal(_ids(index.search_jobs(since=created + second)), [])
+        assert_equal(_ids(index.search_jobs(until=created + second)),
+                     [job.id])
+        assert_equal(_ids(index.search_jobs(until=created)), [])
+
+    def test_queues_and_fields(self):
+        self.enqueue(title=u'My job', queue=u'q1')
+        job = self.enqueue(title=u'My job', queue=u'q2')
+        found = list(index.search_jobs([u'q2'], q=u'job',
+                                       fields=[u'status']))
+        assert_equal(_ids(found), [job.id])
+        assert_equal(found[0][u'status'], u'queued')
+        assert_equal(found[0][u'queue'], u'q2')
+
+    def test_pages(self):
+        ids = [self.enqueue(title=u'Job {}'.format(i)).id for i in range(5)]
+        connect_to_redis().delete(jobs.job_from_id(ids[1]).key)
+        original_page_size = index.PAGE_SIZE
+        index.PAGE_SIZE = 2
+        try:
+            found = _ids(index.search_jobs(since=datetime.datetime(2000, 1,
+                                                                   1)))
+        finally:
+            index.PAGE_SIZE = original_page_size
+        assert_equal(sorted(found), sorted(ids[:1] + ids[2:]))
+
+    def test_deleted_job_is_pruned(self):
+        job = self.enqueue(title=u'Deleted')
+        connect_to_redis().delete(job.key)
+        assert_equal(list(index.search_jobs(q=u'deleted')), [])
+        key = index.get_index_key(jobs.add_queue_name_prefix(u''),
+                                  u'title:deleted')
+        assert_equal(connect_to_redis().zcard(key), 0)
+
+    def test_started_job_is_removed(self):
+        job = self.enqueue(title=u'Started')
+        connection = connect_to_redis()
+        ok_(connection.zscore(self.get_created_key(), job.id) is not None)
+        job = jobs.get_queue().dequeue()
+        jobs.Worker().prepare_job_execution(job)
+        ok_(connection.zscore(self.get_created_key(), job.id) is None)
+        retry.schedule(job, 3600)
+        ok_(connection.zscore(self.get_created_key(), job.id) is not None)
+        assert_equal(list(index.search_jobs(q=u'started')), [])
+
+    def test_requeued_failed_job(self):
+        job = self.enqueue(failing_job, title=u'Failing')
+        jobs.Worker().work(burst=True)
+        assert_equal(list(index.search_jobs(q=u'failing')), [])
+        failed.requeue_failed_jobs([job.id])
+        assert_equal(_ids(index.search_jobs(q=u'failing')), [job.id])
+
+    def test_rebuild(self):
+        job = self.enqueue(title=u'Old job')
+        connection = connect_to_redis()
+        for key in connection.keys(u'rq:index:*'):
+            connection.delete(key)
+        assert_equal(list(index.search_jobs(q=u'old')), [])
+        assert_equal(index.rebuild(), 1)
+        assert_equal(_ids(index.search_jobs(q=u'old')), [job.id])
@@ -1,11 +1,19 @@
 # encoding: utf-8
 
 import datetime
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
 
 from nose.tools import ok_, assert_equal, raises, assert_false
+import mock
 import rq
 
 import ckanext.rq.jobs as jobs
+from ckanext.rq import failed
 from ckantoolkit import config, ObjectNotFound
 from ckan import model
 
@@ -15,10 +23,26 @@ except ImportError:
     from ckanext.rq.tests.helpers import call_action
 
 from ckanext.rq.tests.helpers import (
-    changed_config, recorded_logs, RQTestBase
+    changed_config, failing_job, recorded_logs, RQTestBase
 )
 
 
+class TestImport(object):
+
+    def test_import_does_not_load_ckan(self):
+        u'''
+        Importing the module (e.g. to enqueue a job) must not import
+        CKAN's model or environment, which are slow to import.
+        '''
+        code = (u'import sys, ckanext.rq.jobs; '
+                u'print(u" ".join(m for m in sys.modules if m.startswith('
+                u'(u"ckan.model", u"ckan.config.environment"))))')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.check_output([sys.executable, u'-c', code],
+                                         env=env)
+        assert_equal(output.strip(), b'')
+
+
 class TestQueueNamePrefixes(RQTestBase):
 
     def test_queue_name_prefix_contains_site_id(self):
@@ -34,6 +58,16 @@ class TestQueueNamePrefixes(RQTestBase):
     def test_queue_name_removal_without_prefix(self):
         jobs.remove_queue_name_prefix(u'foobar')
 
+    def test_queue_name_prefix_of_other_site(self):
+        prefixed = jobs.add_queue_name_prefix(u'foobar', u'other-site')
+        assert_equal(jobs.split_queue_name(prefixed),
+                     (u'other-site', u'foobar'))
+        assert_equal(jobs.get_queue(u'foobar', u'other-site').name, prefixed)
+
+    @raises(ValueError)
+    def test_queue_name_split_without_prefix(self):
+        jobs.split_queue_name(u'foobar')
+
 
 class TestEnqueue(RQTestBase):
 
@@ -139,11 +173,95 @@ class TestDictizeJob(RQTestBase):
         ok_(abs((now - dt).total_seconds()) < 10)
 
 
-def failing_job():
+class TestIterJobs(RQTestBase):
+
+    def test_pages(self):
+        ids = [self.enqueue(title=u'Job {}'.format(i)).id for i in range(5)]
+        original_page_size = jobs.PAGE_SIZE
+        jobs.PAGE_SIZE = 2
+        try:
+            listed = [job[u'id'] for job in jobs.iter_jobs()]
+        finally:
+            jobs.PAGE_SIZE = original_page_size
+        assert_equal(listed, ids)
+
+    def test_dictized_like_dictize_job(self):
+        job = self.enqueue(title=u'Title', queue=u'my_queue')
+        assert_equal(list(jobs.iter_jobs([u'my_queue'])),
+                     [jobs.dictize_job(job)])
+
+    def test_queues(self):
+        self.enqueue(queue=u'q1')
+        job = self.enqueue(queue=u'q2')
+        assert_equal([j[u'id'] for j in jobs.iter_jobs([u'q2'])], [job.id])
+
+    def test_title(self):
+        self.enqueue(title=u'Harvest source 1')
+        job = self.enqueue(title=u'Update index')
+        self.enqueue()
+        assert_equal([j[u'id'] for j in jobs.iter_jobs(title=u'Upd*')],
+                     [job.id])
+
+    def test_since_and_until(self):
+        job = self.enqueue()
+        created = job.created_at.replace(microsecond=0)
+        second = datetime.timedelta(seconds=1)
+        assert_equal(len(list(jobs.iter_jobs(since=created))), 1)
+        assert_equal(len(list(jobs.iter_jobs(since=created + second))), 0)
+        assert_equal(len(list(jobs.iter_jobs(until=created + second))), 1)
+        assert_equal(len(list(jobs.iter_jobs(until=created))), 0)
+
+    def test_offset(self):
+        ids = [self.enqueue(queue=q).id for q in [u'q1', u'q1', u'q2']]
+        ids += [self.enqueue(queue=u'q2', title=u'Title').id]
+        for offset in range(5):
+            assert_equal([j[u'id'] for j in jobs.iter_jobs(
+                          [u'q1', u'q2'], offset=offset)], ids[offset:])
+        assert_equal([j[u'id'] for j in jobs.iter_jobs(
+                      [u'q1', u'q2'], title=u'*', offset=0)], ids[3:])
+        assert_equal(list(jobs.iter_jobs(title=u'*', offset=1)), [])
+
+
+def sleeping_job(seconds):
     u'''
-    A background job that fails.
+    A background job that sleeps.
     '''
-    raise RuntimeError(u'JOB FAILURE')
+    time.sleep(seconds)
+
+
+def memory_job(megabytes):
+    u'''
+    A background job that allocates memory.
+    '''
+    return len(b'x' * (megabytes * 1024 * 1024))
+
+
+def cpu_job(seconds):
+    u'''
+    A background job that uses CPU time.
+    '''
+    while True:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        if usage.ru_utime + usage.ru_stime > seconds:
+            return
+
+
+def reloading_job():
+    u'''
+    A background job that reloads its worker and then keeps running.
+    '''
+    os.kill(os.getppid(), signal.SIGHUP)
+    time.sleep(2)
+    return u'done'
+
+
+def _get_address_space_size():
+    u'''
+    Get the size of the address space of the current process in MB.
+    '''
+    with open(u'/proc/self/statm') as f:
+        pages = int(f.read().split()[0])
+    return pages * resource.getpagesize() // (1024 * 1024)
 
 
 def database_job(pkg_id, pkg_title):
@@ -260,3 +378,149 @@ class TestWorker(RQTestBase):
         assert_false(pkg in pkg.Session)
         pkg = model.Package.get(pkg.id)  # Get instance from new session
         assert_equal(pkg.title, u'foofoo')  # Worker only saw committed changes
+
+
+class TestResourceLimits(RQTestBase):
+
+    def run_job(self, job, queues=None, **kwargs):
+        u'''
+        Run a job in a work horse and return its exception type.
+        '''
+        jobs.Worker(queues, **kwargs).work(burst=True)
+        failed_jobs = list(failed.iter_failed_jobs())
+        if not failed_jobs:
+            return None
+        assert_equal(failed_jobs[0][u'id'], job.id)
+        return failed_jobs[0][u'exc_type']
+
+    def test_job_timeout(self):
+        job = self.enqueue(sleeping_job, args=[5], timeout=1)
+        assert_equal(self.run_job(job), u'JobTimeoutException')
+
+    def test_queue_timeout(self):
+        with changed_config(u'ckanext.rq.queue.q.timeout', u'1'):
+            job = self.enqueue(sleeping_job, args=[5], queue=u'q')
+            assert_equal(self.run_job(job, [u'q']), u'JobTimeoutException')
+
+    def test_worker_timeout(self):
+        job = self.enqueue(sleeping_job, args=[5])
+        assert_equal(self.run_job(job, timeout=1), u'JobTimeoutException')
+
+    def test_job_timeout_overrides_worker_timeout(self):
+        job = self.enqueue(sleeping_job, args=[2], timeout=10)
+        assert_equal(self.run_job(job, timeout=1), None)
+
+    def test_memory_limit(self):
+        limit = _get_address_space_size() + 100
+        job = self.enqueue(memory_job, args=[200], max_memory=limit)
+        assert_equal(self.run_job(job), u'JobMemoryLimitExceeded')
+
+    def test_memory_within_limit(self):
+        limit = _get_address_space_size() + 100
+        job = self.enqueue(memory_job, args=[10], max_memory=limit)
+        assert_equal(self.run_job(job), None)
+
+    def test_cpu_limit(self):
+        job = self.enqueue(cpu_job, args=[30], max_cpu=1)
+        assert_equal(self.run_job(job), u'JobCPULimitExceeded')
+
+    def test_limit_breaches_are_not_retried(self):
+        limit = _get_address_space_size() + 100
+        job = self.enqueue(memory_job, args=[200], max_memory=limit,
+                           retry=3)
+        assert_equal(self.run_job(job), u'JobMemoryLimitExceeded')
+
+
+class TestReload(RQTestBase):
+
+    # Commands for the new process of a reloading worker
+    READY = u'from ckanext.rq import reloader; reloader.signal_ready()'
+    STARTING = u'import time; time.sleep(30)'
+    BROKEN = u'raise SystemExit(1)'
+
+    def setup(self):
+        super(TestReload, self).setup()
+        self.workers = []
+
+    def teardown(self):
+        for worker in self.workers:
+            if worker._successor is not None:
+                if worker._successor.poll() is None:
+                    worker._successor.kill()
+                worker._successor.wait()
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+    def get_worker(self, code):
+        worker = jobs.Worker()
+        worker.reload_command = [sys.executable, u'-c', code]
+        self.workers.append(worker)
+        return worker
+
+    def wait_for_successor(self, worker):
+        for _ in range(100):
+            if worker._successor_ready or worker._successor.poll() is not None:
+                return
+            time.sleep(0.1)
+
+    def test_reload_without_command_is_ignored(self):
+        worker = jobs.Worker()
+        worker.request_reload(signal.SIGHUP, None)
+        ok_(worker._successor is None)
+
+    def test_worker_keeps_taking_jobs_until_new_process_is_ready(self):
+        job = self.enqueue()
+        worker = self.get_worker(self.STARTING)
+        worker.request_reload(signal.SIGHUP, None)
+        with mock.patch.object(worker, u'reload') as reload:
+            worker.work(burst=True)
+        job.refresh()
+        assert_equal(job.get_status(), rq.job.JobStatus.FINISHED)
+        # The worker hands over to the new process even if that is not
+        # ready yet when the worker exits
+        ok_(reload.called)
+
+    def test_worker_stops_taking_jobs_once_new_process_is_ready(self):
+        job = self.enqueue()
+        worker = self.get_worker(self.READY)
+        worker.request_reload(signal.SIGHUP, None)
+        self.wait_for_successor(worker)
+        ok_(worker._successor_ready)
+        with mock.patch.object(worker, u'reload') as reload:
+            worker.work(burst=True)
+        ok_(reload.called)
+        assert_equal(jobs.get_queue().job_ids, [job.id])
+
+    def test_worker_continues_if_new_process_fails(self):
+        job = self.enqueue()
+        worker = self.get_worker(self.BROKEN)
+        worker.request_reload(signal.SIGHUP, None)
+        self.wait_for_successor(worker)
+        with mock.patch.object(worker, u'reload') as reload:
+            worker.work(burst=True)
+        ok_(not reload.called)
+        ok_(worker._successor is None)
+        job.refresh()
+        assert_equal(job.get_status(), rq.job.JobStatus.FINISHED)
+
+    def test_busy_worker_reloads_without_interrupting_job(self):
+        job = self.enqueue(reloading_job)
+        other_job = self.enqueue()
+        worker = self.get_worker(self.READY)
+        with mock.patch.object(worker, u'reload') as reload:
+            worker.work(burst=True)
+        ok_(reload.called)
+        job.refresh()
+        assert_equal(job.get_status(), rq.job.JobStatus.FINISHED)
+        assert_equal(job.result, u'done')
+        # The new process performs the remaining jobs
+        assert_equal(jobs.get_queue().job_ids, [other_job.id])
+
+    def test_reload_execs_reloader(self):
+        worker = self.get_worker(self.STARTING)
+        worker.request_reload(signal.SIGHUP, None)
+        with mock.patch.object(jobs.os, u'execv') as execv:
+            worker.reload()
+        assert_equal(execv.call_args[0][1], [
+            sys.executable, u'-m', u'ckanext.rq.reloader',
+            u'{}'.format(worker._successor.pid)] + worker.reload_command)
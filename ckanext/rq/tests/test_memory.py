@@ -0,0 +1,73 @@
+# encoding: utf-8
+
+from nose.tools import assert_equal, ok_, raises
+import mock
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import memory
+
+from ckanext.rq.tests.helpers import failing_job, RQTestBase
+
+
+class TestMemory(RQTestBase):
+
+    def test_queues(self):
+        for i in range(30):
+            self.enqueue(args=[u'x' * 1000], queue=u'q1')
+        self.enqueue(queue=u'q2')
+        report = memory.get_report([u'q1', u'q2'], samples=10)
+        queues = dict((q[u'queue'], q) for q in report[u'queues'])
+        assert_equal(queues[u'q1'][u'jobs'], 30)
+        assert_equal(queues[u'q2'][u'jobs'], 1)
+        ok_(queues[u'q1'][u'memory'] > 30 * 1000)
+        ok_(queues[u'q1'][u'memory'] > queues[u'q2'][u'memory'])
+        assert_equal(report[u'sampled'], 11)
+
+    def test_functions_and_largest_jobs(self):
+        self.enqueue(args=[u'x' * 10000], title=u'Large')
+        self.enqueue(failing_job)
+        report = memory.get_report(limit=1)
+        assert_equal(report[u'functions'][0][u'function'],
+                     u'ckanext.rq.jobs.test_job')
+        assert_equal(len(report[u'largest']), 1)
+        assert_equal(report[u'largest'][0][u'title'], u'Large')
+        ok_(report[u'largest'][0][u'data'] > 10000)
+
+    def test_failed_jobs(self):
+        self.enqueue(failing_job)
+        jobs.Worker().work(burst=True)
+        report = memory.get_report()
+        assert_equal(report[u'failed'][u'jobs'], 1)
+        ok_(report[u'failed'][u'exc_info'] > 0)
+        assert_equal(report[u'failed'][u'exc_info'],
+                     report[u'failed'][u'exc_info_avg'])
+
+    def test_registries(self):
+        self.enqueue()
+        jobs.Worker().work(burst=True)
+        report = memory.get_report()
+        registries = [(r[u'queue'], r[u'registry'], r[u'jobs'])
+                      for r in report[u'registries']]
+        assert_equal(registries,
+                     [(jobs.DEFAULT_QUEUE_NAME, u'finished', 1)])
+
+    @raises(ValueError)
+    def test_memory_usage_not_supported(self):
+        # Redis before 4.0 does not know the MEMORY command
+        def add_count_commands(source, pipeline):
+            pipeline.execute_command(u'NO-SUCH-COMMAND', source.key)
+
+        self.enqueue(queue=u'q1')
+        with mock.patch.object(memory._Source, u'add_count_commands',
+                               add_count_commands):
+            memory.get_report([u'q1'])
+
+    def test_format_report(self):
+        self.enqueue(queue=u'q1')
+        lines = memory.format_report(memory.get_report([u'q1']))
+        ok_(lines[1].startswith(u'q1 '))
+
+    def test_format_bytes(self):
+        assert_equal(memory.format_bytes(100), u'100 bytes')
+        assert_equal(memory.format_bytes(1536), u'1.5 KB')
+        assert_equal(memory.format_bytes(3 * 1024 ** 3), u'3.0 GB')
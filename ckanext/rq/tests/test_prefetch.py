@@ -0,0 +1,73 @@
+# encoding: utf-8
+
+from nose.tools import assert_equal, ok_
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import prefetch, reaper
+from ckanext.rq.redis import connect_to_redis
+
+from ckanext.rq.tests.helpers import changed_config, RQTestBase
+
+
+class TestPrefetch(RQTestBase):
+
+    def setup(self):
+        super(TestPrefetch, self).setup()
+        self._prefetch = changed_config(u'ckanext.rq.prefetch', u'2')
+        self._prefetch.__enter__()
+
+    def teardown(self):
+        self._prefetch.__exit__(None, None, None)
+
+    def test_worker_performs_prefetched_jobs(self):
+        for _ in range(5):
+            self.enqueue()
+        worker = jobs.Worker()
+        worker.work(burst=True)
+        assert_equal(self.all_jobs(), [])
+        assert_equal(jobs.get_queue().job_ids, [])
+        redis_conn = connect_to_redis()
+        ok_(not redis_conn.exists(prefetch.get_list_key(worker.name)))
+
+    def test_jobs_are_moved_to_worker_list(self):
+        ids = [self.enqueue().id for _ in range(4)]
+        worker = jobs.Worker()
+        job, _ = worker.dequeue_job_and_maintain_ttl(None)
+        assert_equal(job.id, ids[0])
+        assert_equal(jobs.get_queue().job_ids, ids[3:])
+        redis_conn = connect_to_redis()
+        assert_equal(redis_conn.lrange(prefetch.get_list_key(worker.name),
+                                       0, -1), ids[:3])
+        # Prefetched jobs are dequeued without going to the queue
+        self.enqueue()
+        job, _ = worker.dequeue_job_and_maintain_ttl(None)
+        assert_equal(job.id, ids[1])
+
+    def test_stopping_worker_returns_prefetched_jobs(self):
+        ids = [self.enqueue().id for _ in range(4)]
+        worker = jobs.Worker()
+        worker.dequeue_job_and_maintain_ttl(None)
+        worker.prepare_job_execution(jobs.job_from_id(ids[0]))
+        worker._return_prefetched()
+        assert_equal(jobs.get_queue().job_ids, ids[1:])
+        redis_conn = connect_to_redis()
+        ok_(not redis_conn.exists(prefetch.get_list_key(worker.name)))
+        ok_(not redis_conn.sismember(prefetch.WORKERS_KEY, worker.name))
+
+    def test_reaper_returns_jobs_of_dead_workers(self):
+        ids = [self.enqueue().id for _ in range(4)]
+        worker = jobs.Worker()
+        worker.dequeue_job_and_maintain_ttl(None)
+        assert_equal(jobs.get_queue().job_ids, ids[3:])
+        reaped = reaper.reap([jobs.get_queue()])
+        assert_equal(reaped, ids[2::-1])
+        assert_equal(jobs.get_queue().job_ids, ids)
+
+    def test_reaper_ignores_live_workers(self):
+        ids = [self.enqueue().id for _ in range(4)]
+        worker = jobs.Worker()
+        worker.dequeue_job_and_maintain_ttl(None)
+        redis_conn = connect_to_redis()
+        redis_conn.set(reaper.get_heartbeat_key(worker.name), 1)
+        assert_equal(reaper.reap([jobs.get_queue()]), [])
+        assert_equal(jobs.get_queue().job_ids, ids[3:])
@@ -0,0 +1,67 @@
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, ok_
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import profile
+from ckanext.rq.redis import connect_to_redis
+
+from ckanext.rq.tests.helpers import changed_config, RQTestBase
+
+
+def profiled_job():
+    return sum(i * i for i in range(1000))
+
+
+class TestProfile(RQTestBase):
+
+    def setup(self):
+        super(TestProfile, self).setup()
+        redis_conn = connect_to_redis()
+        for key in redis_conn.keys(profile.get_profile_key(u'*')):
+            redis_conn.delete(key)
+
+    def test_no_profiling_by_default(self):
+        job = self.enqueue(profiled_job)
+        jobs.Worker().work(burst=True)
+        assert_equal(profile.load(job.id), None)
+
+    def test_profile_rate(self):
+        with changed_config(u'ckanext.rq.profile_rate', u'1'):
+            job = self.enqueue(profiled_job)
+            jobs.Worker().work(burst=True)
+        stats = profile.load(job.id)
+        ok_(stats is not None)
+        ok_(u'profiled_job' in profile.format_summary(stats))
+
+    def test_profile_functions(self):
+        with changed_config(u'ckanext.rq.profile_functions',
+                            u'foo.bar profiled_job'):
+            job = self.enqueue(profiled_job)
+            other_job = self.enqueue()
+            jobs.Worker().work(burst=True)
+        ok_(profile.load(job.id) is not None)
+        assert_equal(profile.load(other_job.id), None)
+
+    def test_failed_jobs_are_profiled(self):
+        with changed_config(u'ckanext.rq.profile_rate', u'1'):
+            job = self.enqueue(profiled_job, args=[u'unexpected argument'])
+            jobs.Worker().work(burst=True)
+        ok_(profile.load(job.id) is not None)
+
+    def test_profile_dir(self):
+        profile_dir = os.path.join(tempfile.mkdtemp(), u'profiles')
+        try:
+            with changed_config(u'ckanext.rq.profile_dir', profile_dir):
+                with changed_config(u'ckanext.rq.profile_rate', u'1'):
+                    job = self.enqueue(profiled_job)
+                    jobs.Worker().work(burst=True)
+                ok_(os.path.exists(os.path.join(profile_dir,
+                                                job.id + u'.prof')))
+                ok_(profile.load(job.id) is not None)
+        finally:
+            shutil.rmtree(os.path.dirname(profile_dir))
@@ -0,0 +1,86 @@
+# encoding: utf-8
+
+from nose.tools import assert_equal, ok_
+from rq.job import JobStatus
+from rq.registry import StartedJobRegistry
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import failed, reaper
+from ckanext.rq.redis import connect_to_redis
+
+from ckanext.rq.tests.helpers import changed_config, RQTestBase
+
+
+class TestReaper(RQTestBase):
+
+    def start_job(self, queue=jobs.DEFAULT_QUEUE_NAME):
+        u'''
+        Start a job on a worker that dies right away.
+        '''
+        job = self.enqueue(queue=queue)
+        rq_queue = jobs.get_queue(queue)
+        job = rq_queue.dequeue()
+        worker = jobs.Worker([queue], name=u'dead-worker')
+        worker.prepare_job_execution(job)
+        return job, worker
+
+    def reap(self, queue=jobs.DEFAULT_QUEUE_NAME):
+        return reaper.reap([jobs.get_queue(queue)])
+
+    def test_orphaned_job_is_requeued(self):
+        job, _ = self.start_job()
+        assert_equal(self.reap(), [job.id])
+        queue = jobs.get_queue()
+        assert_equal(queue.job_ids, [job.id])
+        assert_equal(jobs.job_from_id(job.id).get_status(),
+                     JobStatus.QUEUED)
+        registry = StartedJobRegistry(queue.name, queue.connection)
+        assert_equal(registry.get_job_ids(), [])
+        assert_equal(self.reap(), [])
+
+    def test_orphaned_job_is_failed(self):
+        with changed_config(u'ckanext.rq.queue.q.reap_policy', u'fail'):
+            job, _ = self.start_job(u'q')
+            assert_equal(self.reap(u'q'), [job.id])
+        assert_equal(jobs.get_queue(u'q').job_ids, [])
+        failed_jobs = list(failed.iter_failed_jobs())
+        assert_equal([j[u'id'] for j in failed_jobs], [job.id])
+        assert_equal(failed_jobs[0][u'exc_type'], u'WorkerLost')
+
+    def test_job_of_living_worker_is_not_reaped(self):
+        job, worker = self.start_job()
+        heartbeat = reaper.Heartbeat(worker.name, [connect_to_redis()])
+        heartbeat.start()
+        try:
+            assert_equal(self.reap(), [])
+        finally:
+            heartbeat.stop()
+        assert_equal(self.reap(), [job.id])
+
+    def test_job_without_worker_is_not_reaped(self):
+        job = self.enqueue()
+        queue = jobs.get_queue()
+        StartedJobRegistry(queue.name, queue.connection).add(job, 100)
+        assert_equal(self.reap(), [])
+
+    def test_heartbeat(self):
+        redis_conn = connect_to_redis()
+        heartbeat = reaper.Heartbeat(u'my-worker', [redis_conn])
+        key = reaper.get_heartbeat_key(u'my-worker')
+        heartbeat.start()
+        ok_(0 < redis_conn.ttl(key) <= reaper.get_heartbeat_ttl())
+        heartbeat.stop()
+        ok_(not redis_conn.exists(key))
+
+    def test_worker_reaps_its_queues(self):
+        job, _ = self.start_job()
+        jobs.Worker().work(burst=True)
+        assert_equal(jobs.job_from_id(job.id).get_status(),
+                     JobStatus.FINISHED)
+
+    def test_reaping_can_be_disabled(self):
+        job, _ = self.start_job()
+        with changed_config(u'ckanext.rq.reap_interval', u'0'):
+            jobs.Worker().work(burst=True)
+        assert_equal(jobs.job_from_id(job.id).get_status(),
+                     JobStatus.STARTED)
@@ -0,0 +1,86 @@
+# encoding: utf-8
+
+import signal
+import subprocess
+import sys
+import time
+
+from nose.tools import ok_, assert_equal
+
+from ckanext.rq import reloader
+
+
+# Commands for worker processes
+READY = (u'from ckanext.rq import reloader; reloader.signal_ready(); '
+         u'import time; time.sleep(30)')
+STARTING = u'import time; time.sleep(30)'
+BROKEN = u'raise SystemExit(1)'
+
+
+class TestReloader(object):
+
+    def setup(self):
+        self.processes = []
+
+    def teardown(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        for signum in (signal.SIGTERM, signal.SIGHUP,
+                       reloader.READY_SIGNAL):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    def get_reloader(self, code=STARTING, new_code=READY):
+        process = subprocess.Popen([sys.executable, u'-c', code])
+        self.processes.append(process)
+        r = reloader.Reloader(process.pid, [sys.executable, u'-c', new_code])
+        r._install_signal_handlers()
+        return r
+
+    def run_until(self, r, condition):
+        for _ in range(100):
+            running = r.step()
+            if r.new_worker is not None:
+                self.processes.append(r.new_worker)
+            if condition() or not running:
+                return running
+            time.sleep(0.1)
+
+    def test_reload(self):
+        r = self.get_reloader()
+        old_worker = r.worker
+        r.request_reload(signal.SIGHUP, None)
+        self.run_until(r, lambda: r.worker is not old_worker)
+        ok_(r.worker is not old_worker)
+        # The previous worker is stopped like on SIGTERM
+        self.run_until(r, lambda: not r.retiring)
+        assert_equal(old_worker.returncode, -signal.SIGTERM)
+        ok_(r.worker.poll() is None)
+
+    def test_new_worker_that_fails_is_ignored(self):
+        r = self.get_reloader(new_code=BROKEN)
+        old_worker = r.worker
+        r.request_reload(signal.SIGHUP, None)
+        self.run_until(r, lambda: r.new_worker is None)
+        ok_(r.new_worker is None)
+        ok_(r.worker is old_worker)
+        ok_(r.worker.poll() is None)
+
+    def test_signals_are_passed_on(self):
+        r = self.get_reloader()
+        r.request_reload(signal.SIGHUP, None)
+        self.run_until(r, lambda: r.new_worker is not None)
+        new_worker = r.new_worker
+        r.request_stop(signal.SIGTERM, None)
+        ok_(not self.run_until(r, lambda: False))
+        assert_equal(r.returncode, -signal.SIGTERM)
+        assert_equal(new_worker.returncode, -signal.SIGTERM)
+
+    def test_exits_with_worker(self):
+        r = self.get_reloader(code=u'raise SystemExit(3)')
+        ok_(not self.run_until(r, lambda: False))
+        assert_equal(r.returncode, 3)
+        assert_equal(reloader.get_exit_code(r.returncode), 3)
+        assert_equal(reloader.get_exit_code(-signal.SIGTERM), 143)
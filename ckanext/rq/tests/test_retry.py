@@ -0,0 +1,94 @@
+# encoding: utf-8
+
+from nose.tools import assert_equal, ok_
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import failed, index, retry
+from ckanext.rq.redis import connect_to_redis
+
+from ckanext.rq.tests.helpers import (
+    changed_config, failing_job, RQTestBase
+)
+
+
+class TestRetryPolicy(object):
+
+    def test_exponential_backoff(self):
+        policy = retry.Retry(5, backoff=10, max_delay=60, jitter=False)
+        delays = [policy.get_delay(n) for n in range(1, 6)]
+        assert_equal(delays, [10, 20, 40, 60, 60])
+
+    def test_jitter(self):
+        policy = retry.Retry(5, backoff=10, max_delay=60, jitter=True)
+        for _ in range(100):
+            delay = policy.get_delay(3)
+            ok_(0 <= delay <= 40)
+
+    def test_from_config(self):
+        with changed_config(u'ckanext.rq.retry_max_attempts', u'3'):
+            with changed_config(u'ckanext.rq.queue.q.retry_backoff', u'7'):
+                assert_equal(retry.Retry.from_config(u'q'),
+                             retry.Retry(3, backoff=7))
+                assert_equal(retry.Retry.from_config(u'other'),
+                             retry.Retry(3))
+
+    def test_no_retries_by_default(self):
+        assert_equal(retry.Retry.from_config(u'q').max_attempts, 0)
+
+
+class TestRetries(RQTestBase):
+
+    def make_due(self, queue=jobs.DEFAULT_QUEUE_NAME):
+        u'''
+        Make all delayed jobs of a queue due.
+        '''
+        redis_conn = connect_to_redis()
+        key = retry.get_delayed_key(jobs.add_queue_name_prefix(queue))
+        for id in redis_conn.zrange(key, 0, -1):
+            redis_conn.zadd(key, **{id: 0})
+
+    def test_failed_job_is_delayed(self):
+        job = self.enqueue(failing_job, retry=2)
+        jobs.Worker().work(burst=True)
+        delayed = retry.get_delayed_job_ids(jobs.get_queue())
+        assert_equal(delayed, [job.id])
+        job = jobs.job_from_id(job.id)
+        assert_equal(job.get_status(), retry.SCHEDULED)
+        assert_equal(job.meta[u'attempts'], 2)
+        assert_equal(list(failed.iter_failed_jobs()), [])
+
+    def test_job_fails_after_last_attempt(self):
+        job = self.enqueue(failing_job, retry=2)
+        jobs.Worker().work(burst=True)
+        self.make_due()
+        jobs.Worker().work(burst=True)
+        assert_equal(retry.get_delayed_job_ids(jobs.get_queue()), [])
+        assert_equal([j[u'id'] for j in failed.iter_failed_jobs()],
+                     [job.id])
+
+    def test_due_jobs_are_moved_to_queue(self):
+        job = self.enqueue(failing_job, retry=2)
+        jobs.Worker().work(burst=True)
+        queue = jobs.get_queue()
+        ok_(retry.enqueue_due_jobs([queue]) > 0)
+        assert_equal(queue.job_ids, [])
+        self.make_due()
+        assert_equal(retry.enqueue_due_jobs([queue]), None)
+        assert_equal(queue.job_ids, [job.id])
+
+    def test_queue_policy(self):
+        with changed_config(u'ckanext.rq.queue.q.retry_max_attempts', u'2'):
+            job = self.enqueue(failing_job, queue=u'q')
+            jobs.Worker([u'q']).work(burst=True)
+        assert_equal(retry.get_delayed_job_ids(jobs.get_queue(u'q')),
+                     [job.id])
+
+    def test_clear_delayed(self):
+        self.enqueue(failing_job, retry=2)
+        jobs.Worker().work(burst=True)
+        queue = jobs.get_queue()
+        assert_equal(retry.clear_delayed(queue), 1)
+        assert_equal(retry.get_delayed_job_ids(queue), [])
+        key = index.get_index_key(jobs.add_queue_name_prefix(u''),
+                                  u'created')
+        assert_equal(queue.connection.zcard(key), 0)
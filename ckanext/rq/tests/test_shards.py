@@ -0,0 +1,162 @@
+# encoding: utf-8
+
+import contextlib
+
+from nose.tools import assert_equal, assert_not_equal, ok_
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import failed, index, reaper, shards, stats
+
+from ckanext.rq.tests.helpers import (
+    changed_config, failing_job, RQTestBase
+)
+
+
+SHARD_URLS = [u'redis://localhost:6379/1', u'redis://localhost:6379/2']
+
+
+class TestHashing(object):
+
+    def test_unsharded(self):
+        with changed_config(shards.SHARDS_SETTING_NAME, u''):
+            ok_(not shards.is_sharded())
+            assert_equal(shards.get_queue_shard(u'foo'), 0)
+            assert_equal(shards.get_job_shard(u's1.foo'), 0)
+            assert_equal(shards.new_job_id(0), None)
+
+    def test_queue_shard_is_stable(self):
+        with changed_config(shards.SHARDS_SETTING_NAME, u' '.join(SHARD_URLS)):
+            names = [u'queue-{}'.format(i) for i in range(100)]
+            first = [shards.get_queue_shard(name) for name in names]
+            shards._rings.clear()
+            second = [shards.get_queue_shard(name) for name in names]
+        assert_equal(first, second)
+        assert_equal(set(first), {0, 1})
+
+    def test_adding_a_shard_moves_few_queues(self):
+        names = [u'queue-{}'.format(i) for i in range(1000)]
+        urls = SHARD_URLS + [u'redis://localhost:6379/3']
+        with changed_config(shards.SHARDS_SETTING_NAME, u' '.join(urls[:2])):
+            before = [shards.get_queue_shard(name) for name in names]
+        with changed_config(shards.SHARDS_SETTING_NAME, u' '.join(urls)):
+            after = [shards.get_queue_shard(name) for name in names]
+        moved = [b for b, a in zip(before, after) if b != a]
+        ok_(0 < len(moved) < 500)
+        for b, a in zip(before, after):
+            ok_(a == b or a == 2)
+
+    def test_job_shard(self):
+        with changed_config(shards.SHARDS_SETTING_NAME, u' '.join(SHARD_URLS)):
+            assert_equal(shards.get_job_shard(shards.new_job_id(1)), 1)
+            assert_equal(shards.get_job_shard(u's0.foo'), 0)
+            assert_equal(shards.get_job_shard(u's7.foo'), 0)
+            assert_equal(shards.get_job_shard(u'sx.foo'), 0)
+            assert_equal(shards.get_job_shard(u'a4f0c7d8'), 0)
+
+
+class TestShards(RQTestBase):
+
+    def setup(self):
+        super(TestShards, self).setup()
+        self._flush()
+
+    def teardown(self):
+        self._flush()
+
+    def _flush(self):
+        jobs._queues.clear()
+        with self.sharded():
+            for connection in shards.connect_to_all_shards():
+                connection.flushdb()
+        jobs._queues.clear()
+
+    @contextlib.contextmanager
+    def sharded(self):
+        with changed_config(shards.SHARDS_SETTING_NAME, u' '.join(SHARD_URLS)):
+            try:
+                yield
+            finally:
+                jobs._queues.clear()
+
+    def get_queue_names(self):
+        u'''
+        Get the names of two queues that are stored in different shards.
+        '''
+        names = {}
+        i = 0
+        while len(names) < 2:
+            name = u'queue-{}'.format(i)
+            index = shards.get_queue_shard(jobs.add_queue_name_prefix(name))
+            names.setdefault(index, name)
+            i += 1
+        return names[0], names[1]
+
+    def test_enqueue(self):
+        with self.sharded():
+            q0, q1 = self.get_queue_names()
+            job0 = self.enqueue(queue=q0)
+            job1 = self.enqueue(queue=q1)
+            ok_(job0.id.startswith(u's0.'))
+            ok_(job1.id.startswith(u's1.'))
+            assert_equal(jobs.get_queue(q0).job_ids, [job0.id])
+            assert_equal(jobs.get_queue(q1).job_ids, [job1.id])
+            assert_not_equal(
+                jobs.get_queue(q0).connection.connection_pool,
+                jobs.get_queue(q1).connection.connection_pool)
+            assert_equal(jobs.job_from_id(job1.id).origin,
+                         jobs.add_queue_name_prefix(q1))
+            assert_equal(sorted(q.name for q in jobs.get_all_queues()),
+                         sorted(jobs.add_queue_name_prefix(q)
+                                for q in [q0, q1]))
+
+    def test_worker(self):
+        with self.sharded():
+            q0, q1 = self.get_queue_names()
+            job0 = self.enqueue(queue=q0)
+            job1 = self.enqueue(queue=q1)
+            worker = jobs.Worker([q0, q1])
+            worker.work(burst=True)
+            for job in [job0, job1]:
+                assert_equal(jobs.job_from_id(job.id).get_status(),
+                             u'finished')
+            # The worker is stored in the main Redis instance
+            ok_(worker.get_current_job_id() is None)
+            results = stats.get_queue_stats(
+                [jobs.get_queue(q) for q in [q0, q1]])
+            assert_equal([r[u'drain_rate'] > 0 for r in results],
+                         [True, True])
+
+    def test_failed_jobs(self):
+        with self.sharded():
+            q0, q1 = self.get_queue_names()
+            job0 = self.enqueue(failing_job, queue=q0)
+            job1 = self.enqueue(failing_job, queue=q1)
+            jobs.Worker([q0, q1]).work(burst=True)
+            ids = [job[u'id'] for job in failed.iter_failed_jobs()]
+            assert_equal(sorted(ids), sorted([job0.id, job1.id]))
+            assert_equal(sorted(failed.requeue_failed_jobs(ids)),
+                         sorted(ids))
+            assert_equal(jobs.get_queue(q1).job_ids, [job1.id])
+
+    def test_search(self):
+        with self.sharded():
+            q0, q1 = self.get_queue_names()
+            job0 = self.enqueue(queue=q0, title=u'Job 0')
+            job1 = self.enqueue(queue=q1, title=u'Job 1')
+            job2 = self.enqueue(queue=q0, title=u'Job 2')
+            found = index.search_jobs(q=u'job')
+            assert_equal([job[u'id'] for job in found],
+                         [job0.id, job1.id, job2.id])
+
+    def test_reap(self):
+        with self.sharded():
+            q0, q1 = self.get_queue_names()
+            self.enqueue(queue=q0)
+            job = self.enqueue(queue=q1)
+            rq_queue = jobs.get_queue(q1)
+            job = rq_queue.dequeue()
+            worker = jobs.Worker([q0, q1], name=u'dead-worker')
+            worker.prepare_job_execution(job)
+            queues = [jobs.get_queue(q) for q in [q0, q1]]
+            assert_equal(reaper.reap(queues), [job.id])
+            assert_equal(rq_queue.job_ids, [job.id])
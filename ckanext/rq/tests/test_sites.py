@@ -0,0 +1,76 @@
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, raises
+from ckantoolkit import config
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import sites
+
+from ckanext.rq.tests.helpers import RQTestBase
+
+
+TEST_INI = os.path.abspath(os.path.join(os.path.dirname(__file__), u'..',
+                                        u'..', u'..', u'test.ini'))
+
+
+def site_id_job():
+    return config[u'ckan.site_id']
+
+
+class TestMultiSiteWorker(RQTestBase):
+
+    def setup(self):
+        super(TestMultiSiteWorker, self).setup()
+        self.tmp_dir = tempfile.mkdtemp()
+        sites._site_configs.clear()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+        sites._site_configs.clear()
+
+    def write_config(self, site_id, **settings):
+        u'''
+        Write the configuration file of a test site.
+        '''
+        path = os.path.join(self.tmp_dir, u'{}.ini'.format(site_id))
+        lines = [u'[app:main]',
+                 u'use = config:{}'.format(TEST_INI),
+                 u'ckan.site_id = {}'.format(site_id)]
+        lines.extend(u'{} = {}'.format(*item) for item in settings.items())
+        with open(path, u'w') as f:
+            f.write(u'\n'.join(lines) + u'\n')
+        return path
+
+    def test_queues(self):
+        paths = [self.write_config(u'site-a'), self.write_config(u'site-b')]
+        worker = sites.MultiSiteWorker(paths, [u'default', u'my_queue'])
+        assert_equal(worker.queue_names(), [
+            jobs.add_queue_name_prefix(u'default', u'site-a'),
+            jobs.add_queue_name_prefix(u'my_queue', u'site-a'),
+            jobs.add_queue_name_prefix(u'default', u'site-b'),
+            jobs.add_queue_name_prefix(u'my_queue', u'site-b'),
+        ])
+
+    def test_job_uses_config_of_its_site(self):
+        path = self.write_config(u'site-a')
+        queue = jobs.get_queue(site_id=u'site-a')
+        job = queue.enqueue(site_id_job)
+        sites.MultiSiteWorker([path]).work(burst=True)
+        job.refresh()
+        assert_equal(job.result, u'site-a')
+        assert_equal(config[u'ckan.site_id'], site_id_job())
+
+    @raises(ValueError)
+    def test_duplicate_site(self):
+        path = self.write_config(u'site-a')
+        sites.MultiSiteWorker([path, path])
+
+    @raises(ValueError)
+    def test_different_redis(self):
+        path = self.write_config(u'site-a', **{
+            u'ckan.redis.url': u'redis://redis.example.com:6379/0'})
+        sites.MultiSiteWorker([path])
@@ -0,0 +1,134 @@
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import assert_equal, ok_
+from redis.exceptions import ConnectionError
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import spool
+
+from ckanext.rq.tests.helpers import changed_config, RQTestBase
+
+
+class SpoolTestBase(RQTestBase):
+
+    def setup(self):
+        super(SpoolTestBase, self).setup()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spool_path = os.path.join(self.tmp_dir, u'spool.sqlite')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def spooled_config(self):
+        return changed_config(spool.SPOOL_PATH_SETTING_NAME, self.spool_path)
+
+
+def _redis_down(*args, **kwargs):
+    raise ConnectionError(u'Redis is down')
+
+
+class TestSpool(SpoolTestBase):
+
+    def test_disabled_by_default(self):
+        ok_(not spool.is_enabled())
+        assert_equal(spool.pending(), 0)
+        assert_equal(spool.replay(), 0)
+
+    def test_enqueue_without_spool_raises(self):
+        with mock.patch(u'ckanext.rq.jobs._push_job', _redis_down):
+            try:
+                self.enqueue()
+            except ConnectionError:
+                pass
+            else:
+                raise AssertionError(u'ConnectionError was not raised')
+
+    def test_enqueue_spools_if_redis_is_down(self):
+        with self.spooled_config():
+            with mock.patch(u'ckanext.rq.jobs._push_job', _redis_down):
+                job = self.enqueue(title=u'Spooled', queue=u'my_queue')
+            assert_equal(spool.pending(), 1)
+            assert_equal(self.all_jobs(), [])
+            assert_equal(spool.replay(), 1)
+            assert_equal(spool.pending(), 0)
+        replayed = jobs.job_from_id(job.id)
+        assert_equal(replayed.meta[u'title'], u'Spooled')
+        assert_equal(jobs.remove_queue_name_prefix(replayed.origin),
+                     u'my_queue')
+
+    def test_replay_keeps_order(self):
+        with self.spooled_config():
+            with mock.patch(u'ckanext.rq.jobs._push_job', _redis_down):
+                spooled = [self.enqueue(args=[i]) for i in range(5)]
+            spool.replay(batch_size=2)
+            job = self.enqueue(args=[5])
+        ids = jobs.get_queue().job_ids
+        assert_equal(ids, [j.id for j in spooled] + [job.id])
+
+    def test_replay_does_not_duplicate(self):
+        with self.spooled_config():
+            with mock.patch(u'ckanext.rq.jobs._push_job', _redis_down):
+                job = self.enqueue()
+            spool.replay()
+            # Simulate a replay that was interrupted after Redis accepted
+            # the job but before it was removed from the spool
+            spool.append(job)
+            assert_equal(spool.replay(), 0)
+        assert_equal(jobs.get_queue().job_ids, [job.id])
+
+    def test_replay_max_batches(self):
+        with self.spooled_config():
+            with mock.patch(u'ckanext.rq.jobs._push_job', _redis_down), \
+                    mock.patch(u'ckanext.rq.spool._push_rows', _redis_down):
+                spooled = [self.enqueue(args=[i]) for i in range(5)]
+            assert_equal(spool.replay(batch_size=2, max_batches=1), 2)
+            assert_equal(spool.pending(), 3)
+            ok_(spool.may_have_jobs())
+        assert_equal(jobs.get_queue().job_ids, [j.id for j in spooled[:2]])
+
+    def test_enqueue_replays_spooled_jobs_first(self):
+        with self.spooled_config():
+            with mock.patch(u'ckanext.rq.jobs._push_job', _redis_down):
+                spooled = self.enqueue()
+            job = self.enqueue()
+            assert_equal(spool.pending(), 0)
+        assert_equal(jobs.get_queue().job_ids, [spooled.id, job.id])
+
+    def test_enqueue_keeps_order_of_large_spool(self):
+        with self.spooled_config():
+            with mock.patch(u'ckanext.rq.jobs._push_job', _redis_down), \
+                    mock.patch(u'ckanext.rq.spool._push_rows', _redis_down):
+                spooled = [self.enqueue(args=[i]) for i in range(5)]
+            with mock.patch.object(spool, u'BATCH_SIZE', 2):
+                # Replaying the first batch leaves older jobs in the spool
+                new = [self.enqueue(args=[i]) for i in range(5, 7)]
+                assert_equal(spool.pending(), 3)
+            spool.replay()
+            new.append(self.enqueue(args=[7]))
+        assert_equal(jobs.get_queue().job_ids,
+                     [j.id for j in spooled + new])
+
+    def test_enqueue_does_not_open_empty_spool(self):
+        with self.spooled_config():
+            ok_(not spool.may_have_jobs())
+            with mock.patch(u'ckanext.rq.jobs._push_job', _redis_down):
+                self.enqueue()
+            ok_(spool.may_have_jobs())
+            spool.replay()
+            ok_(not spool.may_have_jobs())
+            with mock.patch.object(spool, u'_connect') as connect:
+                self.enqueue()
+            ok_(not connect.called)
+
+    def test_worker_replays_spool(self):
+        with self.spooled_config():
+            with mock.patch(u'ckanext.rq.jobs._push_job', _redis_down):
+                self.enqueue()
+            jobs.Worker().work(burst=True)
+            assert_equal(spool.pending(), 0)
+        assert_equal(self.all_jobs(), [])
@@ -0,0 +1,87 @@
+# encoding: utf-8
+
+from nose.tools import assert_equal, ok_
+import requests
+from requests.adapters import BaseAdapter
+import sqlalchemy
+
+import ckanext.rq.jobs as jobs
+
+try:
+    from ckan.tests.helpers import call_action
+except ImportError:
+    from ckanext.rq.tests.helpers import call_action
+
+from ckanext.rq.tests.helpers import RQTestBase
+
+
+def database_job():
+    u'''
+    A background job that queries an in-memory database.
+    '''
+    engine = sqlalchemy.create_engine(u'sqlite://')
+    with engine.connect() as conn:
+        conn.execute(u'CREATE TABLE numbers (n INTEGER)')
+        for i in range(10):
+            conn.execute(u'INSERT INTO numbers VALUES (?)', i)
+        conn.execute(u'SELECT SUM(n) FROM numbers')
+
+
+class _FakeAdapter(BaseAdapter):
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def http_job(count):
+    u'''
+    A background job that makes HTTP requests.
+    '''
+    session = requests.Session()
+    session.mount(u'http://', _FakeAdapter())
+    for _ in range(count):
+        session.get(u'http://solr.example.org/select')
+
+
+def failing_database_job():
+    database_job()
+    raise RuntimeError(u'JOB FAILURE')
+
+
+class TestTimings(RQTestBase):
+
+    def timings(self, job):
+        jobs.Worker().work(burst=True)
+        return jobs.job_from_id(job.id).meta[u'timings']
+
+    def test_database_queries(self):
+        timings = self.timings(self.enqueue(database_job))
+        ok_(timings[u'db_queries'] >= 12)
+        ok_(timings[u'db_time'] > 0)
+        ok_(timings[u'db_time'] <= timings[u'total_time'])
+        ok_(timings[u'slowest_statement'])
+        assert_equal(timings[u'http_requests'], 0)
+
+    def test_http_requests(self):
+        timings = self.timings(self.enqueue(http_job, args=[3]))
+        assert_equal(timings[u'http_requests'], 3)
+        ok_(timings[u'http_time'] > 0)
+        assert_equal(timings[u'db_queries'], 0)
+
+    def test_failed_job(self):
+        timings = self.timings(self.enqueue(failing_database_job))
+        ok_(timings[u'db_queries'] >= 12)
+
+    def test_job_show(self):
+        job = self.enqueue(http_job, args=[1])
+        assert_equal(call_action(u'job_show', id=job.id).get(u'timings'),
+                     None)
+        jobs.Worker().work(burst=True)
+        timings = call_action(u'job_show', id=job.id)[u'timings']
+        assert_equal(timings[u'http_requests'], 1)
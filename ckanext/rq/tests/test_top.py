@@ -0,0 +1,56 @@
+# encoding: utf-8
+
+import socket
+
+from nose.tools import assert_equal, ok_
+
+import ckanext.rq.jobs as jobs
+from ckanext.rq import top
+
+from ckanext.rq.tests.helpers import failing_job, RQTestBase
+
+
+class TestTop(RQTestBase):
+
+    def test_queues(self):
+        self.enqueue(queue=u'q1')
+        self.enqueue(queue=u'q1')
+        self.enqueue(queue=u'q2')
+        snapshot = top.get_snapshot([u'q1', u'q2'])
+        assert_equal([(q[u'name'], q[u'depth'], q[u'arrival_rate'] > 0)
+                      for q in snapshot[u'queues']],
+                     [(u'q1', 2, True), (u'q2', 1, True)])
+
+    def test_workers(self):
+        self.enqueue(title=u'My job')
+        job = jobs.get_queue().dequeue()
+        worker = jobs.Worker(name=u'top-worker')
+        worker.register_birth()
+        try:
+            worker.prepare_job_execution(job)
+            snapshot = top.get_snapshot()
+        finally:
+            worker.register_death()
+        worker = [w for w in snapshot[u'workers']
+                  if w[u'name'] == u'top-worker'][0]
+        assert_equal(worker[u'hostname'], socket.gethostname())
+        assert_equal(worker[u'state'], u'busy')
+        assert_equal(worker[u'queues'], [jobs.DEFAULT_QUEUE_NAME])
+        assert_equal(worker[u'job'][u'id'], job.id)
+        assert_equal(worker[u'job'][u'title'], u'My job')
+        ok_(0 <= worker[u'job'][u'runtime'] < 10)
+
+    def test_failures(self):
+        job = self.enqueue(failing_job, title=u'Failing')
+        jobs.Worker().work(burst=True)
+        failures = top.get_snapshot()[u'failures']
+        assert_equal(failures[0][u'id'], job.id)
+        assert_equal(failures[0][u'exc_type'], u'RuntimeError')
+        assert_equal(failures[0][u'title'], u'Failing')
+        assert_equal(failures[0][u'queue'], jobs.DEFAULT_QUEUE_NAME)
+
+    def test_format_snapshot(self):
+        self.enqueue(queue=u'q1')
+        lines = top.format_snapshot(top.get_snapshot([u'q1']), width=40)
+        ok_(lines[1].startswith(u'q1 '))
+        ok_(all(len(line) <= 40 for line in lines))
@@ -0,0 +1,155 @@
+# encoding: utf-8
+
+u'''
+Accounting of the time that background jobs spend in external services.
+
+While a job is performed, the worker records the number and duration of
+the job's database queries (via SQLAlchemy engine events) and, unless
+``ckanext.rq.time_http`` is false, of its HTTP requests made via
+``requests`` (which includes Solr queries). The results are stored in
+the job's ``meta['timings']`` when the job finishes and are returned by
+``job_show``.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import time
+
+try:
+    from ckan.common import config
+except ImportError:
+    # older CKAN versions
+    from pylons import config
+from paste.deploy.converters import asbool
+
+
+log = logging.getLogger(__name__)
+
+# Maximum length of the recorded slowest statement
+MAX_STATEMENT_LENGTH = 1000
+
+# Timings of the job that is currently performed (if any)
+_current = None
+
+_installed = False
+
+
+class JobTimings(object):
+    u'''
+    Time accounting of a single job.
+    '''
+    def __init__(self):
+        self.start = time.time()
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.slowest_statement = None
+        self.slowest_statement_time = 0.0
+        self.http_requests = 0
+        self.http_time = 0.0
+
+    def add_query(self, statement, duration):
+        self.db_queries += 1
+        self.db_time += duration
+        if duration > self.slowest_statement_time:
+            self.slowest_statement = statement[:MAX_STATEMENT_LENGTH]
+            self.slowest_statement_time = duration
+
+    def add_http_request(self, duration):
+        self.http_requests += 1
+        self.http_time += duration
+
+    def as_dict(self):
+        return {
+            u'total_time': round(time.time() - self.start, 6),
+            u'db_queries': self.db_queries,
+            u'db_time': round(self.db_time, 6),
+            u'slowest_statement': self.slowest_statement,
+            u'slowest_statement_time': round(self.slowest_statement_time, 6),
+            u'http_requests': self.http_requests,
+            u'http_time': round(self.http_time, 6),
+        }
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if _current is not None:
+        conn.info.setdefault(u'ckanext_rq_query_start', []).append(
+            time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    starts = conn.info.get(u'ckanext_rq_query_start')
+    if not starts:
+        return
+    duration = time.time() - starts.pop()
+    if _current is not None:
+        _current.add_query(statement, duration)
+
+
+def _instrument_db():
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    event.listen(Engine, u'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, u'after_cursor_execute', _after_cursor_execute)
+
+
+def _instrument_http():
+    try:
+        from requests import Session
+    except ImportError:
+        return
+    send = Session.send
+
+    def timed_send(self, *args, **kwargs):
+        if _current is None:
+            return send(self, *args, **kwargs)
+        start = time.time()
+        try:
+            return send(self, *args, **kwargs)
+        finally:
+            _current.add_http_request(time.time() - start)
+
+    Session.send = timed_send
+
+
+def install():
+    u'''
+    Install the instrumentation hooks.
+
+    Calling this more than once has no effect. The hooks only record
+    anything while a job is performed via :py:func:`timed`.
+    '''
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    _instrument_db()
+    if asbool(config.get(u'ckanext.rq.time_http', True)):
+        _instrument_http()
+
+
+def timed(job):
+    u'''
+    Record the timings of a job while it is performed.
+
+    Replaces the job's ``perform`` method. Once the job has been
+    performed (successfully or not) the timings are stored in
+    ``job.meta['timings']``, so that they are saved along with the job.
+
+    :param rq.job.Job job: The job.
+    '''
+    install()
+    perform = job.perform
+
+    def perform_and_record():
+        global _current
+        timings = _current = JobTimings()
+        try:
+            return perform()
+        finally:
+            _current = None
+            job.meta[u'timings'] = timings.as_dict()
+
+    job.perform = perform_and_record
@@ -0,0 +1,316 @@
+# encoding: utf-8
+
+u'''
+Live overview of background jobs.
+
+``paster jobs top`` shows the depth and rates of the queues, what each
+worker is doing and the most recent failures, and refreshes this view
+every second. Each refresh reads a snapshot with a single pipelined round
+trip per Redis instance (see :py:mod:`ckanext.rq.shards`), so frequent
+refreshes put hardly any load on Redis.
+'''
+
+from __future__ import absolute_import, division
+
+import sys
+import time
+
+from rq.compat import as_text
+from rq.job import Job, unpickle
+from rq.utils import utcnow, utcparse
+
+from ckanext.rq import failed, jobs, shards, stats
+from ckanext.rq.redis import connect_to_redis
+
+
+# Number of recent failures that are shown
+RECENT_FAILURES = 5
+
+# Maximum number of failed jobs that are scanned for recent failures
+FAILURE_SCAN_LIMIT = 1000
+
+_JOB_FIELDS = [u'started_at', u'description', u'meta']
+
+# Read the workers and, if they are stored in the same Redis instance,
+# their current jobs.
+#
+# KEYS[1]: The set of workers
+#
+# Returns for each worker its key, state, current job ID, queues, host
+# name and the started_at, description and meta fields of its job.
+_WORKERS_SCRIPT = b'''
+    local result = {}
+    for _, key in ipairs(redis.call('smembers', KEYS[1])) do
+        local w = redis.call('hmget', key, 'state', 'current_job', 'queues',
+                             'hostname')
+        local j = {false, false, false}
+        if w[2] then
+            j = redis.call('hmget', 'rq:job:' .. w[2], 'started_at',
+                           'description', 'meta')
+        end
+        table.insert(result, {key, w[1] or '', w[2] or '', w[3] or '',
+                              w[4] or '', j[1] or '', j[2] or '',
+                              j[3] or ''})
+    end
+    return result
+'''
+
+# Read the most recent failed jobs of a CKAN instance.
+#
+# KEYS[1]: The failed queue
+# ARGV[1]: The queue name prefix of the CKAN instance
+# ARGV[2]: The maximum number of jobs to return
+# ARGV[3]: The maximum number of failed jobs to scan
+_FAILURES_SCRIPT = b'''
+    local ids = redis.call('lrange', KEYS[1], -tonumber(ARGV[3]), -1)
+    local result = {}
+    for i = #ids, 1, -1 do
+        local v = redis.call('hmget', 'rq:job:' .. ids[i], 'origin',
+                             'ended_at', 'exc_info', 'meta', 'description')
+        if v[1] and string.sub(v[1], 1, #ARGV[1]) == ARGV[1] then
+            table.insert(result, {ids[i], v[1], v[2] or '', v[3] or '',
+                                  v[4] or '', v[5] or ''})
+            if #result >= tonumber(ARGV[2]) then
+                break
+            end
+        end
+    end
+    return result
+'''
+
+
+def _title(meta):
+    return (unpickle(meta) if meta else {}).get(u'title')
+
+
+def _function(description):
+    return as_text(description).split(u'(', 1)[0] or None
+
+
+def get_snapshot(queues=None, window=stats.DEFAULT_WINDOW):
+    u'''
+    Read the current state of queues, workers and failed jobs.
+
+    :param list queues: Names of the queues to show. If not given then
+        all queues are shown.
+
+    :param int window: Number of minutes over which rates are averaged.
+
+    :returns: A dict with the statistics of the queues (``queues``, see
+        :py:func:`ckanext.rq.stats.get_queue_stats`), the workers of this
+        CKAN instance (``workers``) and its most recent failed jobs
+        (``failures``).
+    :rtype: dict
+    '''
+    if queues:
+        queues = [jobs.get_queue(q) for q in queues]
+    else:
+        queues = jobs.get_all_queues()
+    prefix = jobs.add_queue_name_prefix(u'')
+    minutes, period = stats.get_minutes(window)
+
+    # Collect the work for each Redis instance, so that each of them is
+    # asked only once
+    home = connect_to_redis()
+    instances = []
+    by_pool = {}
+
+    def get_instance(connection):
+        try:
+            return by_pool[id(connection.connection_pool)]
+        except KeyError:
+            instance = by_pool[id(connection.connection_pool)] = {
+                u'connection': connection,
+                u'queues': [],
+                u'failures': False,
+                u'workers': False,
+            }
+            instances.append(instance)
+            return instance
+
+    get_instance(home)[u'workers'] = True
+    for connection in shards.connect_to_all_shards():
+        get_instance(connection)[u'failures'] = True
+    for queue in queues:
+        get_instance(queue.connection)[u'queues'].append(queue)
+
+    queue_stats = {}
+    raw_workers = []
+    raw_failures = []
+    for instance in instances:
+        connection = instance[u'connection']
+        with connection.pipeline(transaction=False) as pipeline:
+            if instance[u'workers']:
+                script = connection.register_script(_WORKERS_SCRIPT)
+                script(keys=[jobs.Worker.redis_workers_keys],
+                       client=pipeline)
+            counts = [stats.add_stats_commands(queue, minutes, pipeline)
+                      for queue in instance[u'queues']]
+            if instance[u'failures']:
+                script = connection.register_script(_FAILURES_SCRIPT)
+                script(keys=[failed.get_failed_queue(connection).key],
+                       args=[prefix, RECENT_FAILURES, FAILURE_SCAN_LIMIT],
+                       client=pipeline)
+            values = pipeline.execute()
+        if instance[u'workers']:
+            raw_workers = values.pop(0)
+        if instance[u'failures']:
+            raw_failures.extend(values.pop())
+        start = 0
+        for queue, count in zip(instance[u'queues'], counts):
+            queue_stats[id(queue)] = stats.parse_stats(
+                queue, values[start:start + count], period)
+            start += count
+
+    now = utcnow()
+    workers = []
+    for values in raw_workers:
+        (key, state, job_id, worker_queues, hostname, started_at,
+         description, meta) = [as_text(v) if i < 6 else v
+                               for i, v in enumerate(values)]
+        worker_queues = [q for q in worker_queues.split(u',') if q]
+        if not any(q.startswith(prefix) for q in worker_queues):
+            continue
+        name = key[len(jobs.Worker.redis_worker_namespace_prefix):]
+        worker = {
+            u'name': name,
+            u'hostname': hostname or name.rsplit(u'.', 1)[0],
+            u'state': state,
+            u'queues': [q[len(prefix):] if q.startswith(prefix) else q
+                        for q in worker_queues],
+            u'job': None,
+        }
+        if job_id:
+            if not started_at and shards.is_sharded():
+                # The job is stored in another shard, which takes an
+                # additional round trip
+                connection = shards.connect_to_shard(
+                    shards.get_job_shard(job_id))
+                started_at, description, meta = connection.hmget(
+                    Job.key_for(job_id), _JOB_FIELDS)
+                started_at = as_text(started_at or b'')
+            runtime = None
+            if started_at:
+                runtime = (now - utcparse(started_at)).total_seconds()
+            worker[u'job'] = {
+                u'id': job_id,
+                u'title': _title(meta),
+                u'function': _function(description or b''),
+                u'runtime': runtime,
+            }
+        workers.append(worker)
+    workers.sort(key=lambda w: w[u'name'])
+
+    failures = []
+    for values in raw_failures:
+        failure_id, origin, ended_at, exc_info, meta, description = values
+        ended_at = as_text(ended_at)
+        failures.append({
+            u'id': as_text(failure_id),
+            u'queue': jobs.remove_queue_name_prefix(as_text(origin)),
+            u'ended': utcparse(ended_at) if ended_at else None,
+            u'exc_type': failed.exc_type_from_exc_info(as_text(exc_info)),
+            u'title': _title(meta),
+            u'function': _function(description),
+        })
+    failures.sort(key=lambda f: f[u'ended'] or now, reverse=True)
+
+    results = []
+    for queue in queues:
+        result = queue_stats[id(queue)]
+        result[u'name'] = jobs.remove_queue_name_prefix(result[u'name'])
+        results.append(result)
+    return {
+        u'queues': results,
+        u'workers': workers,
+        u'failures': failures[:RECENT_FAILURES],
+    }
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return u'-'
+    seconds = int(seconds)
+    if seconds < 60:
+        return u'{}s'.format(seconds)
+    if seconds < 3600:
+        return u'{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return u'{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+
+
+def format_snapshot(snapshot, width=80):
+    u'''
+    Format a snapshot for display in a terminal.
+
+    :param dict snapshot: The snapshot, see :py:func:`get_snapshot`.
+
+    :param int width: The width of the terminal. Longer lines are
+        truncated.
+
+    :returns: The lines of the view.
+    :rtype: list
+    '''
+    lines = [u'{:<24} {:>8} {:>8} {:>9} {:>9} {:>8}'.format(
+        u'QUEUE', u'DEPTH', u'RUNNING', u'IN/MIN', u'OUT/MIN', u'DRAIN')]
+    for queue in snapshot[u'queues']:
+        drain_time = queue[u'drain_time']
+        lines.append(u'{:<24} {:>8} {:>8} {:>9.1f} {:>9.1f} {:>8}'.format(
+            queue[u'name'], queue[u'depth'], queue[u'running'],
+            queue[u'arrival_rate'], queue[u'drain_rate'],
+            u'never' if drain_time is None else _format_seconds(drain_time)))
+    lines.append(u'')
+    lines.append(u'{:<32} {:<16} {:<5} {:>8} {}'.format(
+        u'WORKER', u'HOST', u'STATE', u'RUNTIME', u'JOB'))
+    for worker in snapshot[u'workers']:
+        job = worker[u'job']
+        if job is None:
+            runtime, description = u'', u''
+        else:
+            runtime = _format_seconds(job[u'runtime'])
+            description = u'{} {}'.format(job[u'id'],
+                                          job[u'title'] or job[u'function'])
+        lines.append(u'{:<32} {:<16} {:<5} {:>8} {}'.format(
+            worker[u'name'], worker[u'hostname'], worker[u'state'][:5],
+            runtime, description))
+    lines.append(u'')
+    lines.append(u'RECENT FAILURES')
+    for failure in snapshot[u'failures']:
+        ended = failure[u'ended']
+        lines.append(u'{} {} {} {} {}'.format(
+            ended.strftime(u'%H:%M:%S') if ended else u'-',
+            failure[u'id'], failure[u'queue'], failure[u'exc_type'],
+            failure[u'title'] or failure[u'function']))
+    return [line[:width] for line in lines]
+
+
+def run(queues=None, interval=1, out=sys.stdout):
+    u'''
+    Show a continuously refreshed view until interrupted.
+
+    :param list queues: Names of the queues to show. If not given then
+        all queues are shown.
+
+    :param float interval: Seconds between refreshes.
+    '''
+    try:
+        while True:
+            snapshot = get_snapshot(queues)
+            width = _get_terminal_width()
+            out.write(u'\x1b[H\x1b[2J')
+            out.write(u'\n'.join(format_snapshot(snapshot, width)))
+            out.write(u'\n')
+            out.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def _get_terminal_width():
+    try:
+        import fcntl
+        import struct
+        import termios
+        data = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, b'1234')
+        return struct.unpack(u'hh', data)[1] or 80
+    except Exception:
+        return 80